@@ -0,0 +1,24 @@
+"""
+Batch mode of accounting_service worker (see app_common/messaging/batch_consumer.py):
+ card authorization commands are handled in batches,
+ and responses to a batch are published at once.
+
+Run it instead of Celery worker with
+    PYTHONPATH=. python -m accounting_service.batch_worker
+"""
+from accounting_service.app_common.messaging import accounting_service_messaging, \
+    create_order_saga_response_queue
+from accounting_service.app_common.messaging.batch_consumer import BatchCommandConsumer
+from accounting_service.app_common.messaging.accounting_service_messaging import \
+    authorize_card_message
+from .worker import command_handlers_celery_app, authorize_card
+
+consumer = BatchCommandConsumer(
+    command_handlers_celery_app,
+    queue_name=accounting_service_messaging.COMMANDS_QUEUE,
+    handlers={authorize_card_message.TASK_NAME: authorize_card},
+    response_queue=create_order_saga_response_queue,
+)
+
+if __name__ == '__main__':
+    consumer.run()
@@ -1,28 +1,32 @@
-import logging
+import os
 import random
 from dataclasses import asdict
 
 from celery import Celery, Task
-from saga_framework import saga_step_handler
-
-from accounting_service.app_common import settings
+from accounting_service.app_common import settings, metrics
 from accounting_service.app_common.messaging import \
-    accounting_service_messaging, CREATE_ORDER_SAGA_RESPONSE_QUEUE
+    accounting_service_messaging, create_order_saga_response_queue
 from accounting_service.app_common.messaging.accounting_service_messaging import \
     authorize_card_message
+from accounting_service.app_common.messaging.codec import configure_wire_format, decode_payload
+from accounting_service.app_common.messaging.saga_handlers import saga_step_handler
+from accounting_service.app_common.simulation import simulated, configure_simulated_worker
+from accounting_service.app_common.structured_logging import setup_logging, setup_celery_logging
 
-logging.basicConfig(level=logging.DEBUG)
+setup_logging()
+setup_celery_logging()
 
 command_handlers_celery_app = Celery(
     'accounting_command_handlers',
     broker=settings.CELERY_BROKER)
 command_handlers_celery_app.conf.task_default_queue = accounting_service_messaging.COMMANDS_QUEUE
+configure_wire_format(command_handlers_celery_app)
+configure_simulated_worker(command_handlers_celery_app, 'accounting_service')
 
 
-@command_handlers_celery_app.task(bind=True, name=authorize_card_message.TASK_NAME)
-@saga_step_handler(response_queue=CREATE_ORDER_SAGA_RESPONSE_QUEUE)
-def authorize_card_task(self: Task, saga_id: int, payload: dict) -> dict:
-    request_data = authorize_card_message.Payload(**payload)
+@simulated(authorize_card_message.TASK_NAME)
+def authorize_card(saga_id: int, payload: dict) -> dict:
+    request_data = decode_payload(authorize_card_message.TASK_NAME, payload)  # type: authorize_card_message.Payload
 
     # emulate an error
     if request_data.amount >= 50:
@@ -33,3 +37,14 @@ def authorize_card_task(self: Task, saga_id: int, payload: dict) -> dict:
     return asdict(authorize_card_message.Response(
         transaction_id=transaction_id
     ))
+
+
+@command_handlers_celery_app.task(bind=True, name=authorize_card_message.TASK_NAME)
+@saga_step_handler(response_queue=create_order_saga_response_queue)
+def authorize_card_task(self: Task, saga_id: int, payload: dict) -> dict:
+    return authorize_card(saga_id, payload)
+
+
+# e.g. outcomes of simulated commands
+if os.getenv('WORKER_METRICS_PORT'):
+    metrics.start_http_server(int(os.getenv('WORKER_METRICS_PORT')))
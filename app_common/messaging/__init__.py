@@ -1,3 +1,72 @@
+import sys
+import typing
+import zlib
+
+from .. import settings
+
 CREATE_ORDER_SAGA_RESPONSE_QUEUE = 'create_order_saga_responses'
 
 
+def lazy_attributes(module_name: str, names: typing.Iterable[str],
+                    build: typing.Callable[[], dict]) -> typing.Callable[[str], typing.Any]:
+    """
+    Returns module-level `__getattr__` that builds `names` attributes with `build()` on first access to any of them:
+        __getattr__ = lazy_attributes(__name__, ['message'], _build_message)
+    """
+    names = frozenset(names)
+
+    def __getattr__(name: str):
+        if name not in names:
+            raise AttributeError(f'module {module_name!r} has no attribute {name!r}')
+
+        module_globals = vars(sys.modules[module_name])
+        module_globals.update(build())
+        return module_globals[name]
+
+    return __getattr__
+
+
+def lazy_asyncapi_docs(module_name: str, task_name: str, title: str, summary: str, payload: type,
+                       success_response: typing.Optional[dict] = None) -> typing.Callable[[str], typing.Any]:
+    """
+    Returns module-level `__getattr__` of a command message module with AsyncAPI docs of the command:
+     `message` and, if `success_response` (keyword arguments of asyncapi_message_for_success_response()) is given,
+     `success_response`. Docs are built on first access: asyncapi is slow to import, and only docs servers need it
+        __getattr__ = lazy_asyncapi_docs(__name__, TASK_NAME, title='...', summary='...', payload=Payload,
+                                         success_response=dict(title='...', payload_dataclass=Response))
+    """
+    def build() -> dict:
+        import asyncapi
+
+        docs = dict(message=asyncapi.Message(name=task_name, title=title, summary=summary, payload=payload))
+        if success_response is not None:
+            from saga_framework.asyncapi_utils import asyncapi_message_for_success_response
+
+            docs['success_response'] = asyncapi_message_for_success_response(task_name, **success_response)
+        return docs
+
+    names = ['message'] if success_response is None else ['message', 'success_response']
+    return lazy_attributes(module_name, names, build)
+
+
+def create_order_saga_response_queue_for_partition(partition: int) -> str:
+    if settings.CREATE_ORDER_SAGA_RESPONSE_PARTITIONS == 1:
+        return CREATE_ORDER_SAGA_RESPONSE_QUEUE
+
+    return f'{CREATE_ORDER_SAGA_RESPONSE_QUEUE}.{partition}'
+
+
+def create_order_saga_response_queue(saga_id: int) -> str:
+    """
+    Responses for one saga always go to the same partition (queue),
+     so they are handled by the same orchestrator worker
+    """
+    partition = zlib.crc32(str(saga_id).encode()) % settings.CREATE_ORDER_SAGA_RESPONSE_PARTITIONS
+    return create_order_saga_response_queue_for_partition(partition)
+
+
+def create_order_saga_response_queues(partitions: typing.Iterable[int] = None) -> typing.List[str]:
+    if partitions is None:
+        partitions = range(settings.CREATE_ORDER_SAGA_RESPONSE_PARTITIONS)
+
+    return [create_order_saga_response_queue_for_partition(partition) for partition in partitions]
@@ -1,7 +1,6 @@
 import dataclasses
 
-import asyncapi
-from saga_framework.asyncapi_utils import asyncapi_message_for_success_response
+from .. import lazy_asyncapi_docs
 
 TASK_NAME = 'accounting_service.authorize_card'
 
@@ -17,16 +16,9 @@ class Response:
     transaction_id: int
 
 
-message = asyncapi.Message(
-    name=TASK_NAME,
+__getattr__ = lazy_asyncapi_docs(
+    __name__, TASK_NAME,
     title='Authorize previously saved card',
     summary='This command authorizes_money from previously saved card',
     payload=Payload,
-)
-
-success_response = asyncapi_message_for_success_response(
-    TASK_NAME,
-    title='Transaction ID is returned',
-    payload_dataclass=Response
-)
-
+    success_response=dict(title='Transaction ID is returned', payload_dataclass=Response))
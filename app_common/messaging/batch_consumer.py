@@ -0,0 +1,219 @@
+"""
+Batch mode for saga step handler workers (an alternative to running them as Celery workers).
+
+Commands are taken from service commands queue in batches: up to `batch_size` commands,
+ or less if `batch_timeout_ms` milliseconds passed since the first command of a batch was received.
+Each command of a batch is handled separately, so one bad command doesn't fail the whole batch:
+ its handler exception becomes a failure response, just as with `@saga_step_handler`.
+Responses to the whole batch are published with one producer and confirmed by broker at once,
+ and only then the batch is acknowledged.
+
+Commands which have no batch handler (e.g. compensations) are run as regular Celery tasks, in-process.
+
+Commands with a bulk handler are handled all at once: commands of a batch with the same task name are passed
+ to the handler together, e.g. to change many rows with one statement. It returns result of each command
+ (response payload, or exception to send failure response with), or None if commands have no responses.
+If bulk handler raises, its commands are run as regular Celery tasks, one by one.
+
+Usage:
+    def verify_consumer_details(saga_id: int, payload: dict) -> typing.Union[dict, None]:
+        ...  # same as Celery task body, returns response payload or raises
+
+    BatchCommandConsumer(
+        command_handlers_celery_app,
+        queue_name=consumer_service_messaging.COMMANDS_QUEUE,
+        handlers={verify_consumer_details_message.TASK_NAME: verify_consumer_details},
+        response_queue=create_order_saga_response_queue,
+    ).run()
+
+    def approve_tickets(commands: typing.List[typing.Tuple[int, dict]]) -> typing.List[typing.Optional[Exception]]:
+        ...  # [(saga_id, payload), ...] -> result of each command, in the same order
+
+    BatchCommandConsumer(..., bulk_handlers={approve_ticket_message.TASK_NAME: approve_tickets})
+"""
+import collections
+import logging
+import socket
+import threading
+import time
+import typing
+from dataclasses import asdict
+
+from celery import Celery
+from kombu import Connection, Message
+from saga_framework import success_task_name, failure_task_name, serialize_saga_error
+
+from .. import settings
+from .codec import ACCEPT_CONTENT, encode_payload
+from .producer import ConfirmBatchingProducerPool
+from .saga_handlers import ResponseQueue, get_response_queue
+
+logger = logging.getLogger(__name__)
+
+BatchHandler = typing.Callable[[int, dict], typing.Union[dict, None]]
+# [(saga_id, payload), ...] -> [response payload or exception, ...] or None (no responses)
+BulkHandler = typing.Callable[[typing.List[typing.Tuple[int, dict]]],
+                              typing.Optional[typing.List[typing.Union[dict, None, Exception]]]]
+
+
+class BatchCommandConsumer:
+    # how often to check if consumer is stopped while waiting for commands
+    poll_interval = 1
+
+    def __init__(self, celery_app: Celery, queue_name: str,
+                 handlers: typing.Dict[str, BatchHandler],
+                 response_queue: ResponseQueue,
+                 bulk_handlers: typing.Dict[str, BulkHandler] = None,
+                 batch_size: int = settings.COMMANDS_BATCH_SIZE,
+                 batch_timeout_ms: float = settings.COMMANDS_BATCH_TIMEOUT_MS):
+        self.celery_app = celery_app
+        self.queue_name = queue_name
+        self.handlers = handlers
+        self.bulk_handlers = bulk_handlers or {}
+        self.response_queue = response_queue
+        self.batch_size = batch_size
+        self.batch_timeout_ms = batch_timeout_ms
+
+        # responses are confirmed by broker explicitly, once per batch (see _publish_responses)
+        self.producer_pool = ConfirmBatchingProducerPool(celery_app, size=1, flush_size=batch_size + 1)
+        self._messages = []  # type: typing.List[Message]
+        self._stopped = threading.Event()
+        # RabbitMQ can acknowledge all messages up to the given one at once, in-memory transport can't
+        self._ack_multiple = False
+
+    def run(self):
+        queue = self.celery_app.amqp.queues[self.queue_name]
+        with self.celery_app.connection_for_read() as connection, \
+                connection.Consumer([queue], callbacks=[self._on_message],
+                                    accept=ACCEPT_CONTENT, prefetch_count=self.batch_size):
+            self._ack_multiple = connection.transport.driver_type == 'amqp'
+            logger.info('Consuming %s in batches of up to %s commands or %s ms',
+                        self.queue_name, self.batch_size, self.batch_timeout_ms)
+            while not self._stopped.is_set():
+                messages = self._receive_batch(connection)
+                if messages:
+                    self.handle_batch(messages)
+
+        self.producer_pool.close()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _on_message(self, body, message: Message):
+        self._messages.append(message)
+
+    def _receive_batch(self, connection: Connection) -> typing.List[Message]:
+        batch_deadline = None
+        while len(self._messages) < self.batch_size and not self._stopped.is_set():
+            if batch_deadline is None:
+                timeout = self.poll_interval
+            else:
+                timeout = batch_deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+
+            try:
+                connection.drain_events(timeout=timeout)
+            except socket.timeout:
+                pass
+
+            if self._messages and batch_deadline is None:
+                batch_deadline = time.monotonic() + self.batch_timeout_ms / 1000
+
+        messages, self._messages = self._messages, []
+        return messages
+
+    def handle_batch(self, messages: typing.List[Message]):
+        responses = []
+        malformed_messages = []
+        bulk_messages = collections.defaultdict(list)  # type: typing.Dict[str, typing.List[Message]]
+        for message in messages:
+            try:
+                if message.headers['task'] in self.bulk_handlers:
+                    message.decode()  # malformed messages are rejected here, not in the middle of bulk
+                    bulk_messages[message.headers['task']].append(message)
+                    continue
+                response = self._handle_message(message)
+            except Exception:
+                # e.g. message can't be decoded, so there's no saga to respond to
+                logger.exception('Rejecting malformed command %s', message.headers)
+                malformed_messages.append(message)
+                continue
+
+            if response:
+                responses.append(response)
+
+        for task_name, task_messages in bulk_messages.items():
+            responses.extend(self._handle_bulk(task_name, task_messages))
+
+        # if publishing fails, batch isn't acknowledged and will be redelivered
+        self._publish_responses(responses)
+
+        for message in malformed_messages:
+            message.reject()
+        if self._ack_multiple and not malformed_messages:
+            messages[-1].ack(multiple=True)
+        else:
+            for message in messages:
+                if message not in malformed_messages:
+                    message.ack()
+
+        logger.debug('Handled batch of %s commands from %s', len(messages), self.queue_name)
+
+    def _handle_message(self, message: Message) -> typing.Union[typing.Tuple[str, list], None]:
+        """
+        Returns (response task name, response args) or None if there's no response to send
+        """
+        task_name, task_id = message.headers['task'], message.headers['id']
+        args, kwargs, _ = message.decode()
+
+        handler = self.handlers.get(task_name)
+        if handler is None:
+            # no batch handler, run as usual Celery task (it sends response itself, if any)
+            self.celery_app.tasks[task_name].apply(args=args, kwargs=kwargs, task_id=task_id)
+            return None
+
+        saga_id, payload = args
+        try:
+            response_payload = handler(saga_id, payload)
+            response_task_name = success_task_name(task_name)
+        except Exception as exc:
+            logger.exception(exc)
+            response_payload = asdict(serialize_saga_error(exc))
+            response_task_name = failure_task_name(task_name)
+
+        return response_task_name, [saga_id, encode_payload(response_task_name, response_payload)]
+
+    def _handle_bulk(self, task_name: str, messages: typing.List[Message]) -> typing.List[typing.Tuple[str, list]]:
+        commands = [tuple(message.decode()[0]) for message in messages]
+        try:
+            results = self.bulk_handlers[task_name](commands)
+        except Exception:
+            logger.exception('Bulk handler of %s failed, running %s commands one by one', task_name, len(messages))
+            for message in messages:
+                args, kwargs, _ = message.decode()
+                self.celery_app.tasks[task_name].apply(args=args, kwargs=kwargs, task_id=message.headers['id'])
+            return []
+
+        if results is None:
+            return []
+
+        responses = []
+        for (saga_id, _), result in zip(commands, results):
+            if isinstance(result, Exception):
+                response_payload = asdict(serialize_saga_error(result))
+                response_task_name = failure_task_name(task_name)
+            else:
+                response_payload = result
+                response_task_name = success_task_name(task_name)
+            responses.append((response_task_name, [saga_id, encode_payload(response_task_name, response_payload)]))
+        return responses
+
+    def _publish_responses(self, responses: typing.List[typing.Tuple[str, list]]):
+        with self.producer_pool.acquire() as producer:
+            for response_task_name, response_args in responses:
+                saga_id = response_args[0]
+                self.celery_app.send_task(response_task_name, args=response_args,
+                                          queue=get_response_queue(self.response_queue, saga_id),
+                                          producer=producer)
+            producer.flush()
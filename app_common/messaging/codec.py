@@ -0,0 +1,257 @@
+"""
+Compact binary wire format for messaging dataclasses (command payloads and step responses).
+
+Payload is encoded with msgpack as a list of field values in dataclass field order,
+ prefixed with payload schema version:
+    create_ticket_message.Payload(order_id=1, customer_id=2, items=[OrderItem('pizza', 1)])
+    -> [1, 1, 2, [['pizza', 1]]]
+Nested dataclasses (and lists of them) are encoded the same way, without version.
+Codecs are generated from dataclass definitions, see `build_registry()`.
+
+Schema evolution: fields may only be appended to a dataclass (with a default value),
+ and message module's SCHEMA_VERSION is incremented then.
+ * message of an older version lacks new trailing fields, so they get their default values
+ * message of a newer version has extra trailing fields, they are dropped
+So senders and receivers of a message can be upgraded in any order.
+Version is checked on decoding: message without a valid version (not a positive integer),
+ or lacking fields that have no default value, is rejected with UnknownSchemaVersion.
+
+Rolling out:
+ 1. deploy all services (they accept both JSON and msgpack messages, see ACCEPT_CONTENT)
+ 2. set MESSAGING_WIRE_FORMAT=msgpack for services, so they send msgpack messages
+
+Usage:
+    configure_wire_format(celery_app)  # once, for each Celery app
+
+    payload = encode_payload(create_ticket_message.TASK_NAME, asdict(create_ticket_message.Payload(...)))
+    celery_app.send_task(create_ticket_message.TASK_NAME, args=[saga_id, payload], ...)
+
+    request_data = decode_payload(create_ticket_message.TASK_NAME, payload)  # -> create_ticket_message.Payload
+"""
+import dataclasses
+import logging
+import typing
+
+import msgpack
+from celery import Celery
+from saga_framework import success_task_name, failure_task_name, SagaErrorPayload
+
+from .. import settings
+from .accounting_service_messaging import authorize_card_message
+from .consumer_service_messaging import verify_consumer_details_message
+from .restaurant_service_messaging import create_ticket_message, reject_ticket_message, approve_ticket_message
+
+logger = logging.getLogger(__name__)
+
+# content types all services accept, whichever format they send
+ACCEPT_CONTENT = ['json', 'msgpack']
+# Celery serializer for messages sent
+SERIALIZER = 'msgpack' if settings.MESSAGING_WIRE_FORMAT == 'msgpack' else 'json'
+
+MESSAGE_MODULES = [
+    verify_consumer_details_message,
+    create_ticket_message,
+    reject_ticket_message,
+    approve_ticket_message,
+    authorize_card_message,
+]
+
+
+class _FieldCodec:
+    """
+    Converts value of one (possibly nested) field to msgpack-friendly form and back
+    """
+    def __init__(self, field_type):
+        self.field_type = field_type
+        self.item_codec = None  # for lists
+        self.row_codec = None  # type: typing.Optional[_RowCodec]  # for nested dataclasses
+
+        origin = typing.get_origin(field_type)
+        args = typing.get_args(field_type)
+        if origin is typing.Union and type(None) in args:  # Optional[...]
+            field_type = next(arg for arg in args if arg is not type(None))
+            origin, args = typing.get_origin(field_type), typing.get_args(field_type)
+
+        if origin in (list, typing.List) and args:
+            self.item_codec = _FieldCodec(args[0])
+        elif dataclasses.is_dataclass(field_type):
+            self.row_codec = _RowCodec(field_type)
+
+    def to_wire(self, value):
+        if value is None:
+            return None
+        if self.item_codec:
+            return [self.item_codec.to_wire(item) for item in value]
+        if self.row_codec:
+            return self.row_codec.to_row(value)
+
+        return value
+
+    def from_wire(self, value):
+        if value is None:
+            return None
+        if self.item_codec:
+            return [self.item_codec.from_wire(item) for item in value]
+        if self.row_codec:
+            return self.row_codec.from_row(value)
+
+        return value
+
+    def from_dict_value(self, value):
+        if value is None:
+            return None
+        if self.item_codec:
+            return [self.item_codec.from_dict_value(item) for item in value]
+        if self.row_codec:
+            return self.row_codec.from_dict(value)
+
+        return value
+
+
+class _RowCodec:
+    """
+    Dataclass instance (or dict with its fields) <-> list of field values
+    """
+    def __init__(self, dataclass_type: type):
+        self.dataclass_type = dataclass_type
+        type_hints = typing.get_type_hints(dataclass_type)
+        self.fields = [(field.name, _FieldCodec(type_hints[field.name]))
+                       for field in dataclasses.fields(dataclass_type)]
+
+    def to_row(self, value) -> list:
+        if isinstance(value, dict):
+            return [field_codec.to_wire(value[name]) for name, field_codec in self.fields]
+
+        return [field_codec.to_wire(getattr(value, name)) for name, field_codec in self.fields]
+
+    def from_row(self, row: list):
+        # older message may lack trailing fields (defaults are used), newer one may have extra ones (dropped)
+        return self.dataclass_type(**{name: field_codec.from_wire(value)
+                                      for (name, field_codec), value in zip(self.fields, row)})
+
+    def from_dict(self, data: dict):
+        return self.dataclass_type(**{name: field_codec.from_dict_value(data[name])
+                                      for name, field_codec in self.fields if name in data})
+
+
+class UnknownSchemaVersion(ValueError):
+    pass
+
+
+class MessageCodec:
+    def __init__(self, dataclass_type: type, version: int = 1):
+        self.dataclass_type = dataclass_type
+        self.version = version
+        self._row_codec = _RowCodec(dataclass_type)
+        # message of any version has at least fields up to the last one without default value
+        fields = dataclasses.fields(dataclass_type)
+        self._required_fields_count = max(
+            (number for number, field in enumerate(fields, 1)
+             if field.default is dataclasses.MISSING and field.default_factory is dataclasses.MISSING),
+            default=0)
+
+    def encode(self, value) -> bytes:
+        """
+        `value` is a dataclass instance or a dict with its fields (e.g. produced by `asdict`)
+        """
+        return msgpack.packb([self.version] + self._row_codec.to_row(value), use_bin_type=True)
+
+    def decode(self, data: bytes):
+        version, *row = msgpack.unpackb(data, raw=False)
+        if isinstance(version, bool) or not isinstance(version, int) or version < 1:
+            raise UnknownSchemaVersion(f'{self.dataclass_type.__qualname__} message has unknown '
+                                       f'schema version {version!r}')
+        if len(row) < self._required_fields_count:
+            raise UnknownSchemaVersion(f'{self.dataclass_type.__qualname__} message of version {version} has '
+                                       f'{len(row)} fields, at least {self._required_fields_count} are expected')
+        if version > self.version:
+            logger.debug('Decoding %s of version %s with codec of version %s',
+                         self.dataclass_type.__qualname__, version, self.version)
+
+        return self._row_codec.from_row(row)
+
+    def from_dict(self, data: dict):
+        """
+        Builds dataclass from JSON-decoded payload, including nested dataclasses
+        """
+        return self._row_codec.from_dict(data)
+
+
+class CodecRegistry:
+    def __init__(self):
+        self._codecs = {}  # type: typing.Dict[str, MessageCodec]
+
+    def register(self, task_name: str, dataclass_type: type, version: int = 1):
+        self._codecs[task_name] = MessageCodec(dataclass_type, version)
+
+    def get(self, task_name: str) -> typing.Optional[MessageCodec]:
+        return self._codecs.get(task_name)
+
+    def __contains__(self, task_name: str) -> bool:
+        return task_name in self._codecs
+
+    def encode_payload(self, task_name: str, payload: typing.Any,
+                       wire_format: str = settings.MESSAGING_WIRE_FORMAT) -> typing.Any:
+        """
+        Returns what to send as task payload: bytes, if message should be sent in binary format,
+         otherwise payload itself (e.g. for JSON, or if there's no codec for the task)
+        """
+        codec = self.get(task_name)
+        if wire_format != 'msgpack' or codec is None or payload is None:
+            return payload
+
+        return codec.encode(payload)
+
+    def decode_payload(self, task_name: str, payload: typing.Any) -> typing.Any:
+        """
+        Returns dataclass instance for payload received in any format (bytes or JSON-decoded dict)
+        """
+        codec = self.get(task_name)
+        if codec is None or payload is None:
+            return payload
+
+        if isinstance(payload, bytes):
+            return codec.decode(payload)
+
+        return codec.from_dict(payload)
+
+    def decode_payload_as_dict(self, task_name: str, payload: typing.Any) -> typing.Any:
+        """
+        Same as `decode_payload`, but returns dict (as it would be received in JSON)
+        """
+        if not isinstance(payload, bytes):
+            return payload
+
+        return dataclasses.asdict(self.decode_payload(task_name, payload))
+
+
+def configure_wire_format(celery_app: Celery):
+    """
+    Makes Celery app send messages in MESSAGING_WIRE_FORMAT and accept messages in any supported format
+    """
+    celery_app.conf.task_serializer = SERIALIZER
+    celery_app.conf.accept_content = ACCEPT_CONTENT
+
+
+def build_registry(message_modules: typing.Iterable = MESSAGE_MODULES) -> CodecRegistry:
+    """
+    Registers codecs for payloads of messages and their responses:
+     module.Payload for module.TASK_NAME command,
+     module.Response (if any) for its success response
+     and SagaErrorPayload for its failure response
+    """
+    registry = CodecRegistry()
+    for module in message_modules:
+        version = getattr(module, 'SCHEMA_VERSION', 1)
+        registry.register(module.TASK_NAME, module.Payload, version)
+        if hasattr(module, 'Response'):
+            registry.register(success_task_name(module.TASK_NAME), module.Response, version)
+        registry.register(failure_task_name(module.TASK_NAME), SagaErrorPayload)
+
+    return registry
+
+
+codecs = build_registry()
+encode_payload = codecs.encode_payload
+decode_payload = codecs.decode_payload
+decode_payload_as_dict = codecs.decode_payload_as_dict
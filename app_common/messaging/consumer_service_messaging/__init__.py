@@ -1,2 +1,7 @@
+from kombu import Exchange
+
 COMMANDS_QUEUE = 'consumer_service.commands'
 
+# consumer_service events (e.g. consumer_status_changed_message) are published to this exchange,
+#  each interested service (process) consumes them from its own queue bound to it
+EVENTS_EXCHANGE = Exchange('consumer_service.events', type='fanout', durable=True)
@@ -0,0 +1,13 @@
+"""
+Event published by consumer_service (to EVENTS_EXCHANGE) when consumer status changes,
+ e.g. consumer is blocked. Body is JSON: {"event": EVENT_NAME, "payload": asdict(Payload(...))}
+"""
+import dataclasses
+
+EVENT_NAME = 'consumer_service.consumer_status_changed'
+
+
+@dataclasses.dataclass
+class Payload:
+    consumer_id: int
+    status: str
@@ -1,7 +1,6 @@
 import dataclasses
 
-import asyncapi
-from saga_framework.asyncapi_utils import asyncapi_message_for_success_response
+from .. import lazy_asyncapi_docs
 
 TASK_NAME = 'consumer_service.verify_consumer_details'
 
@@ -11,13 +10,11 @@ class Payload:
     consumer_id: int
 
 
-message = asyncapi.Message(
-    name=TASK_NAME,
+__getattr__ = lazy_asyncapi_docs(
+    __name__, TASK_NAME,
     title='Verify consumer details',
     summary='This command makes consumer service verify consumer details.'
             'If consumer is correct, it returns nothing.'
             'If validation fails, it throws an exception',
     payload=Payload,
-)
-
-success_response = asyncapi_message_for_success_response(TASK_NAME)
+    success_response=dict())
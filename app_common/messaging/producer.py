@@ -0,0 +1,239 @@
+"""
+Pool of persistent producers with batched publisher confirms.
+
+Each pooled producer keeps its own broker connection and channel, so neither is set up per message.
+When broker supports publisher confirms (RabbitMQ), producer doesn't wait for a confirm after each message
+ (as `confirm_publish` transport option does), but waits for all outstanding confirms at once:
+ when `flush_size` messages are unconfirmed or `flush_interval` seconds passed since the oldest of them was sent.
+Other transports (e.g. `memory://`) have no confirms, so messages are just published.
+Messages are kept till they're confirmed: ones rejected by broker (nacked) are republished, up to
+ `max_republishes` times, whether confirms are awaited by publisher (`flush()`) or by pool's background flusher.
+ If broker still rejects them, `flush()` raises MessageNacked; if it was the flusher, it logs them,
+ and the next `flush()` of the producer raises MessageNacked for them.
+
+Usage with Celery:
+    producer_pool = ConfirmBatchingProducerPool(celery_app, size=4, flush_size=100, flush_interval=0.05)
+
+    with producer_pool.acquire() as producer:
+        celery_app.send_task('some_task', args=[...], queue='some_queue', producer=producer)
+        producer.flush()  # optional: wait for confirms right away
+
+Metric: producer_messages_nacked_total{result} (republished, failed)
+
+Check (and throughput) against a broker: benchmarks/producer_check.py
+"""
+import contextlib
+import logging
+import queue
+import threading
+import time
+import typing
+
+from amqp.exceptions import MessageNacked
+from celery import Celery
+from kombu import Producer
+
+from .. import metrics
+
+logger = logging.getLogger(__name__)
+
+messages_nacked = metrics.Counter(
+    'producer_messages_nacked_total',
+    'Messages rejected by broker, by result (republished, failed - still rejected after all republishes)',
+    labelnames=['result'])
+
+
+class ConfirmBatchingProducer(Producer):
+    def __init__(self, channel, flush_size: int = 100, flush_interval: float = 0.05,
+                 confirm_timeout: float = 10, max_republishes: int = 3, **kwargs):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.confirm_timeout = confirm_timeout
+        self.max_republishes = max_republishes
+
+        self.lock = threading.RLock()
+        self._reset_confirms_tracking()
+        # Producer.__init__ calls revive(channel)
+        super().__init__(channel, **kwargs)
+
+    @property
+    def confirms_enabled(self) -> bool:
+        return self._confirms_enabled
+
+    @property
+    def unconfirmed_count(self) -> int:
+        return len(self._unconfirmed)
+
+    def revive(self, channel):
+        # called on creation and when connection is re-established,
+        #  so confirms have to be enabled for each new channel
+        super().revive(channel)
+
+        with self.lock:
+            self._reset_confirms_tracking()
+            channel = self.channel
+            if hasattr(channel, 'confirm_select'):  # py-amqp channel
+                channel.confirm_select()
+                channel.events['basic_ack'].add(self._on_ack)
+                channel.events['basic_nack'].add(self._on_nack)
+                self._confirms_enabled = True
+
+    def publish(self, *args, **kwargs):
+        with self.lock:
+            result = self._publish_tracked((args, kwargs, 0))
+            if self.unconfirmed_count >= self.flush_size:
+                self.flush()
+
+            return result
+
+    def flush(self):
+        """
+        Wait until all published messages are confirmed by broker, republishing rejected ones.
+        Raises MessageNacked if broker still rejected any of them after `max_republishes` republishes
+         (including ones rejected while the pool's flusher was waiting for confirms)
+        """
+        with self.lock:
+            self._wait_for_confirms()
+            if self._failed_count:
+                failed_count, self._failed_count = self._failed_count, 0
+                raise MessageNacked(f'{failed_count} messages were rejected by broker')
+
+    def flush_if_due(self):
+        """
+        Same as flush(), if the oldest unconfirmed message was published `flush_interval` ago,
+         but messages rejected after all republishes are only logged: next flush() raises MessageNacked for them
+        """
+        with self.lock:
+            if self._oldest_unconfirmed_at is not None and \
+                    time.monotonic() - self._oldest_unconfirmed_at >= self.flush_interval:
+                failed_count = self._wait_for_confirms()
+                if failed_count:
+                    logger.error('%s messages were rejected by broker after %s republishes',
+                                 failed_count, self.max_republishes)
+
+    def _wait_for_confirms(self) -> int:
+        """
+        Returns number of messages rejected by broker after all republishes
+        """
+        failed_count = 0
+        deadline = time.monotonic() + self.confirm_timeout
+        while True:
+            while self.unconfirmed_count > 0:
+                self.channel.connection.drain_events(timeout=max(deadline - time.monotonic(), 0))
+
+            nacked, self._nacked = self._nacked, []
+            for args, kwargs, republishes in nacked:
+                if republishes < self.max_republishes:
+                    messages_nacked.inc(result='republished')
+                    self._publish_tracked((args, kwargs, republishes + 1))
+                else:
+                    messages_nacked.inc(result='failed')
+                    failed_count += 1
+            if not self.unconfirmed_count:
+                break
+
+        self._oldest_unconfirmed_at = None
+        self._failed_count += failed_count
+        return failed_count
+
+    def _publish_tracked(self, message: typing.Tuple[tuple, dict, int]):
+        # message: publish() arguments and number of republishes
+        args, kwargs, _ = message
+        result = super().publish(*args, **kwargs)
+        if self._confirms_enabled:
+            if not self.unconfirmed_count:
+                self._oldest_unconfirmed_at = time.monotonic()
+            self._published_count += 1  # it equals delivery tag of just published message
+            self._unconfirmed[self._published_count] = message
+
+        return result
+
+    def _reset_confirms_tracking(self):
+        self._confirms_enabled = False
+        self._published_count = 0
+        # delivery tag -> (publish() arguments, number of republishes), in publishing order
+        self._unconfirmed = {}  # type: typing.Dict[int, typing.Tuple[tuple, dict, int]]
+        self._nacked = []  # type: typing.List[typing.Tuple[tuple, dict, int]]  # to republish
+        self._failed_count = 0  # still rejected after all republishes, not raised yet
+        self._oldest_unconfirmed_at = None
+
+    def _pop_confirmed(self, delivery_tag: int, multiple: bool) -> typing.List[typing.Tuple[tuple, dict, int]]:
+        if not multiple:
+            message = self._unconfirmed.pop(delivery_tag, None)
+            return [message] if message else []
+
+        confirmed_tags = [tag for tag in self._unconfirmed if tag <= delivery_tag]
+        return [self._unconfirmed.pop(tag) for tag in confirmed_tags]
+
+    def _on_ack(self, delivery_tag: int, multiple: bool):
+        self._pop_confirmed(delivery_tag, multiple)
+
+    def _on_nack(self, delivery_tag: int, multiple: bool):
+        self._nacked.extend(self._pop_confirmed(delivery_tag, multiple))
+
+
+class ConfirmBatchingProducerPool:
+    def __init__(self, celery_app: Celery, size: int = 4,
+                 flush_size: int = 100, flush_interval: float = 0.05):
+        self.celery_app = celery_app
+        self.size = size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+
+        self._producers = []  # all created producers
+        self._idle_producers = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._flusher = None  # type: threading.Thread
+        self._closed = threading.Event()
+
+    @contextlib.contextmanager
+    def acquire(self) -> typing.Iterator[ConfirmBatchingProducer]:
+        producer = self._take_producer()
+        try:
+            yield producer
+        finally:
+            self._idle_producers.put(producer)
+
+    def flush(self):
+        for producer in list(self._producers):
+            producer.flush()
+
+    def close(self):
+        self._closed.set()
+        for producer in list(self._producers):
+            with producer.lock:
+                producer.flush()
+                producer.connection.release()
+
+    def _take_producer(self) -> ConfirmBatchingProducer:
+        try:
+            return self._idle_producers.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if len(self._producers) < self.size:
+                producer = ConfirmBatchingProducer(
+                    self.celery_app.connection_for_write(),
+                    flush_size=self.flush_size,
+                    flush_interval=self.flush_interval)
+                self._producers.append(producer)
+                self._start_flusher()
+                return producer
+
+        return self._idle_producers.get()
+
+    def _start_flusher(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_periodically,
+                                             name='producer-pool-flusher', daemon=True)
+            self._flusher.start()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval):
+            for producer in list(self._producers):
+                try:
+                    producer.flush_if_due()
+                except Exception:
+                    logger.exception('Failed to wait for publisher confirms')
+
@@ -1,7 +1,6 @@
 import dataclasses
 
-import asyncapi
-from saga_framework.asyncapi_utils import asyncapi_message_for_success_response
+from .. import lazy_asyncapi_docs
 
 TASK_NAME = 'restaurant_service.approve_ticket'
 
@@ -11,12 +10,10 @@ class Payload:
     ticket_id: int
 
 
-message = asyncapi.Message(
-    name=TASK_NAME,
+__getattr__ = lazy_asyncapi_docs(
+    __name__, TASK_NAME,
     title='Approve restaurant ticket',
     summary='This command approves previously created restaurant ticket. \n'
             'Returns no response',
     payload=Payload,
-)
-
-success_response = asyncapi_message_for_success_response(TASK_NAME)
+    success_response=dict())
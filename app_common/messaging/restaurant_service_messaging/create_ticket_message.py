@@ -1,8 +1,7 @@
 import dataclasses
 from typing import List
 
-import asyncapi
-from saga_framework.asyncapi_utils import asyncapi_message_for_success_response
+from .. import lazy_asyncapi_docs
 
 TASK_NAME = 'restaurant_service.create_ticket'
 
@@ -25,17 +24,11 @@ class Response:
     ticket_id: int
 
 
-message = asyncapi.Message(
-    name=TASK_NAME,
+__getattr__ = lazy_asyncapi_docs(
+    __name__, TASK_NAME,
     title='Create restaurant ticket',
     summary='This command creates ticket so restaurant knows order details. \n'
             'In real world, ticket may be created automatically or after restaurant manager approves it '
             '(confirm that they will be able to cook desired dishes)',
     payload=Payload,
-)
-
-success_response = asyncapi_message_for_success_response(
-    TASK_NAME,
-    title='Ticket ID is returned',
-    payload_dataclass=Response
-)
+    success_response=dict(title='Ticket ID is returned', payload_dataclass=Response))
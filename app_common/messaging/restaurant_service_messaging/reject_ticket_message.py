@@ -1,6 +1,6 @@
 import dataclasses
 
-import asyncapi
+from .. import lazy_asyncapi_docs
 
 TASK_NAME = 'restaurant_service.reject_ticket'
 
@@ -10,11 +10,9 @@ class Payload:
     ticket_id: int
 
 
-message = asyncapi.Message(
-    name=TASK_NAME,
+__getattr__ = lazy_asyncapi_docs(
+    __name__, TASK_NAME,
     title='Reject restaurant ticket',
     summary='This compensation command rejects already created restaurant ticket. \n'
             'Returns no response',
-    payload=Payload,
-)
-
+    payload=Payload)
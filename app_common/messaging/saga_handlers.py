@@ -0,0 +1,57 @@
+"""
+Same as `saga_step_handler` from saga_framework,
+ but response queue can be chosen per saga, e.g. to send responses to saga's partition:
+
+    @command_handlers_celery_app.task(bind=True, name=verify_consumer_details_message.TASK_NAME)
+    @saga_step_handler(response_queue=create_order_saga_response_queue)
+    def verify_consumer_details_task(self: Task, saga_id: int, payload: dict) -> typing.Union[dict, None]:
+        ...
+"""
+import functools
+import logging
+import typing
+from dataclasses import asdict
+
+import celery
+from celery import Task
+from saga_framework import send_saga_response, success_task_name, failure_task_name, serialize_saga_error
+
+from .codec import encode_payload
+
+logger = logging.getLogger(__name__)
+
+ResponseQueue = typing.Union[str, typing.Callable[[int], str]]
+
+
+def get_response_queue(response_queue: ResponseQueue, saga_id: int) -> str:
+    return response_queue(saga_id) if callable(response_queue) else response_queue
+
+
+def saga_step_handler(response_queue: ResponseQueue):
+    """
+    Apply this decorator between @task(bind=True) and actual task handler.
+    `response_queue` is a queue name or a function that returns queue name by saga id
+    """
+    def inner(func):
+        @functools.wraps(func)
+        def wrapper(celery_task: Task, saga_id: int, payload: dict):
+            try:
+                response_payload = func(celery_task, saga_id, payload)  # type: typing.Union[dict, None]
+                task_name = success_task_name(celery_task.name)
+            except BaseException as exc:
+                # let Celery handle retries
+                if isinstance(exc, celery.exceptions.Retry):
+                    raise
+
+                logger.exception(exc)
+                response_payload = asdict(serialize_saga_error(exc))
+                task_name = failure_task_name(celery_task.name)
+
+            send_saga_response(celery_task.app,
+                               task_name,
+                               get_response_queue(response_queue, saga_id),
+                               saga_id,
+                               encode_payload(task_name, response_payload))
+        return wrapper
+
+    return inner
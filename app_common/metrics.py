@@ -0,0 +1,211 @@
+"""
+Minimal in-process metrics which are rendered in Prometheus text format.
+
+Usage:
+    sagas_started = Counter('sagas_started_total', 'Number of started sagas', labelnames=['saga'])
+    sagas_started.inc(saga='create_order')
+
+    queue_depth = Gauge('queue_depth', 'Number of queued items')
+    queue_depth.set_function(lambda: queue.qsize())
+
+    step_duration = Histogram('step_duration_seconds', 'Step duration', labelnames=['step'])
+    step_duration.observe(0.25, step='authorize_card')
+
+    render_prometheus()  # text to return from /metrics endpoint
+
+Processes without a web server (e.g. Celery workers) can serve metrics with
+    start_http_server(9100)  # GET http://127.0.0.1:9100/metrics
+"""
+import threading
+import typing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: 'BaseMetric'):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class BaseMetric:
+    type: str = None
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: typing.Sequence[str] = (),
+                 registry: Registry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values tuple -> value
+        self._lock = threading.Lock()
+
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> typing.List[typing.Tuple[str, dict, float]]:
+        with self._lock:
+            values = dict(self._values)
+
+        return [(self.name, dict(zip(self.labelnames, key)), value)
+                for key, value in sorted(values.items())]
+
+
+class Counter(BaseMetric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(BaseMetric):
+    type = 'gauge'
+    _function = None
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        if self._function:
+            return self._function()
+
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def set_function(self, function: typing.Callable[[], float]):
+        """
+        Value will be computed by calling function on each render (only for gauges without labels)
+        """
+        self._function = function
+
+    def samples(self):
+        if self._function:
+            return [(self.name, {}, self._function())]
+
+        return super().samples()
+
+
+class Histogram(BaseMetric):
+    type = 'histogram'
+    DEFAULT_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, 10.0, 30.0, 60.0)
+
+    def __init__(self, *args, buckets: typing.Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # label values tuple -> [count per bucket (not cumulative)..., sum]
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.setdefault(key, [0] * len(self.buckets) + [0.0])
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+
+        samples = []
+        for key, counts in sorted(values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative_count = 0
+            for upper_bound, count in zip(self.buckets, counts):
+                cumulative_count += count
+                samples.append((f'{self.name}_bucket', {**labels, 'le': _format_value(upper_bound)},
+                                cumulative_count))
+            samples.append((f'{self.name}_sum', labels, counts[-1]))
+            samples.append((f'{self.name}_count', labels, cumulative_count))
+
+        return samples
+
+
+def render_prometheus(registry: Registry = REGISTRY) -> str:
+    return registry.render()
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+
+def start_http_server(port: int, host: str = '0.0.0.0', registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """
+    Serves metrics on http://<host>:<port>/metrics from a daemon thread
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # don't log each scrape
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-http-server', daemon=True).start()
+    return server
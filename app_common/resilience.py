@@ -0,0 +1,250 @@
+"""
+Retry policy and circuit breakers shared by step handlers and orchestrator.
+
+ * RetryPolicy: exponential backoff with full jitter, so retries of many sagas failed at the same time
+   are spread over time instead of hitting a degraded service in lockstep
+ * CircuitBreaker: one per downstream service (see `circuit_breakers`).
+   After CIRCUIT_BREAKER_FAILURE_THRESHOLD failures in a row it opens, and calls to the service fail fast
+   with CircuitOpenError (so saga is compensated) for CIRCUIT_BREAKER_RESET_TIMEOUT_SECONDS.
+   Then one trial call is let through (half-open): its success closes the circuit, its failure opens it again.
+   If trial result isn't recorded in CIRCUIT_BREAKER_RESET_TIMEOUT_SECONDS (e.g. orchestrator sent a command
+   from one process, and its response was handled by another), another trial call is let through.
+   Breaker state is kept in process memory, so each worker process has its own breakers.
+ * retry_with_backoff: retries Celery task, recording one outcome per task (not per attempt) to its breaker.
+   Errors that don't mean the service is unavailable can be left out of breaker counting
+
+Step handlers:
+    @command_handlers_celery_app.task(bind=True, name=approve_ticket_message.TASK_NAME)
+    @saga_step_handler(response_queue=create_order_saga_response_queue)
+    @retry_with_backoff(RetryPolicy(max_retries=2), circuit_breakers.get('ticket_store'))
+    def approve_ticket_task(self: Task, saga_id: int, payload: dict) -> typing.Union[dict, None]:
+        ...
+
+Metrics: step_retries_total, circuit_breaker_state (0 - closed, 1 - half-open, 2 - open)
+ and circuit_breaker_rejected_calls_total
+"""
+import functools
+import logging
+import random
+import threading
+import time
+import typing
+from dataclasses import dataclass
+
+from celery import Task
+from celery.exceptions import MaxRetriesExceededError
+
+from . import metrics, settings
+
+logger = logging.getLogger(__name__)
+
+# failures that show a service is unavailable or degraded (as opposed to business errors,
+#  like declined card), by error type name as it's sent in failure responses (SagaErrorPayload.type).
+#  CircuitOpenError isn't one: calls rejected by a breaker don't reach the service, so they aren't failures of it
+TRANSIENT_ERROR_TYPES = {'OSError', 'ConnectionError', 'TimeoutError', 'SagaStepTimeout'}
+
+step_retries = metrics.Counter(
+    'step_retries_total', 'Number of step retries (handler retries and command re-sends)',
+    labelnames=['service', 'task'])
+circuit_breaker_state = metrics.Gauge(
+    'circuit_breaker_state', 'Circuit breaker state: 0 - closed, 1 - half-open, 2 - open',
+    labelnames=['service'])
+circuit_breaker_rejected_calls = metrics.Counter(
+    'circuit_breaker_rejected_calls_total', 'Number of calls failed fast by open circuit breaker',
+    labelnames=['service'])
+
+
+def is_transient_error(error_type: str) -> bool:
+    return error_type in TRANSIENT_ERROR_TYPES
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    max_retries: int = 3
+    # delay before the first retry, seconds. It's multiplied by `multiplier` on each next retry
+    base_delay: float = 1.0
+    max_delay: float = 30.0
+    multiplier: float = 2.0
+
+    def delay(self, retry_number: int) -> float:
+        """
+        Delay before retry #retry_number (starting from 0): random value between 0 and exponential backoff
+        """
+        backoff = min(self.max_delay, self.base_delay * self.multiplier ** retry_number)
+        return random.uniform(0, backoff)
+
+
+NO_RETRIES = RetryPolicy(max_retries=0)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreakerStates:
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+    NAMES = {CLOSED: 'closed', HALF_OPEN: 'half-open', OPEN: 'open'}
+
+
+class CircuitBreaker:
+    def __init__(self, service: str,
+                 failure_threshold: int = settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = settings.CIRCUIT_BREAKER_RESET_TIMEOUT_SECONDS):
+        self.service = service
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._state = CircuitBreakerStates.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_call_started_at = None  # type: typing.Optional[float]
+        self._lock = threading.Lock()
+        circuit_breaker_state.set(self._state, service=service)
+
+    @property
+    def state(self) -> int:
+        with self._lock:
+            if self._state == CircuitBreakerStates.OPEN and self._reset_timeout_passed():
+                return CircuitBreakerStates.HALF_OPEN
+
+            return self._state
+
+    def _reset_timeout_passed(self) -> bool:
+        return time.monotonic() - self._opened_at >= self.reset_timeout
+
+    def _set_state(self, state: int):
+        if state != self._state:
+            logger.warning('Circuit breaker of %s: %s -> %s', self.service,
+                           CircuitBreakerStates.NAMES[self._state], CircuitBreakerStates.NAMES[state])
+        self._state = state
+        circuit_breaker_state.set(state, service=self.service)
+
+    def allow_call(self) -> bool:
+        with self._lock:
+            if self._state == CircuitBreakerStates.CLOSED:
+                return True
+
+            if self._state == CircuitBreakerStates.OPEN and self._reset_timeout_passed():
+                self._set_state(CircuitBreakerStates.HALF_OPEN)
+
+            # only one trial call at a time, others fail fast till its result is known
+            #  (or till reset timeout passes, in case it's never recorded in this process)
+            if self._state == CircuitBreakerStates.HALF_OPEN and not self._trial_call_running():
+                self._trial_call_started_at = time.monotonic()
+                return True
+
+        circuit_breaker_rejected_calls.inc(service=self.service)
+        return False
+
+    def _trial_call_running(self) -> bool:
+        return self._trial_call_started_at is not None \
+            and time.monotonic() - self._trial_call_started_at < self.reset_timeout
+
+    def check(self):
+        """
+        Raises CircuitOpenError if call to the service isn't allowed now
+        """
+        if not self.allow_call():
+            raise CircuitOpenError(f'Circuit breaker of {self.service} is open')
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial_call_started_at = None
+            self._set_state(CircuitBreakerStates.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_call_started_at = None
+            if self._state == CircuitBreakerStates.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._set_state(CircuitBreakerStates.OPEN)
+
+    def release_trial_call(self):
+        """
+        Lets another trial call through: the one running has ended without a result that tells
+         whether the service is available
+        """
+        with self._lock:
+            self._trial_call_started_at = None
+
+
+class CircuitBreakers:
+    """
+    Circuit breakers by service name, created on first use
+    """
+    def __init__(self):
+        self._breakers = {}  # type: typing.Dict[str, CircuitBreaker]
+        self._lock = threading.Lock()
+
+    def get(self, service: str) -> CircuitBreaker:
+        with self._lock:
+            if service not in self._breakers:
+                self._breakers[service] = CircuitBreaker(service)
+
+            return self._breakers[service]
+
+
+circuit_breakers = CircuitBreakers()
+
+
+def retry_with_backoff(retry_policy: RetryPolicy, circuit_breaker: typing.Optional[CircuitBreaker] = None,
+                       uncounted_errors: typing.Tuple[typing.Type[Exception], ...] = (),
+                       business_errors: typing.Tuple[typing.Type[Exception], ...] = ()):
+    """
+    Retries Celery task by `retry_policy`, then re-raises initially risen error.
+    With `circuit_breaker`, task fails fast with CircuitOpenError (without retries) while the circuit is open,
+     and task outcome is recorded to the breaker once: success, or failure when retries are exhausted
+     (attempts that are retried aren't counted, unless it's a trial call of half-open breaker).
+    `uncounted_errors` are retried, but not recorded to the breaker, as they don't mean the service is unavailable.
+    `business_errors` (e.g. ticket that can't be approved) are re-raised at once, neither retried nor recorded.
+
+    Replaces `auto_retry_then_reraise` from saga_framework, which retries with a fixed delay.
+    Apply it after Celery's @task(bind=True) decorator (and after @saga_step_handler)
+    """
+    def inner(func):
+        @functools.wraps(func)
+        def wrapper(self: Task, *args, **kwargs):
+            if circuit_breaker:
+                circuit_breaker.check()
+
+            try:
+                result = func(self, *args, **kwargs)
+            except business_errors:
+                if circuit_breaker:
+                    circuit_breaker.release_trial_call()
+                raise
+            except Exception as exc:
+                counted = circuit_breaker is not None and not isinstance(exc, uncounted_errors)
+                if circuit_breaker and not counted:
+                    # retry (or another task) may be the trial call then
+                    circuit_breaker.release_trial_call()
+
+                retry_number = self.request.retries
+                # failed trial call opens the circuit again, so retry would fail fast anyway
+                trial_call_failed = counted and circuit_breaker.state != CircuitBreakerStates.CLOSED
+                if retry_number >= retry_policy.max_retries or trial_call_failed:
+                    if counted:
+                        circuit_breaker.record_failure()
+                    raise
+
+                service = circuit_breaker.service if circuit_breaker else ''
+                step_retries.inc(service=service, task=self.name)
+                try:
+                    raise self.retry(exc=exc, countdown=retry_policy.delay(retry_number),
+                                     max_retries=retry_policy.max_retries)
+                except MaxRetriesExceededError:
+                    if counted:
+                        circuit_breaker.record_failure()
+                    raise exc
+
+            if circuit_breaker:
+                circuit_breaker.record_success()
+            return result
+
+        return wrapper
+    return inner
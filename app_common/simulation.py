@@ -0,0 +1,276 @@
+"""
+Simulation mode of step handler services: with SIMULATION_PROFILE set, step handlers take time and fail
+ as a profile says, so orchestrator can be loaded like in production without real downstream systems.
+
+Profile is a JSON file (SIMULATION_PROFILE is its path, or name of a profile in simulation_profiles folder):
+    {
+      "seed": 1,  // optional, makes random choices repeatable (in a worker without prefork children)
+      "tasks": {  // by task (command) name, tasks not listed are not simulated
+        "consumer_service.verify_consumer_details": {
+          "latency_ms": {"distribution": "lognormal", "median": 40, "p99": 400},
+          "failure_rate": 0.02,  // business failure (ValueError), saga is compensated
+          "transient_failure_rate": 0.01,  // OSError: retried by handlers that retry, counted by circuit breakers
+          "timeout_rate": 0.005,  // handler hangs for timeout_ms, then fails with TimeoutError
+          "timeout_ms": 30000
+        }
+      },
+      "workers": {  // Celery worker settings by service, used unless set on command line
+        "consumer_service": {"concurrency": 8, "pool": "threads"}
+      }
+    }
+Latency distributions (milliseconds, all but "fixed" can be capped with "max"):
+ * {"distribution": "fixed", "value": 20}
+ * {"distribution": "uniform", "min": 10, "max": 50}
+ * {"distribution": "exponential", "mean": 30}
+ * {"distribution": "lognormal", "median": 40, "p99": 400}
+Simulated latency is a sleep, so use "threads" pool (or high prefork concurrency)
+ to have many commands in progress at once, as with a slow downstream system.
+
+Simulated failures happen before the handler runs, otherwise the handler runs as usual
+ (so orders that fail by their data, e.g. consumer id < 50, still fail).
+
+Usage:
+    @simulated(verify_consumer_details_message.TASK_NAME)
+    def verify_consumer_details(saga_id: int, payload: dict) -> typing.Union[dict, None]:
+        ...
+
+    # bulk handlers (batch mode): each command of a batch is simulated, failed ones are left out
+    errors = simulate_each(approve_ticket_message.TASK_NAME, len(commands))  # -> [None, OSError(...), ...]
+
+    configure_simulated_worker(command_handlers_celery_app, 'consumer_service')
+
+Metric: simulated_outcomes_total{task, outcome} (outcome: success, failure, transient_failure, timeout)
+"""
+import functools
+import json
+import logging
+import math
+import os
+import random
+import time
+import typing
+from dataclasses import dataclass, field
+
+from celery import Celery
+
+from . import metrics, settings
+
+logger = logging.getLogger(__name__)
+
+PROFILES_DIR = os.path.join(os.path.dirname(__file__), 'simulation_profiles')
+# z-score of 99th percentile of standard normal distribution
+_P99_Z = 2.3263
+
+simulated_outcomes = metrics.Counter(
+    'simulated_outcomes_total', 'Outcomes of simulated step handler calls (see simulation.py)',
+    labelnames=['task', 'outcome'])
+
+
+class SimulationProfileError(ValueError):
+    pass
+
+
+class SimulatedFailure(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class LatencyDistribution:
+    distribution: str = 'fixed'
+    value: float = 0
+    min: float = 0
+    max: float = math.inf
+    mean: float = 0
+    median: float = 0
+    p99: float = 0
+
+    DISTRIBUTIONS = ('fixed', 'uniform', 'exponential', 'lognormal')
+
+    def __post_init__(self):
+        if self.distribution not in self.DISTRIBUTIONS:
+            raise SimulationProfileError(f'Unknown latency distribution {self.distribution!r}, '
+                                         f'expected one of {self.DISTRIBUTIONS}')
+        if self.distribution == 'uniform' and not 0 <= self.min <= self.max < math.inf:
+            raise SimulationProfileError('Uniform latency distribution needs 0 <= min <= max')
+        if self.distribution == 'lognormal' and not 0 < self.median <= self.p99:
+            raise SimulationProfileError('Lognormal latency distribution needs 0 < median <= p99')
+
+    def sample_ms(self, rng: random.Random) -> float:
+        if self.distribution == 'fixed':
+            return self.value
+        if self.distribution == 'uniform':
+            return rng.uniform(self.min, self.max)
+        if self.distribution == 'exponential':
+            latency = rng.expovariate(1 / self.mean) if self.mean > 0 else 0
+        else:  # lognormal, by median and 99th percentile
+            mu = math.log(self.median)
+            latency = rng.lognormvariate(mu, (math.log(self.p99) - mu) / _P99_Z)
+
+        return min(latency, self.max)
+
+
+@dataclass(frozen=True)
+class TaskProfile:
+    latency_ms: LatencyDistribution = field(default_factory=LatencyDistribution)
+    failure_rate: float = 0
+    transient_failure_rate: float = 0
+    timeout_rate: float = 0
+    timeout_ms: float = 30000
+
+    def __post_init__(self):
+        rates = [self.failure_rate, self.transient_failure_rate, self.timeout_rate]
+        if any(rate < 0 for rate in rates) or sum(rates) > 1:
+            raise SimulationProfileError('Failure, transient failure and timeout rates should be non-negative '
+                                         'and add up to at most 1')
+
+
+@dataclass(frozen=True)
+class SimulationProfile:
+    tasks: typing.Dict[str, TaskProfile] = field(default_factory=dict)
+    # Celery worker settings by service name
+    workers: typing.Dict[str, dict] = field(default_factory=dict)
+    seed: typing.Optional[int] = None
+
+    WORKER_SETTINGS = {'concurrency': 'worker_concurrency', 'pool': 'worker_pool',
+                       'prefetch_multiplier': 'worker_prefetch_multiplier'}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'SimulationProfile':
+        tasks = {}
+        for task_name, task_data in data.get('tasks', {}).items():
+            try:
+                latency = LatencyDistribution(**task_data.get('latency_ms', {}))
+                tasks[task_name] = TaskProfile(**dict(task_data, latency_ms=latency))
+            except (TypeError, SimulationProfileError) as exc:  # TypeError - unknown keys
+                raise SimulationProfileError(f'Incorrect profile of {task_name}: {exc}') from exc
+
+        workers = data.get('workers', {})
+        for service, worker_settings in workers.items():
+            unknown = set(worker_settings) - set(cls.WORKER_SETTINGS)
+            if unknown:
+                raise SimulationProfileError(f'Unknown worker settings of {service}: {sorted(unknown)}, '
+                                             f'expected some of {sorted(cls.WORKER_SETTINGS)}')
+
+        return cls(tasks=tasks, workers=workers, seed=data.get('seed'))
+
+    @classmethod
+    def load(cls, path_or_name: str) -> 'SimulationProfile':
+        path = path_or_name
+        if not os.path.exists(path) and os.sep not in path_or_name:
+            path = os.path.join(PROFILES_DIR, f'{path_or_name}.json')
+
+        try:
+            with open(path) as profile_file:
+                return cls.from_dict(json.load(profile_file))
+        except (OSError, json.JSONDecodeError) as exc:
+            raise SimulationProfileError(f'Failed to read simulation profile {path_or_name!r}: {exc}') from exc
+
+
+class Simulator:
+    def __init__(self, profile: typing.Optional[SimulationProfile]):
+        self.profile = profile
+        self.sleep = time.sleep
+        self._rng = None  # type: typing.Optional[random.Random]
+        self._rng_pid = None  # type: typing.Optional[int]
+        self._main_pid = os.getpid()
+
+    @property
+    def rng(self) -> random.Random:
+        # prefork pool children would otherwise make the same random choices as each other
+        if self._rng_pid != os.getpid():
+            seed = self.profile.seed if self.profile else None
+            if seed is not None and os.getpid() != self._main_pid:
+                seed = f'{seed}-{os.getpid()}'
+            self._rng = random.Random(seed)
+            self._rng_pid = os.getpid()
+        return self._rng
+
+    @property
+    def enabled(self) -> bool:
+        return self.profile is not None
+
+    def simulate(self, task_name: str):
+        """
+        Waits for simulated latency, then raises simulated failure or returns
+        """
+        task_profile = self.profile.tasks[task_name]
+        rng = self.rng
+        outcome = rng.random()
+
+        if outcome < task_profile.timeout_rate:
+            simulated_outcomes.inc(task=task_name, outcome='timeout')
+            self.sleep(task_profile.timeout_ms / 1000)
+            raise TimeoutError(f'Simulated timeout of {task_name} after {task_profile.timeout_ms} ms')
+
+        self.sleep(task_profile.latency_ms.sample_ms(rng) / 1000)
+        outcome -= task_profile.timeout_rate
+        if outcome < task_profile.failure_rate:
+            simulated_outcomes.inc(task=task_name, outcome='failure')
+            raise SimulatedFailure(f'Simulated failure of {task_name}')
+
+        outcome -= task_profile.failure_rate
+        if outcome < task_profile.transient_failure_rate:
+            simulated_outcomes.inc(task=task_name, outcome='transient_failure')
+            raise OSError(f'Simulated transient failure of {task_name}')
+
+        simulated_outcomes.inc(task=task_name, outcome='success')
+
+
+def _load_simulator() -> Simulator:
+    if not settings.SIMULATION_PROFILE:
+        return Simulator(None)
+
+    profile = SimulationProfile.load(settings.SIMULATION_PROFILE)
+    logger.warning('Simulation mode: step handlers follow %s profile', settings.SIMULATION_PROFILE)
+    return Simulator(profile)
+
+
+simulator = _load_simulator()
+
+
+def simulated(task_name: str):
+    """
+    Runs simulation of `task_name` before the handler (with any arguments), if profile has this task.
+    Without simulation, handler is returned as is
+    """
+    def inner(func):
+        if not simulator.enabled or task_name not in simulator.profile.tasks:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            simulator.simulate(task_name)
+            return func(*args, **kwargs)
+
+        return wrapper
+    return inner
+
+
+def simulate_each(task_name: str, count: int) -> typing.List[typing.Optional[Exception]]:
+    """
+    Runs simulation of `task_name` for each of `count` commands handled in bulk.
+    Returns simulated failure of each command (None - it isn't failed); all None without simulation
+    """
+    if not simulator.enabled or task_name not in simulator.profile.tasks:
+        return [None] * count
+
+    errors = []
+    for _ in range(count):
+        try:
+            simulator.simulate(task_name)
+        except (SimulatedFailure, OSError) as exc:  # TimeoutError is OSError as well
+            errors.append(exc)
+        else:
+            errors.append(None)
+    return errors
+
+
+def configure_simulated_worker(celery_app: Celery, service: str):
+    """
+    Applies profile worker settings of `service` to Celery app (command line options still take precedence)
+    """
+    if not simulator.enabled:
+        return
+
+    for name, value in simulator.profile.workers.get(service, {}).items():
+        celery_app.conf[SimulationProfile.WORKER_SETTINGS[name]] = value
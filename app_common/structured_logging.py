@@ -0,0 +1,266 @@
+"""
+Logging setup for services: records are written to stderr by a background thread,
+ so code that logs (e.g. saga steps and step handlers) only puts a record into an in-memory queue.
+
+ * lazy formatting: message is formatted (`msg % args`) in the background thread,
+   so log with `logger.info('Ticket %s created', ticket_id)`, not with f-strings
+ * structured records: saga id and step name are attached to records (see `saga_logger`)
+   and written as `saga_id=... step=...` suffix or, with LOG_FORMAT=json, as JSON fields
+ * sampling: LOG_SAMPLE_RATES like 'saga_framework=0.1,order_service.create_order_saga=0.1'
+   keeps only given share of DEBUG/INFO records of these loggers (and their children).
+   Records of one saga are kept or dropped together. Warnings and errors are always kept
+
+Usage:
+    setup_logging()  # instead of logging.basicConfig(...)
+    setup_celery_logging()  # in Celery worker modules, so Celery doesn't replace it
+
+    log = saga_logger(logging.getLogger(__name__), saga_id, step='create_restaurant_ticket')
+    log.info('Ticket %s created', ticket_id)
+
+Note: records are formatted after logging call returns, so don't pass objects that change right after logging.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import typing
+import zlib
+from logging.handlers import QueueHandler, QueueListener
+
+from . import settings
+
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+# record attributes which are written as structured fields
+CONTEXT_FIELDS = ('saga_id', 'step')
+
+
+def parse_sample_rates(sample_rates: str) -> typing.Dict[str, float]:
+    """
+    'saga_framework=0.1,celery.app.trace=0.01' -> {'saga_framework': 0.1, 'celery.app.trace': 0.01}
+    """
+    rates = {}
+    for part in sample_rates.split(','):
+        if part.strip():
+            logger_name, _, rate = part.partition('=')
+            rates[logger_name.strip()] = float(rate)
+
+    return rates
+
+
+class SagaLoggerAdapter(logging.LoggerAdapter):
+    """
+    Adds saga context to records. Unlike LoggerAdapter, keeps `extra` passed to logging calls.
+    Records of sagas that aren't sampled are dropped before they are created
+    """
+    def process(self, msg, kwargs):
+        kwargs['extra'] = {**self.extra, **kwargs['extra']} if 'extra' in kwargs else self.extra
+        return msg, kwargs
+
+    def log(self, level, msg, *args, **kwargs):
+        if self.isEnabledFor(level):
+            msg, kwargs = self.process(msg, kwargs)
+            # logger.log() would check level again
+            self.logger._log(level, msg, args, **kwargs)
+
+    def isEnabledFor(self, level: int) -> bool:
+        if not self.logger.isEnabledFor(level):
+            return False
+
+        return _sampling_filter is None or _sampling_filter.keeps(self.logger.name, level, self.extra['saga_id'])
+
+
+def saga_logger(logger: logging.Logger, saga_id: int, step: str = None) -> SagaLoggerAdapter:
+    extra = {'saga_id': saga_id}
+    if step is not None:
+        extra['step'] = step
+
+    return SagaLoggerAdapter(logger, extra)
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates: typing.Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._rate_by_logger_name = {}  # type: typing.Dict[str, float]
+
+    def _rate(self, logger_name: str) -> float:
+        rate = self._rate_by_logger_name.get(logger_name)
+        if rate is None:
+            # rate of the logger itself or of its closest parent
+            name = logger_name
+            while name not in self.rates and '.' in name:
+                name = name.rpartition('.')[0]
+            rate = self._rate_by_logger_name[logger_name] = self.rates.get(name, 1.0)
+
+        return rate
+
+    def keeps(self, logger_name: str, level: int, saga_id: typing.Optional[int] = None) -> bool:
+        if level >= logging.WARNING or not self.rates:
+            return True
+
+        rate = self._rate(logger_name)
+        if rate >= 1:
+            return True
+
+        if saga_id is not None:
+            # the same decision for all records of a saga, so sampled sagas are logged fully
+            return zlib.crc32(str(saga_id).encode()) % 10000 < rate * 10000
+
+        return random.random() < rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return self.keeps(record.name, record.levelno, getattr(record, 'saga_id', None))
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        context = ' '.join(f'{field}={getattr(record, field)}'
+                           for field in CONTEXT_FIELDS if hasattr(record, field))
+        return f'{text} [{context}]' if context else text
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            if hasattr(record, field):
+                data[field] = getattr(record, field)
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(data, default=str)
+
+
+class LazyQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # QueueHandler formats record here, to make it picklable for multiprocessing queues.
+        # Queue is in-process, so record is formatted later, by listener's handler
+        return record
+
+
+class BatchingStreamHandler(logging.StreamHandler):
+    """
+    Stream handler that writes records on flush, all at once
+    """
+    def __init__(self, stream: typing.TextIO = None):
+        super().__init__(stream)
+        self._pending = []  # type: typing.List[str]
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self._pending.append(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        with self.lock:
+            if self._pending:
+                self.stream.write(''.join(self._pending))
+                self._pending = []
+            super().flush()
+
+
+class BatchingQueueListener(QueueListener):
+    """
+    Writes records one batch at a time: handlers are flushed when there are no more queued records
+    """
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        try:
+            return self.queue.get(block=False)
+        except queue.Empty:
+            if not block:
+                raise
+
+        for handler in self.handlers:
+            handler.flush()
+
+        return self.queue.get()
+
+    def stop(self):
+        if self._thread is None:  # already stopped
+            return
+
+        super().stop()
+        for handler in self.handlers:
+            handler.flush()
+
+
+_listener = None  # type: typing.Optional[QueueListener]
+# used by SagaLoggerAdapter to drop records before they are created
+_sampling_filter = None  # type: typing.Optional[SamplingFilter]
+
+
+def setup_logging(level: typing.Union[str, int] = None,
+                  sample_rates: typing.Dict[str, float] = None,
+                  log_format: str = None,
+                  stream: typing.TextIO = None) -> QueueListener:
+    """
+    Replaces root logger handlers with a queue handler. Records are written to `stream` (stderr by default)
+     by a background thread. Can be called again to reconfigure logging
+    """
+    global _listener, _sampling_filter
+
+    if sample_rates is None:
+        sample_rates = parse_sample_rates(settings.LOG_SAMPLE_RATES)
+    formatter_class = JsonFormatter if (log_format or settings.LOG_FORMAT) == 'json' else TextFormatter
+
+    target_handler = BatchingStreamHandler(stream or sys.stderr)
+    target_handler.setFormatter(formatter_class(TEXT_FORMAT))
+
+    records = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(records)
+    _sampling_filter = SamplingFilter(sample_rates)
+    queue_handler.addFilter(_sampling_filter)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level or settings.LOG_LEVEL)
+
+    if _listener is not None:
+        _listener.stop()  # writes records queued so far
+    _listener = BatchingQueueListener(records, target_handler)
+    _listener.start()
+
+    return _listener
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+def _restart_listener_in_child_process():
+    # listener thread isn't copied to processes forked after setup (e.g. Celery prefork pool workers)
+    global _listener
+
+    if _listener is not None:
+        _listener = BatchingQueueListener(_listener.queue, *_listener.handlers)
+        _listener.start()
+
+
+atexit.register(_stop_listener)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_listener_in_child_process)
+
+
+def setup_celery_logging():
+    """
+    Celery worker configures logging on start, replacing root handlers.
+    This makes it use `setup_logging` instead (with log level from --loglevel option)
+    """
+    from celery.signals import setup_logging as celery_setup_logging
+
+    @celery_setup_logging.connect(weak=False)
+    def on_celery_setup_logging(loglevel=None, **kwargs):
+        setup_logging(level=loglevel)
@@ -0,0 +1,125 @@
+"""
+Compares message size and encode/decode time of the JSON wire format (payload sent as `asdict(...)` JSON)
+ and the binary one (see app_common/messaging/codec.py) for each registered message.
+
+Both payload alone and whole Celery message body ([args, kwargs, embed], as published) are measured.
+
+Usage (from repo root):
+    python benchmarks/codec_benchmark.py --items 3 --number 20000 --output benchmarks/results/codec.json
+"""
+import argparse
+import dataclasses
+import json
+import os
+import sys
+import timeit
+
+from kombu.serialization import dumps, loads, prepare_accept_content
+
+from local_runtime import _make_services_importable
+
+_make_services_importable()
+
+from order_service.app_common.messaging import codec  # noqa: E402
+from order_service.app_common.messaging.accounting_service_messaging import authorize_card_message  # noqa: E402
+from order_service.app_common.messaging.consumer_service_messaging import \
+    verify_consumer_details_message  # noqa: E402
+from order_service.app_common.messaging.restaurant_service_messaging import \
+    create_ticket_message, approve_ticket_message  # noqa: E402
+from saga_framework import success_task_name, failure_task_name, SagaErrorPayload  # noqa: E402
+
+
+def sample_messages(items_count: int) -> dict:
+    """
+    task name -> sample payload
+    """
+    return {
+        verify_consumer_details_message.TASK_NAME: verify_consumer_details_message.Payload(consumer_id=75),
+        create_ticket_message.TASK_NAME: create_ticket_message.Payload(
+            order_id=123456,
+            customer_id=75,
+            items=[create_ticket_message.OrderItem(name=f'Pizza Margherita #{i}', quantity=i % 5 + 1)
+                   for i in range(items_count)],
+        ),
+        success_task_name(create_ticket_message.TASK_NAME): create_ticket_message.Response(ticket_id=241),
+        authorize_card_message.TASK_NAME: authorize_card_message.Payload(card_id=1001, amount=35),
+        approve_ticket_message.TASK_NAME: approve_ticket_message.Payload(ticket_id=241),
+        failure_task_name(authorize_card_message.TASK_NAME): SagaErrorPayload(
+            type='ValueError',
+            message='Card authorization failed. Insiffucient balance',
+            module='builtins',
+            traceback='Traceback (most recent call last):\n  File "worker.py", line 27, in authorize_card\n'
+                      'ValueError: Card authorization failed. Insiffucient balance\n',
+        ),
+    }
+
+
+def measure(task_name: str, payload, number: int) -> dict:
+    message_codec = codec.codecs.get(task_name)
+    payload_dict = dataclasses.asdict(payload)
+
+    json_payload = json.dumps(payload_dict).encode()
+    binary_payload = message_codec.encode(payload_dict)
+    assert message_codec.decode(binary_payload) == payload
+
+    def celery_body(task_payload, serializer: str) -> bytes:
+        # same structure Celery publishes (task protocol 2)
+        return dumps(([42, task_payload], {}, {'callbacks': None, 'errbacks': None,
+                                               'chain': None, 'chord': None}),
+                     serializer=serializer)[2]
+
+    accept = prepare_accept_content(codec.ACCEPT_CONTENT)
+    json_body = celery_body(payload_dict, 'json')
+    binary_body = celery_body(binary_payload, 'msgpack')
+
+    def per_call_us(statement) -> float:
+        return round(min(timeit.repeat(statement, number=number, repeat=3)) / number * 1e6, 3)
+
+    return {
+        'payload_bytes': {'json': len(json_payload), 'msgpack': len(binary_payload)},
+        'message_body_bytes': {'json': len(json_body), 'msgpack': len(binary_body)},
+        # encoding starts from dict, as it's produced by `asdict(...)` in services
+        'encode_us': {
+            'json': per_call_us(lambda: celery_body(payload_dict, 'json')),
+            'msgpack': per_call_us(lambda: celery_body(message_codec.encode(payload_dict), 'msgpack')),
+        },
+        # decoding ends with typed dataclass (for JSON, as services do it now: `Payload(**payload)`)
+        'decode_us': {
+            'json': per_call_us(lambda: payload.__class__(
+                **loads(json_body, 'application/json', 'utf-8', accept=accept)[0][1])),
+            'msgpack': per_call_us(lambda: message_codec.decode(
+                loads(binary_body, 'application/x-msgpack', 'binary', accept=accept)[0][1])),
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=3, help='number of order items in create_ticket payload')
+    parser.add_argument('--number', type=int, default=20000, help='encode/decode calls per measurement')
+    parser.add_argument('--output', default='codec-benchmark-results.json', help='path to JSON results file')
+    args = parser.parse_args(argv)
+
+    results = {task_name: measure(task_name, payload, args.number)
+               for task_name, payload in sample_messages(args.items).items()}
+
+    print(f"{'message':<55} {'payload, B':>14} {'body, B':>14} {'encode, us':>16} {'decode, us':>16}")
+    for task_name, stats in results.items():
+        columns = [f"{stats[key]['json']}/{stats[key]['msgpack']}"
+                   for key in ('payload_bytes', 'message_body_bytes', 'encode_us', 'decode_us')]
+        print(f'{task_name:<55} {columns[0]:>14} {columns[1]:>14} {columns[2]:>16} {columns[3]:>16}')
+    print('(json/msgpack)')
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(args.output, 'w') as output_file:
+        json.dump({'config': {'items': args.items, 'number': args.number}, 'messages': results},
+                  output_file, indent=2)
+    print(f'Results are written to {args.output}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
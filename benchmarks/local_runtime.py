@@ -0,0 +1,184 @@
+"""
+Runs order_service (web app and orchestrator worker) together with
+ consumer_service, restaurant_service and accounting_service workers in one process,
+ over SQLite (a DB file per service) and in-memory broker. No RabbitMQ or Postgres is needed.
+
+Messages are not consumed by real Celery workers:
+ `LocalRuntime.process_next_message()` takes one message from in-memory broker
+ and runs corresponding task of corresponding service in current thread.
+With OUTBOX_ENABLED=1, saga commands are published from outbox when all queues are empty
+ (as if outbox relay was running).
+With consumer verification cache enabled (CONSUMER_VERIFICATION_CACHE_TTL_SECONDS), its events
+ are handled before each message, instead of in a background thread.
+Everything runs in the calling thread, in a fixed order, so runs are repeatable (see saga_cpu_cost.py).
+
+Note: import this module before any service module,
+ as services read broker and DB settings at import time.
+"""
+import importlib
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+import typing
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SERVICES = ['order_service', 'consumer_service', 'restaurant_service', 'accounting_service']
+
+
+def _make_services_importable():
+    for service in SERVICES:
+        service_root = os.path.join(REPO_ROOT, service)
+        if service_root not in sys.path:
+            sys.path.insert(0, service_root)
+
+    # In Docker images, app_common is copied into each service package.
+    # Locally, make `<service>.app_common` refer to app_common folder from repo root
+    app_common_root = os.path.join(REPO_ROOT, 'app_common')
+    for service in SERVICES:
+        if importlib.util.find_spec(f'{service}.app_common') is None:
+            spec = importlib.util.spec_from_file_location(
+                f'{service}.app_common', os.path.join(app_common_root, '__init__.py'),
+                submodule_search_locations=[app_common_root])
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[spec.name] = module
+            spec.loader.exec_module(module)
+
+
+class ProcessedMessage(typing.NamedTuple):
+    queue: str
+    task_name: str
+    task_id: str
+    saga_id: int
+    payload: typing.Any
+    # CPU time of the calling thread spent on the task (see time.thread_time)
+    cpu_time_s: float = 0
+
+
+class LocalRuntime:
+    def __init__(self, db_path: str = None):
+        if db_path is None:
+            db_path = os.path.join(tempfile.mkdtemp(prefix='saga-local-runtime-'), 'order_service.sqlite')
+
+        os.environ['CELERY_BROKER'] = 'memory://'
+        os.environ['APP_SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+        os.environ['RESTAURANT_SQLALCHEMY_DATABASE_URI'] = \
+            f"sqlite:///{os.path.join(os.path.dirname(db_path), 'restaurant_service.sqlite')}"
+        _make_services_importable()
+
+        # imported here, after environment is set up
+        from kombu import Connection
+        from kombu.serialization import prepare_accept_content
+        from order_service import app as order_app_module
+        from order_service.models import create_schema
+        from order_service import create_order_saga_worker
+        from order_service.create_order_saga import consumer_verification_cache
+        from order_service.app_common.messaging import create_order_saga_response_queues
+        from order_service.app_common.messaging.codec import ACCEPT_CONTENT
+        from order_service.outbox import OUTBOX_ENABLED, OutboxRelay
+        from consumer_service import worker as consumer_worker
+        from restaurant_service import worker as restaurant_worker
+        from restaurant_service.models import create_schema as create_restaurant_schema
+        from accounting_service import worker as accounting_worker
+
+        create_schema()
+        create_restaurant_schema()
+        self.order_app_module = order_app_module
+        self.flask_client = order_app_module.app.test_client()
+        self.outbox_relay = OutboxRelay(order_app_module.main_celery_app, order_app_module.producer_pool) \
+            if OUTBOX_ENABLED else None
+
+        # which Celery app consumes which queue
+        self.celery_app_by_queue = {
+            consumer_worker.consumer_service_messaging.COMMANDS_QUEUE:
+                consumer_worker.command_handlers_celery_app,
+            restaurant_worker.restaurant_service_messaging.COMMANDS_QUEUE:
+                restaurant_worker.command_handlers_celery_app,
+            accounting_worker.accounting_service_messaging.COMMANDS_QUEUE:
+                accounting_worker.command_handlers_celery_app,
+        }
+        for response_queue in create_order_saga_response_queues():
+            self.celery_app_by_queue[response_queue] = create_order_saga_worker.create_order_saga_responses_celery_app
+
+        self._connection = Connection('memory://')
+        # queues are polled with Queue.get(accept=...): SimpleQueue doesn't take `accept` before kombu 5.1
+        self._accept = prepare_accept_content(ACCEPT_CONTENT)
+        self._queues = [(name, self._declare_queue(name)) for name in self.celery_app_by_queue]
+        self._next_queue_index = 0
+
+        self.consumer_verification_cache = consumer_verification_cache
+        self._cache_events_queue = None
+        self._cache_events_accept = prepare_accept_content(['json'])
+        if consumer_verification_cache.enabled:
+            consumer_verification_cache.listen_in_background = False
+            self._cache_events_queue = self._declare_queue(consumer_verification_cache.events_queue)
+
+    def _declare_queue(self, queue):
+        # for queue name, same queue and exchange as Connection.SimpleQueue(name) declares
+        from kombu import Exchange, Queue
+
+        if not isinstance(queue, Queue):
+            queue = Queue(queue, Exchange(queue, type='direct'), queue)
+        queue = queue.bind(self._connection.default_channel)
+        queue.declare()
+        return queue
+
+    def process_next_message(self) -> typing.Optional[ProcessedMessage]:
+        """
+        Runs a task for the first message found in service queues.
+        Queues are checked round-robin, so no service starves others.
+        Returns None if all queues are empty
+        """
+        self._handle_cache_events()
+        for _ in range(len(self._queues)):
+            queue_name, queue = self._queues[self._next_queue_index]
+            self._next_queue_index = (self._next_queue_index + 1) % len(self._queues)
+            message = queue.get(accept=self._accept)
+            if message is None:
+                continue
+
+            args, kwargs, _ = message.decode()
+            task_name, task_id = message.headers['task'], message.headers['id']
+            message.ack()
+
+            celery_app = self.celery_app_by_queue[queue_name]
+            started_cpu_time = time.thread_time()
+            try:
+                celery_app.tasks[task_name].apply(args=args, kwargs=kwargs, task_id=task_id)
+            finally:
+                # as Celery worker does after each task, see close_sqlalchemy_db_connection_after_celery_task_ends
+                self.order_app_module.db.session.remove()
+            cpu_time_s = time.thread_time() - started_cpu_time
+
+            saga_id, payload = (list(args) + [None, None])[:2]
+            return ProcessedMessage(queue_name, task_name, task_id, saga_id, payload, cpu_time_s)
+
+        if self.outbox_relay:
+            try:
+                relayed_count = self.outbox_relay.relay_batch()
+            finally:
+                self.order_app_module.db.session.remove()
+            if relayed_count:
+                return self.process_next_message()
+
+        return None
+
+    def _handle_cache_events(self):
+        while self._cache_events_queue is not None:
+            message = self._cache_events_queue.get(accept=self._cache_events_accept)
+            if message is None:
+                return
+
+            message.ack()
+            self.consumer_verification_cache.handle_event(message.decode())
+
+    def process_all_messages(self) -> int:
+        processed_count = 0
+        while self.process_next_message():
+            processed_count += 1
+
+        return processed_count
+
+    def close(self):
+        self._connection.release()
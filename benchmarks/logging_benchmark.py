@@ -0,0 +1,146 @@
+"""
+Measures per-message overhead of logging in saga hot paths, i.e. time the logging call takes in the caller:
+ * before: `logging.basicConfig(...)` handler (formats and writes record in the caller)
+   and f-string message (formatted even if record is dropped)
+ * after: `setup_logging()` (see app_common/structured_logging.py) - record is put into a queue
+   and formatted and written by a background thread; message is formatted lazily, saga context is attached.
+   Also with sampling of 10% and 1% of sagas
+
+Records are written to a temporary file. With --sink-latency-us, each write to it is delayed
+ (like a write to stderr pipe which log collector reads slowly).
+Time the background thread takes to write records left in queue after the last call
+ is reported separately, as `drain_ms` (it's not spent in the caller).
+
+Note: background thread shares GIL with the caller, so without sink latency the "after" variant
+ doesn't take less CPU than the "before" one (records are still formatted in the same process).
+ It takes writes off the caller, and sampling drops records before they are created.
+
+Usage (from repo root):
+    python benchmarks/logging_benchmark.py --messages 20000 --sink-latency-us 50 \
+        --output benchmarks/results/logging.json
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import typing
+
+from local_runtime import _make_services_importable
+
+_make_services_importable()
+
+from order_service.app_common import structured_logging  # noqa: E402
+
+LOGGER_NAME = 'order_service.create_order_saga'
+
+
+class SlowStream:
+    """
+    Text stream which write takes at least `latency_s` (GIL is released meanwhile, as in blocking write)
+    """
+    def __init__(self, stream: typing.TextIO, latency_s: float):
+        self.stream = stream
+        self.latency_s = latency_s
+
+    def write(self, text: str):
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def log_before(logger: logging.Logger, saga_id: int, ticket_id: int, payload: dict):
+    logger.info(f'Saga {saga_id}: running on_success for "create_restaurant_ticket" step')
+    logger.info(f'Restaurant ticket # {ticket_id} created, result = {payload}')
+
+
+def log_after(logger: logging.Logger, saga_id: int, ticket_id: int, payload: dict):
+    log = structured_logging.saga_logger(logger, saga_id, step='create_restaurant_ticket')
+    log.info('Running on_%s handler', 'success')
+    log.info('Restaurant ticket #%s created, result = %s', ticket_id, payload)
+
+
+def _reset_root_logger():
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        handler.close()
+
+
+def measure(variant: str, messages: int, log_path: str, sink_latency_s: float) -> dict:
+    _reset_root_logger()
+    with open(log_path, 'w') as file:
+        log_file = SlowStream(file, sink_latency_s)
+        if variant == 'before':
+            logging.basicConfig(level=logging.DEBUG, stream=log_file)
+            log_call = log_before
+        else:
+            rate = {'after': 1.0, 'after_sampled_10': 0.1, 'after_sampled_1': 0.01}[variant]
+            listener = structured_logging.setup_logging(level=logging.DEBUG, stream=log_file,
+                                                        sample_rates={LOGGER_NAME: rate})
+            log_call = log_after
+
+        logger = logging.getLogger(LOGGER_NAME)
+        payload = {'ticket_id': 241, 'items': [{'name': 'Dish 1', 'quantity': 2}]}
+        calls = messages // 2  # each call logs two messages
+
+        started_at = time.perf_counter()
+        for saga_id in range(calls):
+            log_call(logger, saga_id, 241, payload)
+        caller_s = time.perf_counter() - started_at
+
+        drain_s = 0.0
+        if variant != 'before':
+            drain_started_at = time.perf_counter()
+            listener.stop()  # waits till all queued records are written
+            drain_s = time.perf_counter() - drain_started_at
+        _reset_root_logger()
+
+    with open(log_path) as log_file:
+        written = sum(1 for _ in log_file)
+
+    return {
+        'per_message_us': round(caller_s / (calls * 2) * 1e6, 3),
+        'caller_ms': round(caller_s * 1000, 1),
+        'drain_ms': round(drain_s * 1000, 1),
+        'lines_written': written,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=20000, help='messages logged per variant')
+    parser.add_argument('--sink-latency-us', type=float, default=0, help='delay of each write to log file')
+    parser.add_argument('--output', default='logging-benchmark-results.json', help='path to JSON results file')
+    args = parser.parse_args(argv)
+
+    log_path = os.path.join(tempfile.mkdtemp(prefix='saga-logging-benchmark-'), 'benchmark.log')
+    variants = ['before', 'after', 'after_sampled_10', 'after_sampled_1']
+    results = {variant: measure(variant, args.messages, log_path, args.sink_latency_us / 1e6)
+               for variant in variants}
+
+    print(f"{'variant':<18} {'per message, us':>16} {'caller, ms':>12} {'drain, ms':>12} {'lines':>8}")
+    for variant, stats in results.items():
+        print(f"{variant:<18} {stats['per_message_us']:>16} {stats['caller_ms']:>12} "
+              f"{stats['drain_ms']:>12} {stats['lines_written']:>8}")
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(args.output, 'w') as output_file:
+        json.dump({'config': {'messages': args.messages, 'sink_latency_us': args.sink_latency_us,
+                              'python': sys.version.split()[0]},
+                   'variants': results},
+                  output_file, indent=2)
+    print(f'Results are written to {args.output}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,295 @@
+"""
+End-to-end CreateOrder saga throughput and latency benchmark.
+
+Starts sagas through order_service scenario endpoints (e.g. /run-success-saga)
+ with a configurable mix and rate, runs all services in one process (see local_runtime.py)
+ and reports p50/p95/p99 of:
+ * saga time to completion (by scenario and by outcome)
+ * each step (from sending a command till its response is handled by orchestrator)
+ * compensation (from the moment saga starts compensating till it's marked as failed)
+
+Results are printed and written to a JSON file, so they can be compared between runs.
+
+Usage (from repo root, with all services' dependencies installed):
+    python benchmarks/saga_benchmark.py --sagas 500 --rate 100 \
+        --mix success=70,card_authorization_failure=20,consumer_verification_failure=10 \
+        --output benchmarks/results/latest.json
+"""
+import argparse
+import collections
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import re
+import sys
+import time
+import typing
+
+from local_runtime import LocalRuntime
+
+SCENARIO_ENDPOINTS = {
+    'success': '/run-success-saga',
+    'consumer_verification_failure': '/run-saga-failing-on-consumer-verification-because-of-incorrect-id',
+    'card_authorization_failure': '/run-saga-failing-on-card-authorization',
+    'orchestrator_failure': '/run-saga-where-orchestrator-code-fails',
+    'random': '/run-random-saga',
+}
+
+
+def percentiles(values_ms: typing.List[float]) -> dict:
+    if not values_ms:
+        return {'count': 0}
+
+    values_ms = sorted(values_ms)
+
+    def nearest_rank(percent: float) -> float:
+        rank = max(int(round(percent / 100 * len(values_ms) + 0.5)) - 1, 0)
+        return round(values_ms[min(rank, len(values_ms) - 1)], 3)
+
+    return {
+        'count': len(values_ms),
+        'mean': round(sum(values_ms) / len(values_ms), 3),
+        'p50': nearest_rank(50),
+        'p95': nearest_rank(95),
+        'p99': nearest_rank(99),
+        'max': round(values_ms[-1], 3),
+    }
+
+
+def parse_mix(mix: str) -> typing.Dict[str, float]:
+    weights = {}
+    for part in mix.split(','):
+        scenario, _, weight = part.partition('=')
+        scenario = scenario.strip()
+        if scenario not in SCENARIO_ENDPOINTS:
+            raise argparse.ArgumentTypeError(
+                f'Unknown scenario "{scenario}". Known ones: {", ".join(SCENARIO_ENDPOINTS)}')
+        weights[scenario] = float(weight or 1)
+
+    return weights
+
+
+class SagaBenchmark:
+    def __init__(self, runtime: LocalRuntime, mix: typing.Dict[str, float],
+                 sagas_count: int, rate: float, seed: int):
+        self.runtime = runtime
+        self.mix = mix
+        self.sagas_count = sagas_count
+        self.rate = rate
+        self.rng = random.Random(seed)
+
+        self.saga_scenario = {}  # saga_id -> scenario
+        self.saga_started_at = {}
+        self.saga_finished_at = {}
+        self.saga_outcome = {}
+        self.rejected_count = 0  # orders rejected by admission control (see MAX_IN_FLIGHT_SAGAS)
+        self.compensation_started_at = {}
+        self.compensation_durations_ms = []
+        self.command_sent_at = {}  # (saga_id, task name) -> time
+        self.step_durations_ms = collections.defaultdict(list)  # (step name, outcome) -> durations
+
+        saga_class = runtime.order_app_module.CreateOrderSaga
+        # noinspection PyTypeChecker
+        self.step_name_by_task_name = {step.base_task_name: step.name
+                                       for step in saga_class(None, None, None).async_steps}
+        self._instrument(saga_class)
+
+    def _instrument(self, saga_class):
+        from celery.signals import before_task_publish
+
+        @before_task_publish.connect(weak=False)
+        def on_publish(sender: str, body, **kwargs):
+            if '.response.' not in sender:
+                args = body[0]
+                self.command_sent_at[(args[0], sender)] = time.perf_counter()
+
+        benchmark = self
+        original_compensate = saga_class.compensate
+        original_on_saga_success = saga_class.on_saga_success
+        original_on_saga_failure = saga_class.on_saga_failure
+
+        def compensate(saga, *args, **kwargs):
+            benchmark.compensation_started_at.setdefault(saga.saga_id, time.perf_counter())
+            return original_compensate(saga, *args, **kwargs)
+
+        def on_saga_success(saga):
+            original_on_saga_success(saga)
+            benchmark._on_saga_finished(saga.saga_id, 'succeeded')
+
+        def on_saga_failure(saga, *args, **kwargs):
+            original_on_saga_failure(saga, *args, **kwargs)
+            benchmark._on_saga_finished(saga.saga_id, 'failed')
+
+        saga_class.compensate = compensate
+        saga_class.on_saga_success = on_saga_success
+        saga_class.on_saga_failure = on_saga_failure
+
+    def _on_saga_finished(self, saga_id: int, outcome: str):
+        now = time.perf_counter()
+        self.saga_finished_at[saga_id] = now
+        self.saga_outcome[saga_id] = outcome
+        if saga_id in self.compensation_started_at:
+            self.compensation_durations_ms.append((now - self.compensation_started_at[saga_id]) * 1000)
+
+    def _start_saga(self):
+        scenario = self.rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+
+        started_at = time.perf_counter()
+        response = self.runtime.flask_client.get(SCENARIO_ENDPOINTS[scenario])
+        if response.status_code == 429:
+            self.rejected_count += 1
+            return
+        saga_id = int(re.search(r'#(\d+)', response.get_data(as_text=True)).group(1))
+
+        self.saga_scenario[saga_id] = scenario
+        self.saga_started_at[saga_id] = started_at
+
+    def _on_message_processed(self, task_name: str, saga_id: int):
+        now = time.perf_counter()
+        base_task_name, is_response, outcome = task_name.partition('.response.')
+        if is_response:
+            sent_at = self.command_sent_at.pop((saga_id, base_task_name), None)
+            step_name = self.step_name_by_task_name.get(base_task_name, base_task_name)
+        else:
+            # commands without response, e.g. compensations like restaurant_service.reject_ticket
+            if task_name in self.step_name_by_task_name:
+                return  # response to it will come later
+            sent_at = self.command_sent_at.pop((saga_id, task_name), None)
+            step_name, outcome = task_name, 'no_response'
+
+        if sent_at is not None:
+            self.step_durations_ms[(step_name, outcome)].append((now - sent_at) * 1000)
+
+    def run(self) -> dict:
+        started_count = 0
+        interval = 1 / self.rate if self.rate else 0
+        benchmark_started_at = next_saga_at = time.perf_counter()
+
+        while True:
+            now = time.perf_counter()
+            if started_count < self.sagas_count and now >= next_saga_at:
+                self._start_saga()
+                started_count += 1
+                next_saga_at += interval
+                continue
+
+            processed_message = self.runtime.process_next_message()
+            if processed_message:
+                self._on_message_processed(processed_message.task_name, processed_message.saga_id)
+                continue
+
+            if started_count < self.sagas_count:
+                time.sleep(max(next_saga_at - time.perf_counter(), 0))
+                continue
+
+            break  # all sagas started and no messages left
+
+        wall_time_s = time.perf_counter() - benchmark_started_at
+        return self._results(wall_time_s)
+
+    def _results(self, wall_time_s: float) -> dict:
+        time_to_completion_ms = {saga_id: (finished_at - self.saga_started_at[saga_id]) * 1000
+                                 for saga_id, finished_at in self.saga_finished_at.items()}
+
+        def completion_percentiles(predicate) -> dict:
+            return percentiles([duration for saga_id, duration in time_to_completion_ms.items()
+                                if predicate(saga_id)])
+
+        steps = collections.defaultdict(dict)
+        for (step_name, outcome), durations in sorted(self.step_durations_ms.items()):
+            steps[step_name][outcome] = percentiles(durations)
+
+        return {
+            'created_at': datetime.datetime.utcnow().isoformat(),
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'broker': 'memory://',
+                'database': 'sqlite',
+            },
+            'sagas': {
+                'started': len(self.saga_started_at),
+                'finished': len(self.saga_finished_at),
+                'unfinished': len(self.saga_started_at) - len(self.saga_finished_at),
+                'rejected': self.rejected_count,
+                'by_outcome': dict(collections.Counter(self.saga_outcome.values())),
+                'wall_time_s': round(wall_time_s, 3),
+                'throughput_per_s': round(len(self.saga_finished_at) / wall_time_s, 3),
+            },
+            'time_to_completion_ms': {
+                'all': completion_percentiles(lambda saga_id: True),
+                'by_scenario': {
+                    scenario: completion_percentiles(lambda saga_id: self.saga_scenario[saga_id] == scenario)
+                    for scenario in self.mix
+                },
+                'by_outcome': {
+                    outcome: completion_percentiles(lambda saga_id: self.saga_outcome[saga_id] == outcome)
+                    for outcome in sorted(set(self.saga_outcome.values()))
+                },
+            },
+            'steps_ms': dict(steps),
+            'compensation_ms': percentiles(self.compensation_durations_ms),
+        }
+
+
+def print_summary(results: dict):
+    sagas = results['sagas']
+    print(f"Sagas: {sagas['finished']}/{sagas['started']} finished in {sagas['wall_time_s']}s "
+          f"({sagas['throughput_per_s']} sagas/s), outcomes: {sagas['by_outcome']}, rejected: {sagas['rejected']}")
+
+    def row(title: str, stats: dict):
+        if stats['count']:
+            print(f"  {title:<60} n={stats['count']:<6} p50={stats['p50']:<10} "
+                  f"p95={stats['p95']:<10} p99={stats['p99']}")
+
+    print('Time to completion, ms:')
+    row('all', results['time_to_completion_ms']['all'])
+    for scenario, stats in results['time_to_completion_ms']['by_scenario'].items():
+        row(f'scenario: {scenario}', stats)
+    print('Steps, ms:')
+    for step_name, by_outcome in results['steps_ms'].items():
+        for outcome, stats in by_outcome.items():
+            row(f'{step_name} ({outcome})', stats)
+    print('Compensation, ms:')
+    row('all', results['compensation_ms'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sagas', type=int, default=200, help='number of sagas to start')
+    parser.add_argument('--rate', type=float, default=50,
+                        help='sagas started per second (0 means start them all at once)')
+    parser.add_argument('--mix', type=parse_mix, default='success=1',
+                        help=f'comma-separated scenario=weight pairs. Scenarios: {", ".join(SCENARIO_ENDPOINTS)}')
+    parser.add_argument('--seed', type=int, default=1, help='random seed, for repeatable runs')
+    parser.add_argument('--output', default='saga-benchmark-results.json', help='path to JSON results file')
+    parser.add_argument('--log-level', default='WARNING', help='services log level')
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)  # services use `random` too
+    runtime = LocalRuntime()
+    logging.getLogger().setLevel(args.log_level)
+
+    try:
+        results = SagaBenchmark(runtime, args.mix, args.sagas, args.rate, args.seed).run()
+    finally:
+        runtime.close()
+
+    results['config'] = {'sagas': args.sagas, 'rate': args.rate, 'mix': args.mix, 'seed': args.seed}
+    print_summary(results)
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f'Results are written to {args.output}')
+
+    return 0 if not results['sagas']['unfinished'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,254 @@
+"""
+CPU cost of a CreateOrder saga, with all four services embedded in one process (see local_runtime.py:
+ in-memory broker, SQLite), so orchestration overhead (CreateOrderSaga step transitions, repository calls,
+ message encoding) can be measured and profiled without broker, DB server and container noise.
+
+Runs are deterministic: services' `random` is seeded, scenarios are picked with --seed,
+ and sagas are started in waves of --in-flight, each wave processed till all queues are empty,
+ in one thread and in a fixed order (no timers, no sleeps). Simulation mode (SIMULATION_PROFILE) is turned off.
+CPU time of the thread (time.thread_time) spent on each saga-starting request and on each handled message
+ is attributed to its saga. Reported per saga: CPU time (overall, by scenario, by component) and DB statements
+ executed by orchestrator; per task: mean CPU time of one message.
+The first --warmup sagas (lazy imports, statement caches) are not measured.
+
+Usage (from repo root, with all services' dependencies installed):
+    python benchmarks/saga_cpu_cost.py --sagas 1000 --mix success=1 --output benchmarks/results/cpu.json
+
+Profiling the measured part with cProfile (costs are inflated by profiler overhead then):
+    python benchmarks/saga_cpu_cost.py --sagas 1000 --profile-output benchmarks/results/cpu.pstats
+    python -m pstats benchmarks/results/cpu.pstats
+or sampling the whole run with py-spy:
+    py-spy record -o saga-flamegraph.svg -- python benchmarks/saga_cpu_cost.py --sagas 5000
+"""
+import argparse
+import collections
+import cProfile
+import datetime
+import gc
+import json
+import logging
+import os
+import platform
+import pstats
+import random
+import re
+import sys
+import time
+import typing
+
+from local_runtime import LocalRuntime
+from saga_benchmark import SCENARIO_ENDPOINTS, parse_mix, percentiles
+
+WEB_COMPONENT = 'order_service.web'
+ORCHESTRATOR_COMPONENT = 'order_service.orchestrator'
+
+
+def component_of(task_name: str) -> str:
+    # responses are handled by orchestrator, commands - by the service their name starts with
+    if '.response.' in task_name:
+        return ORCHESTRATOR_COMPONENT
+    return task_name.split('.', 1)[0]
+
+
+class SagaCpuCost:
+    def __init__(self, runtime: LocalRuntime, mix: typing.Dict[str, float], in_flight: int, seed: int):
+        self.runtime = runtime
+        self.mix = mix
+        self.in_flight = in_flight
+        self.rng = random.Random(seed)
+
+        from order_service.create_order_saga import statements_counter
+        self.statements_counter = statements_counter
+
+        self.saga_scenario = {}  # saga_id -> scenario
+        self.saga_cpu_time_s = collections.Counter()
+        self.saga_cpu_time_by_component_s = collections.defaultdict(collections.Counter)  # component -> saga_id -> s
+        self.task_cpu_times_s = collections.defaultdict(list)  # task name -> CPU time of each message
+        self.rejected_count = 0
+
+    def _start_saga(self) -> typing.Optional[int]:
+        scenario = self.rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+
+        started_cpu_time = time.thread_time()
+        response = self.runtime.flask_client.get(SCENARIO_ENDPOINTS[scenario])
+        cpu_time_s = time.thread_time() - started_cpu_time
+        if response.status_code == 429:
+            self.rejected_count += 1
+            return None
+
+        saga_id = int(re.search(r'#(\d+)', response.get_data(as_text=True)).group(1))
+        self.saga_scenario[saga_id] = scenario
+        self._attribute(saga_id, WEB_COMPONENT, cpu_time_s)
+        return saga_id
+
+    def _attribute(self, saga_id: int, component: str, cpu_time_s: float):
+        if saga_id in self.saga_scenario:
+            self.saga_cpu_time_s[saga_id] += cpu_time_s
+            self.saga_cpu_time_by_component_s[component][saga_id] += cpu_time_s
+
+    def run(self, sagas_count: int, profiler: cProfile.Profile = None) -> dict:
+        gc.collect()  # garbage of warmup isn't collected during measurement
+        if profiler:
+            profiler.enable()
+        started_at, started_cpu_time = time.perf_counter(), time.thread_time()
+
+        started_count = 0
+        while started_count < sagas_count:
+            for _ in range(min(self.in_flight, sagas_count - started_count)):
+                self._start_saga()
+                started_count += 1
+
+            while True:
+                processed_message = self.runtime.process_next_message()
+                if not processed_message:
+                    break
+                self.task_cpu_times_s[processed_message.task_name].append(processed_message.cpu_time_s)
+                self._attribute(processed_message.saga_id, component_of(processed_message.task_name),
+                                processed_message.cpu_time_s)
+
+        cpu_time_s, wall_time_s = time.thread_time() - started_cpu_time, time.perf_counter() - started_at
+        if profiler:
+            profiler.disable()
+        return self._results(cpu_time_s, wall_time_s)
+
+    def _saga_statuses(self) -> typing.Dict[int, str]:
+        from order_service.models import db, CreateOrderSagaState
+
+        try:
+            return dict(db.session.query(CreateOrderSagaState.id, CreateOrderSagaState.status)
+                        .filter(CreateOrderSagaState.id.in_(list(self.saga_scenario))))
+        finally:
+            db.session.remove()
+
+    def _results(self, cpu_time_s: float, wall_time_s: float) -> dict:
+        from order_service.models import TERMINAL_SAGA_STATUSES
+
+        statuses = self._saga_statuses()
+        finished_count = sum(1 for status in statuses.values() if status in TERMINAL_SAGA_STATUSES)
+        sagas_count = len(self.saga_scenario) or 1
+        attributed_cpu_time_s = sum(self.saga_cpu_time_s.values())
+
+        def cpu_percentiles(saga_ids) -> dict:
+            return percentiles([self.saga_cpu_time_s[saga_id] * 1000 for saga_id in saga_ids])
+
+        return {
+            'created_at': datetime.datetime.utcnow().isoformat(),
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'broker': 'memory://',
+                'database': 'sqlite',
+            },
+            'sagas': {
+                'started': len(self.saga_scenario),
+                'finished': finished_count,
+                'unfinished': len(self.saga_scenario) - finished_count,
+                'rejected': self.rejected_count,
+                'by_status': dict(collections.Counter(statuses.values())),
+                'wall_time_s': round(wall_time_s, 3),
+                'cpu_time_s': round(cpu_time_s, 3),
+                # e.g. outbox relay and queue polling, which aren't done on behalf of one saga
+                'unattributed_cpu_time_s': round(cpu_time_s - attributed_cpu_time_s, 3),
+            },
+            'cpu_per_saga_ms': {
+                'all': cpu_percentiles(self.saga_scenario),
+                'by_scenario': {
+                    scenario: cpu_percentiles([saga_id for saga_id, saga_scenario in self.saga_scenario.items()
+                                               if saga_scenario == scenario])
+                    for scenario in self.mix
+                },
+                # mean over all sagas, e.g. consumer_service isn't called by some of them
+                'by_component_mean': {
+                    component: round(sum(cpu_times.values()) * 1000 / sagas_count, 3)
+                    for component, cpu_times in sorted(self.saga_cpu_time_by_component_s.items())
+                },
+            },
+            'cpu_per_message_ms': {
+                task_name: {
+                    'count': len(cpu_times),
+                    'mean': round(sum(cpu_times) * 1000 / len(cpu_times), 3),
+                    'total': round(sum(cpu_times) * 1000, 3),
+                }
+                for task_name, cpu_times in sorted(self.task_cpu_times_s.items())
+            },
+            'db_statements_per_saga': percentiles([self.statements_counter.get(saga_id)
+                                                   for saga_id in self.saga_scenario]),
+        }
+
+
+def print_summary(results: dict):
+    sagas = results['sagas']
+    print(f"Sagas: {sagas['finished']}/{sagas['started']} finished in {sagas['wall_time_s']}s, "
+          f"CPU {sagas['cpu_time_s']}s ({sagas['unattributed_cpu_time_s']}s not attributed to sagas), "
+          f"statuses: {sagas['by_status']}, rejected: {sagas['rejected']}")
+
+    def row(title: str, stats: dict):
+        if stats['count']:
+            print(f"  {title:<60} n={stats['count']:<6} mean={stats['mean']:<9} p50={stats['p50']:<9} "
+                  f"p95={stats['p95']:<9} p99={stats['p99']}")
+
+    print('CPU per saga, ms:')
+    row('all', results['cpu_per_saga_ms']['all'])
+    for scenario, stats in results['cpu_per_saga_ms']['by_scenario'].items():
+        row(f'scenario: {scenario}', stats)
+    print('CPU per saga by component (mean), ms:')
+    for component, mean in results['cpu_per_saga_ms']['by_component_mean'].items():
+        print(f'  {component:<60} {mean}')
+    print('CPU per message, ms:')
+    for task_name, stats in results['cpu_per_message_ms'].items():
+        print(f"  {task_name:<60} n={stats['count']:<6} mean={stats['mean']}")
+    print('DB statements per saga (orchestrator):')
+    row('all', results['db_statements_per_saga'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sagas', type=int, default=500, help='number of measured sagas')
+    parser.add_argument('--warmup', type=int, default=20, help='number of sagas run before measurement')
+    parser.add_argument('--in-flight', type=int, default=10,
+                        help='sagas started at once, before their messages are processed')
+    parser.add_argument('--mix', type=parse_mix, default='success=1',
+                        help=f'comma-separated scenario=weight pairs. Scenarios: {", ".join(SCENARIO_ENDPOINTS)}')
+    parser.add_argument('--seed', type=int, default=1, help='random seed, for repeatable runs')
+    parser.add_argument('--output', default='saga-cpu-cost-results.json', help='path to JSON results file')
+    parser.add_argument('--profile-output', help='path to write cProfile stats of the measured part to')
+    parser.add_argument('--profile-top', type=int, default=30,
+                        help='number of functions (by cumulative time) to print with --profile-output')
+    parser.add_argument('--log-level', default='WARNING', help='services log level')
+    args = parser.parse_args(argv)
+
+    # simulated latency would only add sleeps, and simulated failures - randomness
+    os.environ.pop('SIMULATION_PROFILE', None)
+    random.seed(args.seed)  # services use `random` too
+    runtime = LocalRuntime()
+    logging.getLogger().setLevel(args.log_level)
+
+    try:
+        if args.warmup:
+            SagaCpuCost(runtime, args.mix, args.in_flight, args.seed).run(args.warmup)
+        profiler = cProfile.Profile() if args.profile_output else None
+        results = SagaCpuCost(runtime, args.mix, args.in_flight, args.seed).run(args.sagas, profiler)
+    finally:
+        runtime.close()
+
+    results['config'] = {'sagas': args.sagas, 'warmup': args.warmup, 'in_flight': args.in_flight,
+                         'mix': args.mix, 'seed': args.seed, 'profiled': bool(profiler)}
+    print_summary(results)
+
+    for path in [args.output, args.profile_output]:
+        if path and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f'Results are written to {args.output}')
+
+    if profiler:
+        profiler.dump_stats(args.profile_output)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(args.profile_top)
+        print(f'Profile is written to {args.profile_output}')
+
+    return 0 if not results['sagas']['unfinished'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
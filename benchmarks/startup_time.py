@@ -0,0 +1,154 @@
+"""
+Measures order_service startup time, each run in a fresh Python process:
+ * orchestrator worker: import time of `order_service.create_order_saga_worker`
+   and time till the first saga response is consumed and handled by a real Celery worker (solo pool)
+ * web app: import time of `order_service.app` and time till the first request (GET /ping) is served
+
+Runs over SQLite and in-memory broker, like local_runtime.py.
+Schema is created and sagas are started before measurements: each worker run handles a response to one of them.
+
+Usage (from repo root):
+    python benchmarks/startup_time.py --runs 5 --output benchmarks/results/startup.json
+"""
+import time
+
+process_started_at = time.perf_counter()
+
+import argparse  # noqa: E402
+import json  # noqa: E402
+import os  # noqa: E402
+import statistics  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+
+RESULT_PREFIX = 'STARTUP_RESULT '
+
+
+def _prepare_environment(db_path: str):
+    os.environ['CELERY_BROKER'] = 'memory://'
+    os.environ['APP_SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+
+    from local_runtime import _make_services_importable
+    _make_services_importable()
+
+
+def _report(result: dict):
+    print(RESULT_PREFIX + json.dumps(result), flush=True)
+
+
+def setup(db_path: str, sagas_count: int):
+    _prepare_environment(db_path)
+    from order_service.app import app
+    from order_service.models import create_schema
+
+    create_schema()
+    client = app.test_client()
+    for _ in range(sagas_count):
+        client.get('/run-success-saga')
+    _report({})
+
+
+def measure_worker(db_path: str, saga_id: int):
+    _prepare_environment(db_path)
+
+    from order_service import create_order_saga_worker
+    imported_at = time.perf_counter()
+
+    from celery.signals import task_postrun
+    from saga_framework import success_task_name
+    from order_service.app_common.messaging import create_order_saga_response_queue
+    from order_service.app_common.messaging.restaurant_service_messaging import create_ticket_message
+
+    celery_app = create_order_saga_worker.create_order_saga_responses_celery_app
+    celery_app.send_task(success_task_name(create_ticket_message.TASK_NAME),
+                         args=[saga_id, {'ticket_id': 250}],
+                         queue=create_order_saga_response_queue(saga_id))
+
+    @task_postrun.connect(weak=False)
+    def on_first_task_handled(**kwargs):
+        _report({
+            'import_s': imported_at - process_started_at,
+            'first_message_s': time.perf_counter() - process_started_at,
+        })
+        os._exit(0)  # no need to wait for graceful worker shutdown
+
+    celery_app.Worker(pool='solo', concurrency=1, loglevel='WARNING', quiet=True, redirect_stdouts=False,
+                      without_heartbeat=True, without_mingle=True, without_gossip=True).start()
+
+
+def measure_web_app(db_path: str):
+    _prepare_environment(db_path)
+
+    from order_service.app import app
+    imported_at = time.perf_counter()
+
+    response = app.test_client().get('/ping')
+    assert response.status_code == 200
+    _report({
+        'import_s': imported_at - process_started_at,
+        'first_request_s': time.perf_counter() - process_started_at,
+    })
+
+
+def run_child(*args: str) -> dict:
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', *args],
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                               universal_newlines=True, timeout=120,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    for line in completed.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+
+    raise RuntimeError(f'{args[0]} run failed (exit code {completed.returncode})')
+
+
+def summary(runs: list) -> dict:
+    return {key: {'median_ms': round(statistics.median(run[key] for run in runs) * 1000, 1),
+                  'min_ms': round(min(run[key] for run in runs) * 1000, 1)}
+            for key in runs[0]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='fresh processes per measurement')
+    parser.add_argument('--output', default='startup-time-results.json', help='path to JSON results file')
+    parser.add_argument('--child', nargs='+', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        mode, db_path, *rest = args.child
+        if mode == 'setup':
+            setup(db_path, int(rest[0]))
+        elif mode == 'worker':
+            measure_worker(db_path, int(rest[0]))
+        else:
+            measure_web_app(db_path)
+        return 0
+
+    db_path = os.path.join(tempfile.mkdtemp(prefix='saga-startup-time-'), 'order_service.sqlite')
+    run_child('setup', db_path, str(args.runs))
+
+    results = {
+        'worker': summary([run_child('worker', db_path, str(saga_id)) for saga_id in range(1, args.runs + 1)]),
+        'web_app': summary([run_child('web', db_path) for _ in range(args.runs)]),
+    }
+    results['config'] = {'runs': args.runs, 'python': sys.version.split()[0]}
+
+    for process, stats in results.items():
+        if process != 'config':
+            print(process + ': ' + ', '.join(f"{key} median={value['median_ms']}ms min={value['min_ms']}ms"
+                                             for key, value in stats.items()))
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f'Results are written to {args.output}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,24 @@
+"""
+Batch mode of consumer_service worker (see app_common/messaging/batch_consumer.py):
+ consumer verification commands are handled in batches,
+ and responses to a batch are published at once.
+
+Run it instead of Celery worker with
+    PYTHONPATH=. python -m consumer_service.batch_worker
+"""
+from consumer_service.app_common.messaging import consumer_service_messaging, \
+    create_order_saga_response_queue
+from consumer_service.app_common.messaging.batch_consumer import BatchCommandConsumer
+from consumer_service.app_common.messaging.consumer_service_messaging import \
+    verify_consumer_details_message
+from .worker import command_handlers_celery_app, verify_consumer_details
+
+consumer = BatchCommandConsumer(
+    command_handlers_celery_app,
+    queue_name=consumer_service_messaging.COMMANDS_QUEUE,
+    handlers={verify_consumer_details_message.TASK_NAME: verify_consumer_details},
+    response_queue=create_order_saga_response_queue,
+)
+
+if __name__ == '__main__':
+    consumer.run()
@@ -0,0 +1,37 @@
+"""
+Consumer status changes. Other services are notified with `consumer_status_changed` event
+ (see consumer_status_changed_message), e.g. orchestrator drops cached verification of the consumer.
+
+Change consumer status with
+    PYTHONPATH=. python -m consumer_service.consumer_status 42 blocked
+"""
+import argparse
+import logging
+from dataclasses import asdict
+
+from consumer_service.app_common.messaging import consumer_service_messaging
+from consumer_service.app_common.messaging.consumer_service_messaging import consumer_status_changed_message
+from .worker import command_handlers_celery_app
+
+logger = logging.getLogger(__name__)
+
+
+def change_consumer_status(consumer_id: int, status: str):
+    # in real world, we would change consumer status in consumer service DB here
+
+    payload = consumer_status_changed_message.Payload(consumer_id=consumer_id, status=status)
+    with command_handlers_celery_app.producer_or_acquire() as producer:
+        producer.publish(
+            {'event': consumer_status_changed_message.EVENT_NAME, 'payload': asdict(payload)},
+            exchange=consumer_service_messaging.EVENTS_EXCHANGE, routing_key='', serializer='json',
+            declare=[consumer_service_messaging.EVENTS_EXCHANGE], retry=True)
+    logger.info('Consumer #%s status changed to %s', consumer_id, status)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('consumer_id', type=int)
+    parser.add_argument('status', help='new consumer status, e.g. blocked')
+    args = parser.parse_args()
+
+    change_consumer_status(args.consumer_id, args.status)
@@ -1,27 +1,31 @@
-import logging
+import os
 import typing
 
 from celery import Celery, Task
-from saga_framework import saga_step_handler
-
-from consumer_service.app_common import settings
+from consumer_service.app_common import settings, metrics
 from consumer_service.app_common.messaging import consumer_service_messaging, \
-    CREATE_ORDER_SAGA_RESPONSE_QUEUE
+    create_order_saga_response_queue
 from consumer_service.app_common.messaging.consumer_service_messaging import \
     verify_consumer_details_message
+from consumer_service.app_common.messaging.codec import configure_wire_format, decode_payload
+from consumer_service.app_common.messaging.saga_handlers import saga_step_handler
+from consumer_service.app_common.simulation import simulated, configure_simulated_worker
+from consumer_service.app_common.structured_logging import setup_logging, setup_celery_logging
 
-logging.basicConfig(level=logging.DEBUG)
+setup_logging()
+setup_celery_logging()
 
 command_handlers_celery_app = Celery(
     'consumer_command_handlers',
     broker=settings.CELERY_BROKER)
 command_handlers_celery_app.conf.task_default_queue = consumer_service_messaging.COMMANDS_QUEUE
+configure_wire_format(command_handlers_celery_app)
+configure_simulated_worker(command_handlers_celery_app, 'consumer_service')
 
 
-@command_handlers_celery_app.task(bind=True, name=verify_consumer_details_message.TASK_NAME)
-@saga_step_handler(response_queue=CREATE_ORDER_SAGA_RESPONSE_QUEUE)
-def verify_consumer_details_task(self: Task, saga_id: int, payload: dict) -> typing.Union[dict, None]:
-    request_data = verify_consumer_details_message.Payload(**payload)
+@simulated(verify_consumer_details_message.TASK_NAME)
+def verify_consumer_details(saga_id: int, payload: dict) -> typing.Union[dict, None]:
+    request_data = decode_payload(verify_consumer_details_message.TASK_NAME, payload)  # type: verify_consumer_details_message.Payload
 
     # emulate an error if consumer_id is less than 50
     if request_data.consumer_id < 50:
@@ -30,4 +34,12 @@ def verify_consumer_details_task(self: Task, saga_id: int, payload: dict) -> typ
     return None  # nothing to return
 
 
+@command_handlers_celery_app.task(bind=True, name=verify_consumer_details_message.TASK_NAME)
+@saga_step_handler(response_queue=create_order_saga_response_queue)
+def verify_consumer_details_task(self: Task, saga_id: int, payload: dict) -> typing.Union[dict, None]:
+    return verify_consumer_details(saga_id, payload)
+
 
+# e.g. outcomes of simulated commands
+if os.getenv('WORKER_METRICS_PORT'):
+    metrics.start_http_server(int(os.getenv('WORKER_METRICS_PORT')))
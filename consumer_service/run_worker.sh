@@ -1 +1,5 @@
-PYTHONPATH=. celery -A consumer_service.worker worker --loglevel=INFO
\ No newline at end of file
+if [ "$BATCH_MODE" = "1" ]; then
+  PYTHONPATH=. python -m consumer_service.batch_worker
+else
+  PYTHONPATH=. celery -A consumer_service.worker worker --loglevel=INFO
+fi
\ No newline at end of file
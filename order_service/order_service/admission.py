@@ -0,0 +1,168 @@
+"""
+Admission control for saga creation: new orders are rejected (HTTP 429 with Retry-After)
+ while too many sagas are in flight or step handler services are behind on their command queues,
+ so a slow downstream service doesn't make backlog of started sagas grow without bound.
+
+The check itself doesn't query DB or broker. Number of in-flight sagas is an in-memory estimate:
+ count of unfinished sagas read from DB (at most once per ADMISSION_REFRESH_INTERVAL_SECONDS)
+ plus sagas admitted by this process since then. The count is summed from saga status counters (see stats.py),
+ not counted over saga states, so refresh costs the same however many sagas there are. Command queue depths are read from broker on refresh as well.
+Each web process refreshes the estimate itself, so sagas admitted by other processes are seen after refresh.
+
+Limits (0 disables the check):
+ * MAX_IN_FLIGHT_SAGAS
+ * MAX_COMMANDS_QUEUE_DEPTH - for each step handler service command queue
+
+Usage:
+    admission_controller.refresh_if_needed()  # in a thread where DB can be queried
+    admission_controller.admit()  # raises AdmissionRejected
+    admission_controller.release()  # if admitted saga wasn't created after all
+"""
+import logging
+import math
+import os
+import threading
+import time
+import typing
+
+from order_service.app_common import metrics
+from order_service.app_common.messaging import consumer_service_messaging, \
+    restaurant_service_messaging, accounting_service_messaging
+from order_service.create_order_saga import main_celery_app
+from order_service.models import TERMINAL_SAGA_STATUSES, RESERVED_SAGA_STATUS
+from order_service.stats import stats_counters, SAGAS_BY_STATUS
+
+logger = logging.getLogger(__name__)
+
+MAX_IN_FLIGHT_SAGAS = int(os.getenv('MAX_IN_FLIGHT_SAGAS', 0))
+MAX_COMMANDS_QUEUE_DEPTH = int(os.getenv('MAX_COMMANDS_QUEUE_DEPTH', 0))
+ADMISSION_REFRESH_INTERVAL_SECONDS = float(os.getenv('ADMISSION_REFRESH_INTERVAL_SECONDS', 1))
+
+COMMANDS_QUEUES = [
+    consumer_service_messaging.COMMANDS_QUEUE,
+    restaurant_service_messaging.COMMANDS_QUEUE,
+    accounting_service_messaging.COMMANDS_QUEUE,
+]
+
+orders_rejected = metrics.Counter(
+    'order_admission_rejected_total',
+    'Orders rejected by admission control, by reason (in_flight_sagas, commands_queue_depth)',
+    labelnames=['reason'])
+in_flight_sagas = metrics.Gauge(
+    'order_admission_in_flight_sagas',
+    'Estimated number of unfinished sagas, as seen by admission control')
+commands_queue_depth = metrics.Gauge(
+    'order_admission_commands_queue_depth',
+    'Number of messages in step handler service command queue, as of last admission control refresh',
+    labelnames=['queue'])
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def count_in_flight_sagas() -> int:
+    return stats_counters.count_excluding(SAGAS_BY_STATUS, TERMINAL_SAGA_STATUSES + (RESERVED_SAGA_STATUS,))
+
+
+def get_commands_queue_depths(queues: typing.List[str] = COMMANDS_QUEUES) -> typing.Dict[str, int]:
+    depths = {}
+    with main_celery_app.connection_for_read() as connection:
+        channel = connection.default_channel
+        for queue in queues:
+            try:
+                depths[queue] = channel.queue_declare(queue=queue, passive=True).message_count
+            except Exception:
+                # queue isn't declared yet (no worker has started) - nothing is waiting in it then
+                logger.debug('Failed to get depth of %s queue', queue, exc_info=True)
+                depths[queue] = 0
+                channel = connection.channel()  # channel is closed by broker on error
+
+    return depths
+
+
+class AdmissionController:
+    def __init__(self, max_in_flight_sagas: int = MAX_IN_FLIGHT_SAGAS,
+                 max_commands_queue_depth: int = MAX_COMMANDS_QUEUE_DEPTH,
+                 refresh_interval: float = ADMISSION_REFRESH_INTERVAL_SECONDS):
+        self.max_in_flight_sagas = max_in_flight_sagas
+        self.max_commands_queue_depth = max_commands_queue_depth
+        self.refresh_interval = refresh_interval
+        # clients are asked to come back after the next refresh
+        self.retry_after = max(1, math.ceil(refresh_interval))
+
+        self.in_flight_sagas = 0
+        self.commands_queue_depths = {}  # type: typing.Dict[str, int]
+        self._refreshed_at = None  # type: typing.Optional[float]
+        self._refresh_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_in_flight_sagas or self.max_commands_queue_depth)
+
+    @property
+    def needs_refresh(self) -> bool:
+        return self.enabled and (self._refreshed_at is None
+                                 or time.monotonic() - self._refreshed_at >= self.refresh_interval)
+
+    def refresh(self):
+        # one refresh at a time: others go on with the current estimate
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+
+        try:
+            in_flight_sagas_count = count_in_flight_sagas() if self.max_in_flight_sagas else 0
+            depths = get_commands_queue_depths() if self.max_commands_queue_depth else {}
+            with self._lock:
+                self.in_flight_sagas = in_flight_sagas_count
+                self.commands_queue_depths = depths
+                self._refreshed_at = time.monotonic()
+            for queue, depth in depths.items():
+                commands_queue_depth.set(depth, queue=queue)
+        finally:
+            self._refresh_lock.release()
+
+    def refresh_if_needed(self):
+        if self.needs_refresh:
+            try:
+                self.refresh()
+            except Exception:
+                # keep admitting by the last known estimate
+                logger.exception('Failed to refresh admission control state')
+
+    def admit(self, count: int = 1):
+        """
+        Reserves room for `count` new sagas or raises AdmissionRejected
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            if self.max_in_flight_sagas and self.in_flight_sagas + count > self.max_in_flight_sagas:
+                orders_rejected.inc(count, reason='in_flight_sagas')
+                raise AdmissionRejected(f'Too many orders are being processed ({self.in_flight_sagas}), '
+                                        f'try again later', self.retry_after)
+
+            if self.max_commands_queue_depth and any(depth > self.max_commands_queue_depth
+                                                     for depth in self.commands_queue_depths.values()):
+                orders_rejected.inc(count, reason='commands_queue_depth')
+                raise AdmissionRejected('Order processing is behind, try again later', self.retry_after)
+
+            self.in_flight_sagas += count
+
+    def release(self, count: int = 1):
+        """
+        Gives back room reserved by admit() for `count` sagas that weren't created after all
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self.in_flight_sagas = max(self.in_flight_sagas - count, 0)
+
+
+admission_controller = AdmissionController()
+in_flight_sagas.set_function(lambda: admission_controller.in_flight_sagas)
@@ -1,106 +1,51 @@
+import contextlib
 import datetime
-import enum
 import logging
 import os
 import random
-from dataclasses import asdict
-
-from celery import Celery
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from saga_framework import SyncStep, \
-    AsyncStep, BaseStep, AbstractSagaStateRepository, StatefulSaga
-from sqlalchemy_mixins import AllFeaturesMixin, TimestampsMixin
-
-from order_service.app_common import settings
-from order_service.app_common.messaging import consumer_service_messaging, \
-    accounting_service_messaging, restaurant_service_messaging
-from order_service.app_common.messaging.accounting_service_messaging import \
-    authorize_card_message
-from order_service.app_common.messaging.consumer_service_messaging import \
-    verify_consumer_details_message
-from order_service.app_common.messaging.restaurant_service_messaging import \
-    create_ticket_message, reject_ticket_message, approve_ticket_message
-
-logging.basicConfig(level=logging.DEBUG)
-
-main_celery_app = Celery('my_celery_app', broker=settings.CELERY_BROKER)
-
-app = Flask(__name__)
-
-current_dir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('APP_SQLALCHEMY_DATABASE_URI',
-                                                  f"sqlite:///{current_dir}/order_service.sqlite")
-
-db = SQLAlchemy(app, session_options={'autocommit': True})
-
-
-class OrderStatuses(enum.Enum):
-    PENDING_VALIDATION = 'pending_validation'
-    APPROVED = 'approved'
-    REJECTED = 'rejected'
-
-
-class BaseModel(db.Model, AllFeaturesMixin):
-    __abstract__ = True
-    pass
-
-
-class Order(BaseModel):
-    id = db.Column(db.Integer, primary_key=True)
-    status = db.Column(db.Enum(OrderStatuses),
-                       default=OrderStatuses.PENDING_VALIDATION)
-    consumer_id = db.Column(db.Integer)
-    card_id = db.Column(db.Integer)
-    price = db.Column(db.Integer)
-
-    items = db.relationship("OrderItem", backref="order")
-
-    transaction_id = db.Column(db.String)
-    restaurant_ticket_id = db.Column(db.Integer)
-
-
-class OrderItem(BaseModel):
-    id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'))
-    name = db.Column(db.String)
-    quantity = db.Column(db.Integer)
-
-
-class CreateOrderSagaState(BaseModel, TimestampsMixin):
-    id = db.Column(db.Integer, primary_key=True)
-    last_message_id = db.Column(db.String)
-
-    status = db.Column(db.String, default='not_started')
-    failed_step = db.Column(db.String)
-    failed_at = db.Column(db.TIMESTAMP)
-    failure_details = db.Column(db.JSON)
-
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'))
-    order = db.relationship("Order")
-
-
-BaseModel.set_session(db.session)
-db.create_all()  # "run migrations"
-
+import threading
+import time
+import typing
+
+import click
+from flask import request, jsonify, abort, Response, stream_with_context
+from sqlalchemy import func, insert
+
+from order_service.admission import admission_controller, AdmissionRejected
+from order_service.app_common import metrics
+from order_service import queries
+from order_service.stats import stats_counters, SAGAS_BY_STATUS
+from order_service.outbox import OUTBOX_ENABLED, OUTBOX_RELAY_BATCH_SIZE, OUTBOX_RELAY_POLL_INTERVAL_SECONDS, \
+    OutboxRelay, outbox_transaction
+from order_service.app_common.structured_logging import setup_logging
+from order_service.models import app, db, create_schema, Order, OrderItem, \
+    CreateOrderSagaState, CreateOrderSagaStateArchive, CreateOrderSagaStepEvent, ProcessedSagaResponse, \
+    TERMINAL_SAGA_STATUSES, RESERVED_SAGA_STATUS, StatsCounter, transaction
+from order_service.create_order_saga import main_celery_app, producer_pool, CreateOrderSaga, \
+    create_saga_state_repository, QUANTITY_THAT_WILL_MAKE_ORCHESTRATOR_FAIL
+
+setup_logging()
+logger = logging.getLogger(__name__)
 
 @app.route('/ping')
 def ping():
     return 'ping response'
 
 
-BASE_INPUT_DATA = dict(
-    items=[
-        OrderItem(
-           name='Dish 1',
-           quantity=random.randint(1, 5)
-        ),
-        OrderItem(
-            name='Dish 2',
-            quantity=random.randint(1, 5)
-        )
-    ]
-)
+def _base_input_data():
+    # items are created for each order: OrderItem instance can belong to one order only
+    return dict(
+        items=[
+            OrderItem(
+               name='Dish 1',
+               quantity=random.randint(1, 5)
+            ),
+            OrderItem(
+                name='Dish 2',
+                quantity=random.randint(1, 5)
+            )
+        ]
+    )
 
 # magic numbers that make consumer_service succeed or fail
 CONSUMER_ID_THAT_WILL_SUCCEED = 70
@@ -110,19 +55,147 @@ CONSUMER_ID_THAT_WILL_FAIL = 10
 PRICE_THAT_WILL_SUCCEED = 20
 PRICE_THAT_WILL_FAIL = 80
 
-QUANTITY_THAT_WILL_MAKE_ORCHESTRATOR_FAIL = 100500
+MAX_SAGAS_IN_BULK = int(os.getenv('MAX_SAGAS_IN_BULK', 1000))
 
 
-def _run_saga(input_data):
-    order = Order.create(**input_data)
-    saga_state = CreateOrderSagaState.create(order_id=order.id)
-    saga_state_repository = CreateOrderSagaRepository()
+def _admit_sagas(count: int = 1):
+    # raises AdmissionRejected, see on_admission_rejected
+    admission_controller.refresh_if_needed()
+    admission_controller.admit(count)
+
+
+@app.errorhandler(AdmissionRejected)
+def on_admission_rejected(exc: AdmissionRejected):
+    return str(exc), 429, {'Retry-After': str(exc.retry_after)}
+
 
-    CreateOrderSaga(saga_state_repository, main_celery_app, saga_state.id).execute()
-    return f'Scheduled saga #{saga_state.id}. ' \
+def _run_saga(input_data):
+    _admit_sagas()
+    saga_id = None
+    try:
+        # with outbox, saga is created and started in one transaction
+        with outbox_transaction():
+            order = Order.create(**input_data)
+            saga_id = CreateOrderSagaState.create(order_id=order.id).id
+            saga_state_repository = create_saga_state_repository()
+
+            CreateOrderSaga(saga_state_repository, main_celery_app, saga_id).execute()
+    except Exception:
+        if OUTBOX_ENABLED or saga_id is None:  # saga wasn't created: its transaction was rolled back
+            admission_controller.release()
+        raise
+    return f'Scheduled saga #{saga_id}. ' \
            f'See its progress in order_service worker'
 
 
+def _input_data_from_json(order_json: dict) -> dict:
+    """
+    Converts order JSON like
+      {"consumer_id": 70, "price": 20, "card_id": 1,
+       "items": [{"name": "Dish 1", "quantity": 2}]}
+    to the input data accepted by _run_saga.
+    Raises ValueError if order is incorrect: price is negative, there are no items,
+     or some item quantity isn't positive
+    """
+    if not isinstance(order_json, dict) \
+            or not isinstance(order_json.get('items'), list) \
+            or not all(isinstance(item, dict) for item in order_json['items']):
+        raise ValueError('Incorrect order data: object with "items" list of objects expected')
+
+    try:
+        input_data = dict(
+            consumer_id=int(order_json['consumer_id']),
+            price=int(order_json['price']),
+            card_id=int(order_json['card_id']),
+            items=[
+                OrderItem(name=str(item['name']),
+                          quantity=int(item['quantity']))
+                for item in order_json['items']
+            ]
+        )
+    except (KeyError, TypeError, ValueError) as exc:
+        raise ValueError(f'Incorrect order data: {exc!r}') from exc
+
+    if not input_data['items']:
+        raise ValueError('Incorrect order data: order has no items')
+    if input_data['price'] < 0:
+        raise ValueError(f'Incorrect order data: negative price {input_data["price"]}')
+    for item in input_data['items']:
+        if item.quantity < 1:
+            raise ValueError(f'Incorrect order data: quantity of {item.name!r} is {item.quantity}')
+    return input_data
+
+
+def _run_sagas_in_bulk(input_data_list: list) -> typing.List[dict]:
+    """
+    Same as _run_saga, but for many orders at once:
+     * orders, order items and saga states are inserted in a single transaction
+       (one flush, so SQLAlchemy batches INSERTs per table)
+     * first-step commands for all sagas are published over one broker connection
+       (with outbox, they are written to outbox in the same transaction as orders and saga states)
+    Returns result of each saga: {"saga_id": 1, "status": "started"}.
+    Without outbox, sagas are started one by one after their transaction is committed:
+     saga that fails to start (e.g. its command isn't published) is failed, {"status": "failed", "error": ...},
+     and the rest are still started
+    """
+    _admit_sagas(len(input_data_list))
+    saga_ids = None
+    results = []
+    try:
+        with outbox_transaction():
+            with transaction():
+                saga_states = [CreateOrderSagaState(order=Order(**input_data))
+                               for input_data in input_data_list]
+                db.session.add_all(saga_states)
+                db.session.flush()
+                # read ids before commit, otherwise each access would refresh an expired instance
+                saga_ids = [saga_state.id for saga_state in saga_states]
+
+            saga_state_repository = create_saga_state_repository()
+            with (contextlib.nullcontext() if OUTBOX_ENABLED else producer_pool.acquire()) as producer:
+                for saga_id in saga_ids:
+                    saga = CreateOrderSaga(saga_state_repository, main_celery_app, saga_id)
+                    saga.producer = producer
+                    try:
+                        saga.execute()
+                    except Exception as exc:
+                        if OUTBOX_ENABLED:
+                            raise
+                        results.append(_fail_unstarted_saga(saga_id, exc))
+                    else:
+                        results.append(dict(saga_id=saga_id, status='started'))
+    except Exception as exc:
+        if OUTBOX_ENABLED or saga_ids is None:  # sagas weren't created: their transaction was rolled back
+            admission_controller.release(len(input_data_list))
+            raise
+        # e.g. no broker connection for any of them
+        results += [_fail_unstarted_saga(saga_id, exc) for saga_id in saga_ids[len(results):]]
+
+    return results
+
+
+def _fail_unstarted_saga(saga_id: int, exc: Exception) -> dict:
+    """
+    Fails saga that's still not started after its start failed, so it isn't left unfinished:
+     timeout sweeper only picks up sagas waiting for a step response
+    """
+    logger.error('Failed to start saga #%s', saga_id, exc_info=exc)
+    try:
+        db.session.rollback()
+        failed = fail_sagas(CreateOrderSagaState.id == saga_id, status='not_started',
+                            failure_type='SagaNotStarted', error=f'Saga was not started: {exc!r}')
+    except Exception:
+        # it stays not started
+        logger.exception('Failed to mark saga #%s as failed', saga_id)
+        return dict(saga_id=saga_id, status='not_started', error=repr(exc))
+    if not failed:
+        # its first step was started after all, so it's finished by orchestrator or timeout sweeper
+        return dict(saga_id=saga_id, status='started')
+
+    admission_controller.release()
+    return dict(saga_id=saga_id, status='failed', error=repr(exc))
+
+
 @app.route('/')
 def welcome_page():
     return '''
@@ -134,7 +207,9 @@ def welcome_page():
       <li><a href="/run-saga-failing-on-consumer-verification-because-of-incorrect-id">/run-saga-failing-on-consumer-verification-because-of-incorrect-id</a></li>
       <li><a href="/run-saga-where-orchestrator-code-fails">/run-saga-where-orchestrator-code-fails</a></li>
       <li><a href="/run-saga-failing-on-card-authorization">/run-saga-failing-on-card-authorization</a></li>
+      <li><a href="/run-random-sagas-in-bulk?count=10">/run-random-sagas-in-bulk?count=10</a></li>
     </ul>
+    To start many sagas at once, POST orders to <code>/run-sagas-in-bulk</code>
     '''
 
 
@@ -142,7 +217,7 @@ def welcome_page():
 def run_random_saga():
     # it will randomly pass or fail
     return _run_saga(input_data=dict(
-        **BASE_INPUT_DATA,
+        **_base_input_data(),
         consumer_id=random.randint(1, 100),
         price=random.randint(1, 100),
         card_id=random.randint(1, 5)
@@ -153,7 +228,7 @@ def run_random_saga():
 def run_success_saga():
     # it should succeed
     return _run_saga(input_data=dict(
-        **BASE_INPUT_DATA,
+        **_base_input_data(),
         consumer_id=CONSUMER_ID_THAT_WILL_SUCCEED,
         price=PRICE_THAT_WILL_SUCCEED,
         card_id=random.randint(1, 5)
@@ -164,7 +239,7 @@ def run_success_saga():
 def run_saga_failing_on_consumer_verification_incorrect_id():
     # it should fail on consumer verification stage
     return _run_saga(input_data=dict(
-        **BASE_INPUT_DATA,
+        **_base_input_data(),
         consumer_id=CONSUMER_ID_THAT_WILL_FAIL,
         price=PRICE_THAT_WILL_SUCCEED,
         card_id=random.randint(1, 5)
@@ -192,217 +267,433 @@ def run_saga_where_orchestrator_code_fails():
 def run_saga_failing_on_card_authorization():
     # it should fail on card authorization stage
     return _run_saga(input_data=dict(
-        **BASE_INPUT_DATA,
+        **_base_input_data(),
         consumer_id=CONSUMER_ID_THAT_WILL_SUCCEED,
         price=PRICE_THAT_WILL_FAIL,
         card_id=random.randint(1, 5)
     ))
 
 
-class CreateOrderSagaRepository(AbstractSagaStateRepository):
-    def get_saga_state_by_id(self, saga_id: int) -> CreateOrderSagaState:
-        return CreateOrderSagaState.find(saga_id)
-
-    def update_status(self, saga_id: int, status: str) -> CreateOrderSagaState:
-        return self.get_saga_state_by_id(saga_id).update(status=status)
-
-    def update(self, saga_id: int, **fields_to_update: str) -> object:
-        return self.get_saga_state_by_id(saga_id).update(**fields_to_update)
-
-    def on_step_failure(self, saga_id: int, failed_step: BaseStep, initial_failure_payload: dict) -> object:
-        return self.get_saga_state_by_id(saga_id).update(
-            failed_step=failed_step.name,
-            failed_at=datetime.datetime.utcnow(),
-            failure_details=initial_failure_payload
-        )
-
-
-class CreateOrderSaga(StatefulSaga):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        self.steps = [
-            SyncStep(
-                name='reject_order',
-                compensation=self.reject_order
-            ),
-            AsyncStep(
-                name='verify_consumer_details',
-                action=self.verify_consumer_details,
-
-                base_task_name=verify_consumer_details_message.TASK_NAME,
-                queue=consumer_service_messaging.COMMANDS_QUEUE,
-
-                on_success=self.verify_consumer_details_on_success,
-                on_failure=self.verify_consumer_details_on_failure
-            ),
-
-            AsyncStep(
-                name='create_restaurant_ticket',
-                action=self.create_restaurant_ticket,
-                compensation=self.reject_restaurant_ticket,
-
-                base_task_name=create_ticket_message.TASK_NAME,
-                queue=restaurant_service_messaging.COMMANDS_QUEUE,
-
-                on_success=self.create_restaurant_ticket_on_success,
-                on_failure=self.create_restaurant_ticket_on_failure
-            ),
-
-            AsyncStep(
-                name='authorize_card',
-                action=self.authorize_card,
-
-                base_task_name=authorize_card_message.TASK_NAME,
-                queue=accounting_service_messaging.COMMANDS_QUEUE,
-
-                on_success=self.authorize_card_on_success,
-                on_failure=self.authorize_card_on_failure
-            ),
-
-            AsyncStep(
-                name='approve_restaurant_ticket',
-                action=self.approve_restaurant_ticket,
-
-                base_task_name=approve_ticket_message.TASK_NAME,
-                queue=restaurant_service_messaging.COMMANDS_QUEUE,
-
-                on_success=self.approve_restaurant_ticket_on_success,
-                on_failure=self.approve_restaurant_ticket_on_failure
-            ),
-
-            SyncStep(
-                name='approve_order',
-                action=self.approve_order
-            )
-        ]
-
-    def verify_consumer_details(self, current_step: AsyncStep):
-        logging.info(f'Verifying consumer #{self.saga_state.order.consumer_id} ...')
-
-        message_id = self.send_message_to_other_service(
-            current_step,
-            asdict(
-                verify_consumer_details_message.Payload(
-                    consumer_id=self.saga_state.order.consumer_id
-                )
-            )
+@app.route('/run-sagas-in-bulk', methods=['POST'])
+def run_sagas_in_bulk():
+    # expects JSON like {"orders": [{"consumer_id": 70, "price": 20, "card_id": 1,
+    #                                "items": [{"name": "Dish 1", "quantity": 2}]}, ...]}
+    request_json = request.get_json(silent=True)
+    orders_json = request_json.get('orders') if isinstance(request_json, dict) else None
+    if not isinstance(orders_json, list) or not orders_json:
+        abort(400, 'Non-empty "orders" list expected')
+    if len(orders_json) > MAX_SAGAS_IN_BULK:
+        abort(400, f'At most {MAX_SAGAS_IN_BULK} orders can be submitted at once')
+
+    try:
+        input_data_list = [_input_data_from_json(order_json) for order_json in orders_json]
+    except ValueError as exc:
+        abort(400, str(exc))
+
+    results = _run_sagas_in_bulk(input_data_list)
+    return jsonify(saga_ids=[result['saga_id'] for result in results], sagas=results)
+
+
+def _stream_page(build_query, serialize) -> Response:
+    try:
+        query = build_query(request.args)
+        limit = queries.parse_page_size(request.args)
+    except ValueError as exc:
+        abort(400, str(exc))
+
+    return Response(stream_with_context(queries.stream_page(query, limit, serialize)),
+                    mimetype='application/json')
+
+
+@app.route('/sagas')
+def list_sagas():
+    # e.g. /sagas?status=failed&failed_step=authorize_card&created_from=2021-01-01T00:00:00&limit=100,
+    #  then /sagas?...&cursor=<next_cursor of previous page>. See queries.sagas_query
+    return _stream_page(queries.sagas_query, queries.serialize_saga)
+
+
+@app.route('/sagas/<int:saga_id>')
+def get_saga(saga_id: int):
+    # e.g. to see what became of an order submitted to async ingress (see asgi.py)
+    saga = queries.get_saga(saga_id)
+    if saga is None:
+        abort(404, f'Saga #{saga_id} not found')
+    return jsonify(saga)
+
+
+@app.route('/orders')
+def list_orders():
+    # e.g. /orders?status=rejected&consumer_id=10&limit=100. See queries.orders_query
+    return _stream_page(queries.orders_query, queries.serialize_order)
+
+
+@app.route('/stats')
+def stats():
+    # numbers of orders by status and sagas by status and failed step, from counters (see stats.py)
+    return jsonify(stats_counters.read())
+
+
+step_response_seconds = metrics.Histogram(
+    'create_order_saga_step_response_seconds',
+    'Time from sending step command till its response is received by orchestrator',
+    labelnames=['step', 'outcome'])
+step_handler_seconds = metrics.Histogram(
+    'create_order_saga_step_handler_seconds',
+    'Duration of step on_success / on_failure handler',
+    labelnames=['step', 'outcome'])
+
+
+class StepEventsAggregator:
+    """
+    Folds step events into histograms.
+    Each refresh reads only events added since previous refresh (by primary key),
+     so the table is never scanned as a whole.
+    Event ids are taken when events are inserted, so an event may be committed after events with greater ids.
+    Ids skipped by a refresh are re-read by next refreshes for `late_commit_seconds`
+     (ids of rolled back transactions are never committed and are dropped then).
+    As usual for Prometheus metrics, histograms start empty when process starts
+     (events written before the first refresh are skipped).
+    """
+    batch_size = 1000
+    late_commit_seconds = 60
+
+    def __init__(self):
+        self._last_seen_id = None
+        self._skipped_ids = {}  # event id -> time.monotonic() when it was skipped
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        with self._lock:
+            if self._last_seen_id is None:
+                self._last_seen_id = db.session.query(func.max(CreateOrderSagaStepEvent.id)).scalar() or 0
+                return
+
+            self._read_skipped_events()
+            while True:
+                events = self._query_events() \
+                    .filter(CreateOrderSagaStepEvent.id > self._last_seen_id) \
+                    .order_by(CreateOrderSagaStepEvent.id) \
+                    .limit(self.batch_size) \
+                    .all()
+
+                skipped_at = time.monotonic()
+                for event in events:
+                    self._skipped_ids.update((event_id, skipped_at)
+                                             for event_id in range(self._last_seen_id + 1, event.id))
+                    self._last_seen_id = event.id
+                    self._observe(event)
+
+                if len(events) < self.batch_size:
+                    return
+
+    def _read_skipped_events(self):
+        expired_before = time.monotonic() - self.late_commit_seconds
+        self._skipped_ids = {event_id: skipped_at for event_id, skipped_at in self._skipped_ids.items()
+                             if skipped_at >= expired_before}
+        skipped_ids = sorted(self._skipped_ids)
+        for chunk_start in range(0, len(skipped_ids), self.batch_size):
+            events = self._query_events() \
+                .filter(CreateOrderSagaStepEvent.id.in_(skipped_ids[chunk_start:chunk_start + self.batch_size])) \
+                .all()
+            for event in events:
+                del self._skipped_ids[event.id]
+                self._observe(event)
+
+    @staticmethod
+    def _query_events():
+        return db.session.query(
+            CreateOrderSagaStepEvent.id,
+            CreateOrderSagaStepEvent.step,
+            CreateOrderSagaStepEvent.outcome,
+            CreateOrderSagaStepEvent.command_sent_at,
+            CreateOrderSagaStepEvent.response_received_at,
+            CreateOrderSagaStepEvent.handler_duration_ms,
         )
 
-        self.saga_state_repository.update(self.saga_id, last_message_id=message_id)
-
-    def verify_consumer_details_on_success(self, step: BaseStep, payload: dict):
-        logging.info(f'Consumer #{self.saga_state.order.consumer_id} verification succeeded')
-        logging.info(f'result = {payload}')
-
-    def verify_consumer_details_on_failure(self, step: BaseStep, payload: dict):
-        logging.info(f'Consumer #{self.saga_state.order.consumer_id} verification failed')
-        logging.info(f'result = {payload}')
-
-    def reject_order(self, step: BaseStep):
-        self.saga_state.order.update(status=OrderStatuses.REJECTED)
-        logging.info(f'Compensation: order {self.saga_state.order.id} rejected')
-
-    def create_restaurant_ticket(self, current_step: AsyncStep):
-        logging.info(f'Creating restaurant ticket for saga {self.saga_id} ...')
-
-        # emulating saga step failure on ORCHESTRATOR side
-        if self.saga_state.order.items[0].quantity == QUANTITY_THAT_WILL_MAKE_ORCHESTRATOR_FAIL:
-            raise KeyError('Incorrect quantity')
-
-        message_id = self.send_message_to_other_service(
-            current_step,
-            asdict(
-                create_ticket_message.Payload(
-                    order_id=self.saga_state.order.id,
-                    customer_id=self.saga_state.order.consumer_id,
-                    items=[
-                        create_ticket_message.OrderItem(
-                            name=item.name,
-                            quantity=item.quantity
-                        )
-                        for item in self.saga_state.order.items
-                    ]
-                )
-            )
-        )
+    @staticmethod
+    def _observe(event):
+        if event.command_sent_at and event.response_received_at:
+            step_response_seconds.observe(
+                (event.response_received_at - event.command_sent_at).total_seconds(),
+                step=event.step, outcome=event.outcome)
+        step_handler_seconds.observe(event.handler_duration_ms / 1000,
+                                     step=event.step, outcome=event.outcome)
 
-        self.saga_state_repository.update(self.saga_id, last_message_id=message_id)
 
-    def create_restaurant_ticket_on_success(self, step: BaseStep, payload: dict):
-        response = create_ticket_message.Response(**payload)
-        logging.info(f'Restaurant ticket # {response.ticket_id} created')
+step_events_aggregator = StepEventsAggregator()
 
-        self.saga_state.order.update(restaurant_ticket_id=response.ticket_id)
 
-    def create_restaurant_ticket_on_failure(self, step: BaseStep, payload: dict):
-        logging.info(f'Restaurant ticket creation for saga {self.saga_id} failed: \n'
-                     f'{payload}')
+@app.route('/metrics')
+def prometheus_metrics():
+    step_events_aggregator.refresh()
+    return metrics.render_prometheus(), 200, {'Content-Type': metrics.CONTENT_TYPE}
 
-    def reject_restaurant_ticket(self, current_step: AsyncStep):
-        logging.info(f'Compensation: rejecting restaurant ticket #{self.saga_state.order.restaurant_ticket_id} ...')
 
-        message_id = self.send_message_to_other_service(
-            current_step,
-            asdict(
-                reject_ticket_message.Payload(
-                    ticket_id=self.saga_state.order.restaurant_ticket_id
-                )
-            ),
-            # in compensation, it's needed to explicitly set Celery task name
-            task_name=reject_ticket_message.TASK_NAME
+@app.route('/run-random-sagas-in-bulk')
+def run_random_sagas_in_bulk():
+    # it will randomly pass or fail
+    count = min(request.args.get('count', 10, type=int), MAX_SAGAS_IN_BULK)
+    results = _run_sagas_in_bulk([
+        dict(
+            **_base_input_data(),
+            consumer_id=random.randint(1, 100),
+            price=random.randint(1, 100),
+            card_id=random.randint(1, 5)
         )
-
-        self.saga_state_repository.update(self.saga_id, last_message_id=message_id)
-
-    def authorize_card(self, current_step: AsyncStep):
-        logging.info(f'Authorizing card for saga {self.saga_id} (amount={self.saga_state.order.price} ...')
-
-        message_id = self.send_message_to_other_service(
-            current_step,
-            asdict(
-                authorize_card_message.Payload(
-                    card_id=self.saga_state.order.card_id,
-                    amount=self.saga_state.order.price
+        for _ in range(count)
+    ])
+    return jsonify(saga_ids=[result['saga_id'] for result in results], sagas=results)
+
+
+SAGA_ARCHIVE_RETENTION_DAYS = float(os.getenv('SAGA_ARCHIVE_RETENTION_DAYS', 7))
+SAGA_ARCHIVE_BATCH_SIZE = int(os.getenv('SAGA_ARCHIVE_BATCH_SIZE', 500))
+
+
+def archive_finished_sagas(retention: datetime.timedelta, batch_size: int = SAGA_ARCHIVE_BATCH_SIZE,
+                           max_batches: int = None) -> int:
+    """
+    Moves sagas that finished (succeeded or failed) more than `retention` ago to archive table.
+    Each batch of at most `batch_size` sagas is moved in its own short transaction,
+     so rows are never locked for long and orchestrator isn't blocked.
+    Returns number of archived sagas
+    """
+    archived_at = datetime.datetime.utcnow()
+    updated_before = archived_at - retention
+    archived_columns = [column.name for column in CreateOrderSagaStateArchive.__table__.columns
+                        if column.name != 'archived_at']
+
+    archived_count = 0
+    batches_count = 0
+    # one status at a time: (status, updated_at) index then gives rows in updated_at order
+    for status in TERMINAL_SAGA_STATUSES:
+        while max_batches is None or batches_count < max_batches:
+            with db.session.begin():
+                saga_ids = [saga_id for saga_id, in db.session.query(CreateOrderSagaState.id)
+                            .filter(CreateOrderSagaState.status == status,
+                                    CreateOrderSagaState.updated_at < updated_before)
+                            .order_by(CreateOrderSagaState.updated_at)
+                            .limit(batch_size)
+                            # rows locked by another archiver are left for it
+                            .with_for_update(skip_locked=True)]
+                if not saga_ids:
+                    break
+
+                source_table = CreateOrderSagaState.__table__
+                db.session.execute(
+                    insert(CreateOrderSagaStateArchive.__table__).from_select(
+                        archived_columns + ['archived_at'],
+                        db.select([source_table.c[name] for name in archived_columns]
+                                  + [db.literal(archived_at).label('archived_at')])
+                        .where(source_table.c.id.in_(saga_ids))
+                    )
                 )
-            )
-        )
-
-        self.saga_state_repository.update(self.saga_id, last_message_id=message_id)
-
-    def authorize_card_on_success(self, step: BaseStep, payload: dict):
-        response = authorize_card_message.Response(**payload)
-        logging.info(f'Card authorized. Transaction ID: {response.transaction_id}')
-        self.saga_state.order.update(transaction_id=response.transaction_id)
-
-    def authorize_card_on_failure(self, step: BaseStep, payload: dict):
-        logging.info(f'Card authorization for saga {self.saga_id} failed: \n'
-                     f'{payload}')
-
-    def approve_restaurant_ticket(self, current_step: AsyncStep):
-        logging.info(f'Approving restaurant ticket #{self.saga_state.order.restaurant_ticket_id} ...')
-
-        message_id = self.send_message_to_other_service(
-            current_step,
-            asdict(
-                approve_ticket_message.Payload(
-                    ticket_id=self.saga_state.order.restaurant_ticket_id
-                )
-            )
-        )
-
-        self.saga_state_repository.update(self.saga_id, last_message_id=message_id)
-
-    def approve_restaurant_ticket_on_success(self, step: BaseStep, payload: dict):
-        logging.info(f'Restaurant ticket #{self.saga_state.order.restaurant_ticket_id} approved')
-
-    def approve_restaurant_ticket_on_failure(self, step: BaseStep, payload: dict):
-        logging.info(f'Restaurant ticket #{self.saga_state.order.restaurant_ticket_id} approve failed')
-
-    def approve_order(self, step: BaseStep):
-        self.saga_state.order.update(status=OrderStatuses.APPROVED)
-        logging.info(f'Order {self.saga_state.order.id} approved')
+                db.session.execute(source_table.delete().where(source_table.c.id.in_(saga_ids)))
+                # responses to finished sagas won't be handled anyway
+                ProcessedSagaResponse.query \
+                    .filter(ProcessedSagaResponse.saga_id.in_(saga_ids)) \
+                    .delete(synchronize_session=False)
+
+            archived_count += len(saga_ids)
+            batches_count += 1
+            logger.info('Archived %s %s sagas (%s in total)', len(saga_ids), status, archived_count)
+
+    return archived_count
+
+
+@app.cli.command('archive-sagas')
+@click.option('--retention-days', type=float, default=SAGA_ARCHIVE_RETENTION_DAYS, show_default=True,
+              help='archive sagas finished more than this number of days ago')
+@click.option('--batch-size', type=int, default=SAGA_ARCHIVE_BATCH_SIZE, show_default=True)
+@click.option('--every', type=float, default=None,
+              help='keep running and archive sagas every given number of seconds')
+def archive_sagas_command(retention_days: float, batch_size: int, every: float):
+    """
+    Move finished sagas to archive table
+    """
+    while True:
+        archived_count = archive_finished_sagas(datetime.timedelta(days=retention_days), batch_size)
+        click.echo(f'Archived {archived_count} sagas')
+        if every is None:
+            return
+        time.sleep(every)
+
+
+SAGA_TIMEOUT_SWEEP_BATCH_SIZE = int(os.getenv('SAGA_TIMEOUT_SWEEP_BATCH_SIZE', 100))
+
+
+def sweep_timed_out_sagas(batch_size: int = SAGA_TIMEOUT_SWEEP_BATCH_SIZE) -> int:
+    """
+    Finds sagas whose async step has been waiting for response longer than step deadline
+     (see CreateOrderSaga.step_timeout_policies) and re-sends step command or compensates saga.
+
+    Sagas waiting for a step response have '<step>.running' status,
+     so candidates are looked up with (status, updated_at) index, in batches of `batch_size`
+     (normally, only a few sagas are stuck, so sorting candidates by id is cheap).
+    Each saga is claimed with a conditional UPDATE first,
+     so concurrent sweepers or a response that has just arrived don't make it handled twice.
+    Returns number of handled sagas
+    """
+    saga_state_repository = create_saga_state_repository()
+    handled_count = 0
+
+    for step_name, policy in CreateOrderSaga.step_timeout_policies.items():
+        status = f'{step_name}.running'
+        now = datetime.datetime.utcnow()
+        sent_before = now - policy.deadline
+        # batches are read with keyset pagination by id, so each saga is handled at most once per sweep
+        last_seen_id = 0
+        while True:
+            candidates = db.session.query(
+                CreateOrderSagaState.id,
+                CreateOrderSagaState.last_message_id,
+                CreateOrderSagaState.timeout_retries
+            ) \
+                .filter(CreateOrderSagaState.status == status,
+                        CreateOrderSagaState.updated_at < sent_before,
+                        CreateOrderSagaState.id > last_seen_id) \
+                .order_by(CreateOrderSagaState.id) \
+                .limit(batch_size) \
+                .all()
+            if candidates:
+                last_seen_id = candidates[-1].id
+
+            for saga_id, last_message_id, timeout_retries in candidates:
+                # claimed saga gets fresh updated_at, so it's not picked again by this (or other) sweep
+                claimed = CreateOrderSagaState.query \
+                    .filter_by(id=saga_id, status=status, last_message_id=last_message_id) \
+                    .filter(CreateOrderSagaState.updated_at < sent_before) \
+                    .update({CreateOrderSagaState.updated_at: now}, synchronize_session=False)
+                if not claimed:
+                    continue
+
+                saga = CreateOrderSaga(saga_state_repository, main_celery_app, saga_id)
+                try:
+                    saga.on_async_step_timeout(saga.get_step_by_name(step_name),
+                                               retry=timeout_retries < policy.retry_policy.max_retries)
+                except Exception:
+                    # saga stays claimed till next deadline, so it will be retried later
+                    logger.exception('Saga %s: failed to handle "%s" step timeout', saga_id, step_name)
+                handled_count += 1
+
+            if len(candidates) < batch_size:
+                break
+
+    return handled_count
+
+
+# saga ids reserved by async ingress (see asgi.py) and not used for this long are given up on
+RESERVED_SAGA_ID_TTL_SECONDS = float(os.getenv('RESERVED_SAGA_ID_TTL_SECONDS', 600))
+
+
+def fail_sagas(*criteria, status: str, failure_type: str, error: str) -> int:
+    """
+    Marks sagas in `status` matching `criteria` as failed, so clients that got their ids see the outcome.
+    Conditional UPDATE: sagas that moved on from `status` meanwhile aren't touched. Returns number of failed sagas
+    """
+    now = datetime.datetime.utcnow()
+    with transaction():
+        failed_count = CreateOrderSagaState.query \
+            .filter(CreateOrderSagaState.status == status, *criteria) \
+            .update(dict(status='failed', failed_at=now, updated_at=now,
+                         failure_details={'type': failure_type, 'message': error}),
+                    synchronize_session=False)
+        stats_counters.record_change(SAGAS_BY_STATUS, status, 'failed', failed_count)
+    return failed_count
+
+
+def fail_reserved_sagas(*criteria, error: str) -> int:
+    """
+    Marks reserved sagas (see asgi.py) matching `criteria` as failed, their orders were never persisted
+    """
+    return fail_sagas(*criteria, status=RESERVED_SAGA_STATUS, failure_type='OrderNotPersisted', error=error)
+
+
+def sweep_stale_reserved_sagas(ttl: datetime.timedelta = datetime.timedelta(seconds=RESERVED_SAGA_ID_TTL_SECONDS)) \
+        -> int:
+    """
+    Fails sagas whose order was never persisted: async ingress process crashed or was killed
+     after returning saga id, or reserved ids and never used them. Returns number of failed sagas
+    """
+    # reserved saga state isn't updated till it's used, so updated_at is when it was reserved: (status, updated_at) index
+    return fail_reserved_sagas(CreateOrderSagaState.updated_at < datetime.datetime.utcnow() - ttl,
+                               error=f'Order was not persisted in {ttl.total_seconds():g} seconds')
+
+
+@app.cli.command('sweep-timed-out-sagas')
+@click.option('--batch-size', type=int, default=SAGA_TIMEOUT_SWEEP_BATCH_SIZE, show_default=True)
+@click.option('--every', type=float, default=None,
+              help='keep running and sweep sagas every given number of seconds')
+def sweep_timed_out_sagas_command(batch_size: int, every: float):
+    """
+    Re-send or compensate saga steps which response didn't come in time,
+     fail sagas reserved by async ingress which order wasn't persisted in RESERVED_SAGA_ID_TTL_SECONDS
+    """
+    while True:
+        handled_count = sweep_timed_out_sagas(batch_size)
+        click.echo(f'Handled {handled_count} timed out sagas')
+        click.echo(f'Failed {sweep_stale_reserved_sagas()} stale reserved sagas')
+        if every is None:
+            return
+        time.sleep(every)
+
+
+@app.cli.command('relay-outbox')
+@click.option('--batch-size', type=int, default=OUTBOX_RELAY_BATCH_SIZE, show_default=True)
+@click.option('--poll-interval', type=float, default=OUTBOX_RELAY_POLL_INTERVAL_SECONDS, show_default=True,
+              help='seconds to wait before checking outbox again once it is empty')
+@click.option('--once', is_flag=True, help='publish messages that are in outbox now and exit')
+def relay_outbox_command(batch_size: int, poll_interval: float, once: bool):
+    """
+    Publish saga commands from outbox (see order_service.outbox)
+    """
+    if os.getenv('OUTBOX_RELAY_METRICS_PORT'):
+        metrics.start_http_server(int(os.getenv('OUTBOX_RELAY_METRICS_PORT')))
+
+    relay = OutboxRelay(main_celery_app, producer_pool, batch_size)
+    while True:
+        try:
+            published_count = relay.relay_all()
+            if published_count:
+                logger.debug('Published %s messages from outbox', published_count)
+        except Exception:
+            # messages stay in outbox and are published on next attempt
+            logger.exception('Failed to publish messages from outbox')
+        finally:
+            db.session.remove()
+
+        if once:
+            return
+        time.sleep(poll_interval)
+
+
+@app.cli.command('reconcile-stats')
+def reconcile_stats_command():
+    """
+    Rebuild order and saga counters (see order_service.stats) from orders and sagas
+    """
+    counts = stats_counters.read()
+    new_counts = stats_counters.rebuild()
+    for kind, kind_counts in new_counts.items():
+        for key in sorted(kind_counts.keys() | counts.get(kind, {}).keys()):
+            old_count, new_count = counts.get(kind, {}).get(key, 0), kind_counts.get(key, 0)
+            if old_count != new_count:
+                click.echo(f'{kind}[{key}]: {old_count} -> {new_count}')
+    click.echo('Counters are rebuilt')
+
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """
+    Creates missing tables. Run it before starting web app and workers
+    """
+    counters_existed = db.inspect(db.engine).has_table(StatsCounter.__tablename__)
+    create_schema()
+    if not counters_existed:
+        # counters are added to existing DB: count what's there already
+        stats_counters.rebuild()
+    click.echo('DB schema is up to date')
 
 
 if __name__ == '__main__':
+    create_schema()
     result = run_random_saga()
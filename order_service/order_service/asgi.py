@@ -0,0 +1,354 @@
+"""
+Non-blocking ASGI entrypoint for the order API (an alternative to Flask `app`).
+
+`POST /orders` only validates the order, takes a pre-reserved saga id and returns `202 Accepted`.
+Persisting the order and publishing the first saga command is done by a bounded background pipeline,
+ so DB and broker hiccups don't turn into HTTP latency.
+Client sees the outcome with `GET /sagas/<saga_id>`. If the order can't be persisted, its saga is failed.
+If ingress process dies before that, the saga stays reserved till the timeout sweeper fails it
+ (see app.sweep_stale_reserved_sagas). Reserved ids aren't used after half of RESERVED_SAGA_ID_TTL_SECONDS,
+ so sweeper never fails a saga that's about to be started.
+
+Run it with
+    PYTHONPATH=. uvicorn order_service.asgi:app --port 5001
+"""
+import asyncio
+import collections
+import json
+import logging
+import os
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from order_service.admission import admission_controller, AdmissionRejected
+from order_service import queries
+from order_service.app import db, main_celery_app, Order, \
+    CreateOrderSagaState, CreateOrderSaga, create_saga_state_repository, \
+    _input_data_from_json, fail_reserved_sagas, RESERVED_SAGA_ID_TTL_SECONDS
+from order_service.app_common import metrics
+from order_service.models import RESERVED_SAGA_STATUS, transaction
+from order_service.outbox import outbox_transaction
+from order_service.stats import stats_counters, SAGAS_BY_STATUS
+
+logger = logging.getLogger(__name__)
+
+ASYNC_INGRESS_CONCURRENCY = int(os.getenv('ASYNC_INGRESS_CONCURRENCY', 4))
+ASYNC_INGRESS_MAX_QUEUE_SIZE = int(os.getenv('ASYNC_INGRESS_MAX_QUEUE_SIZE', 1000))
+# how many saga ids are reserved with one DB transaction
+ASYNC_INGRESS_SAGA_IDS_BATCH = int(os.getenv('ASYNC_INGRESS_SAGA_IDS_BATCH', 100))
+
+orders_submitted = metrics.Counter(
+    'order_api_async_orders_submitted_total',
+    'Orders submitted to async ingress, by result (accepted, invalid, rejected)',
+    labelnames=['result'])
+orders_processed = metrics.Counter(
+    'order_api_async_orders_processed_total',
+    'Orders processed by async ingress pipeline, by result (succeeded, failed)',
+    labelnames=['result'])
+queue_depth = metrics.Gauge(
+    'order_api_async_queue_depth',
+    'Orders accepted, but not yet taken by pipeline workers')
+orders_in_progress = metrics.Gauge(
+    'order_api_async_orders_in_progress',
+    'Orders being persisted and published by pipeline workers right now')
+reserved_saga_ids = metrics.Gauge(
+    'order_api_async_reserved_saga_ids',
+    'Saga ids reserved in advance and not yet used')
+
+
+class PipelineFull(Exception):
+    pass
+
+
+class SagaNotReserved(Exception):
+    pass
+
+
+def _reserve_saga_ids(count: int) -> typing.List[int]:
+    try:
+        with db.session.begin():
+            saga_states = [CreateOrderSagaState(status=RESERVED_SAGA_STATUS) for _ in range(count)]
+            db.session.add_all(saga_states)
+            db.session.flush()
+            return [saga_state.id for saga_state in saga_states]
+    finally:
+        db.session.remove()
+
+
+def _release_saga_ids(saga_ids: typing.List[int]):
+    # reserved ids that were never returned to clients
+    try:
+        with transaction():
+            released_count = CreateOrderSagaState.query \
+                .filter(CreateOrderSagaState.id.in_(saga_ids), CreateOrderSagaState.status == RESERVED_SAGA_STATUS) \
+                .delete(synchronize_session=False)
+            stats_counters.record_change(SAGAS_BY_STATUS, RESERVED_SAGA_STATUS, None, released_count)
+    finally:
+        db.session.remove()
+
+
+def _fail_reserved_saga(saga_id: int, error: str):
+    try:
+        fail_reserved_sagas(CreateOrderSagaState.id == saga_id, error=error)
+    finally:
+        db.session.remove()
+
+
+def _run_saga_with_reserved_id(saga_id: int, input_data: dict):
+    # same as app._run_saga, but saga state already exists
+    try:
+        with outbox_transaction():
+            with transaction():
+                order = Order(**input_data)
+                db.session.add(order)
+                db.session.flush()
+                started_count = CreateOrderSagaState.query \
+                    .filter_by(id=saga_id, status=RESERVED_SAGA_STATUS) \
+                    .update(dict(order_id=order.id, status='not_started'), synchronize_session=False)
+                if not started_count:
+                    # e.g. failed by sweeper: order isn't persisted either
+                    raise SagaNotReserved(f'Saga #{saga_id} is no longer reserved')
+                stats_counters.record_change(SAGAS_BY_STATUS, RESERVED_SAGA_STATUS, 'not_started', started_count)
+
+            CreateOrderSaga(create_saga_state_repository(), main_celery_app, saga_id).execute()
+    finally:
+        db.session.remove()
+
+
+class SagaSubmissionPipeline:
+    def __init__(self, concurrency: int, max_queue_size: int, saga_ids_batch: int,
+                 saga_id_ttl_seconds: float = RESERVED_SAGA_ID_TTL_SECONDS):
+        self.concurrency = concurrency
+        self.max_queue_size = max_queue_size
+        self.saga_ids_batch = saga_ids_batch
+        # ids reserved earlier than this are released, not used: sweeper fails them after saga_id_ttl_seconds
+        self.saga_id_max_age_seconds = saga_id_ttl_seconds / 2
+
+        self.in_progress = 0
+        self._queue = None  # type: asyncio.Queue
+        self._workers = []
+        self._executor = None  # type: ThreadPoolExecutor
+        self._reserved_saga_ids = collections.deque()  # (saga id, time.monotonic() when reserved)
+        self._refill = None  # type: asyncio.Future
+
+    @property
+    def started(self) -> bool:
+        return self._queue is not None
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self.started else 0
+
+    @property
+    def reserved_saga_ids_count(self) -> int:
+        return len(self._reserved_saga_ids)
+
+    async def start(self):
+        # queue is created here as it must be bound to running event loop
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        # one more thread for reserving saga ids
+        self._executor = ThreadPoolExecutor(self.concurrency + 1,
+                                            thread_name_prefix='saga-submission')
+        self._workers = [asyncio.ensure_future(self._work()) for _ in range(self.concurrency)]
+        self._schedule_refill()
+
+    async def stop(self):
+        # let workers process already accepted orders
+        await self._queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        if self._refill is not None:
+            await asyncio.wait([self._refill])
+        unused_saga_ids = [saga_id for saga_id, _ in self._reserved_saga_ids]
+        self._reserved_saga_ids.clear()
+        if unused_saga_ids:
+            await self._release(unused_saga_ids)
+        self._executor.shutdown()
+
+    async def submit(self, input_data: dict) -> int:
+        if self._queue.full():
+            raise PipelineFull
+
+        saga_id, reserved_at = await self._take_reserved_saga_id()
+        try:
+            self._queue.put_nowait((saga_id, input_data))
+        except asyncio.QueueFull:
+            # queue was filled while we were waiting for saga id
+            self._reserved_saga_ids.appendleft((saga_id, reserved_at))
+            raise PipelineFull
+
+        return saga_id
+
+    async def _take_reserved_saga_id(self) -> typing.Tuple[int, float]:
+        self._release_expired_saga_ids()
+        if len(self._reserved_saga_ids) <= self.saga_ids_batch // 2:
+            self._schedule_refill()
+
+        while not self._reserved_saga_ids:
+            await self._refill
+            if not self._reserved_saga_ids:  # ids were taken by other requests while we were waiting
+                self._schedule_refill()
+
+        return self._reserved_saga_ids.popleft()
+
+    def _release_expired_saga_ids(self):
+        expired_before = time.monotonic() - self.saga_id_max_age_seconds
+        expired_saga_ids = []
+        # ids are reserved in batches, oldest first
+        while self._reserved_saga_ids and self._reserved_saga_ids[0][1] < expired_before:
+            expired_saga_ids.append(self._reserved_saga_ids.popleft()[0])
+        if expired_saga_ids:
+            asyncio.ensure_future(self._release(expired_saga_ids))
+
+    async def _release(self, saga_ids: typing.List[int]):
+        try:
+            await asyncio.get_event_loop().run_in_executor(self._executor, _release_saga_ids, saga_ids)
+        except Exception:
+            # they will be failed by sweeper
+            logger.exception('Failed to release %s reserved saga ids', len(saga_ids))
+
+    def _schedule_refill(self):
+        if self._refill is None or self._refill.done():
+            self._refill = asyncio.ensure_future(self._refill_reserved_saga_ids())
+
+    async def _refill_reserved_saga_ids(self):
+        saga_ids = await asyncio.get_event_loop().run_in_executor(
+            self._executor, _reserve_saga_ids, self.saga_ids_batch)
+        reserved_at = time.monotonic()
+        self._reserved_saga_ids.extend((saga_id, reserved_at) for saga_id in saga_ids)
+
+    async def _work(self):
+        while True:
+            saga_id, input_data = await self._queue.get()
+            self.in_progress += 1
+            try:
+                await asyncio.get_event_loop().run_in_executor(
+                    self._executor, _run_saga_with_reserved_id, saga_id, input_data)
+                orders_processed.inc(result='succeeded')
+            except Exception as exc:
+                logger.exception('Failed to start saga #%s', saga_id)
+                orders_processed.inc(result='failed')
+                await self._fail(saga_id, f'Order was not persisted: {exc!r}')
+            finally:
+                self.in_progress -= 1
+                self._queue.task_done()
+
+    async def _fail(self, saga_id: int, error: str):
+        try:
+            await asyncio.get_event_loop().run_in_executor(self._executor, _fail_reserved_saga, saga_id, error)
+        except Exception:
+            # it will be failed by sweeper
+            logger.exception('Failed to mark saga #%s as failed', saga_id)
+
+
+pipeline = SagaSubmissionPipeline(concurrency=ASYNC_INGRESS_CONCURRENCY,
+                                  max_queue_size=ASYNC_INGRESS_MAX_QUEUE_SIZE,
+                                  saga_ids_batch=ASYNC_INGRESS_SAGA_IDS_BATCH)
+queue_depth.set_function(lambda: pipeline.queue_depth)
+orders_in_progress.set_function(lambda: pipeline.in_progress)
+reserved_saga_ids.set_function(lambda: pipeline.reserved_saga_ids_count)
+
+
+def _get_saga(saga_id: int) -> typing.Optional[dict]:
+    try:
+        return queries.get_saga(saga_id)
+    finally:
+        db.session.remove()
+
+
+def _refresh_admission_state():
+    try:
+        admission_controller.refresh_if_needed()
+    finally:
+        db.session.remove()
+
+
+async def _submit_order(body: bytes) -> typing.Tuple[int, dict, dict]:
+    try:
+        input_data = _input_data_from_json(json.loads(body))
+    except ValueError as exc:  # JSONDecodeError is ValueError as well
+        orders_submitted.inc(result='invalid')
+        return 400, {'error': str(exc)}, {}
+
+    if admission_controller.needs_refresh:
+        asyncio.get_event_loop().run_in_executor(None, _refresh_admission_state)
+    try:
+        admission_controller.admit()
+    except AdmissionRejected as exc:
+        orders_submitted.inc(result='rejected')
+        return 429, {'error': str(exc)}, {'retry-after': str(exc.retry_after)}
+
+    try:
+        saga_id = await pipeline.submit(input_data)
+    except PipelineFull:
+        admission_controller.release()
+        orders_submitted.inc(result='rejected')
+        return 503, {'error': 'Too many orders are being processed, try again later'}, {'retry-after': '1'}
+    except Exception as exc:
+        logger.exception('Failed to reserve saga id')
+        admission_controller.release()
+        orders_submitted.inc(result='rejected')
+        return 503, {'error': f'Failed to reserve saga id: {exc!r}'}, {'retry-after': '1'}
+
+    orders_submitted.inc(result='accepted')
+    return 202, {'saga_id': saga_id}, {}
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _handle_lifespan(receive, send)
+        return
+
+    if not pipeline.started:  # server may not support lifespan protocol
+        await pipeline.start()
+
+    method, path = scope['method'], scope['path']
+    if method == 'POST' and path == '/orders':
+        status, response, headers = await _submit_order(await _read_body(receive))
+        await _send_response(send, status, json.dumps(response).encode(), 'application/json', headers)
+    elif method == 'GET' and path.startswith('/sagas/') and path[len('/sagas/'):].isdigit():
+        saga = await asyncio.get_event_loop().run_in_executor(None, _get_saga, int(path[len('/sagas/'):]))
+        if saga is None:
+            await _send_response(send, 404, b'Saga not found', 'text/plain')
+        else:
+            await _send_response(send, 200, json.dumps(saga).encode(), 'application/json')
+    elif method == 'GET' and path == '/metrics':
+        await _send_response(send, 200, metrics.render_prometheus().encode(), metrics.CONTENT_TYPE)
+    elif method == 'GET' and path == '/ping':
+        await _send_response(send, 200, b'ping response', 'text/plain')
+    else:
+        await _send_response(send, 404, b'Not Found', 'text/plain')
+
+
+async def _handle_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await pipeline.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await pipeline.stop()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def _read_body(receive) -> bytes:
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+
+    return body
+
+
+async def _send_response(send, status: int, body: bytes, content_type: str, headers: dict = None):
+    headers = {**(headers or {}), 'content-type': content_type, 'content-length': str(len(body))}
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.encode(), value.encode()) for name, value in headers.items()],
+    })
+    await send({'type': 'http.response.body', 'body': body})
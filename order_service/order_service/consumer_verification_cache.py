@@ -0,0 +1,228 @@
+"""
+Orchestrator-side cache of positive consumer verification results: consumers verified recently
+ (within CONSUMER_VERIFICATION_CACHE_TTL_SECONDS) aren't verified again, `verify_consumer_details` step
+ of their sagas completes locally, without a command to consumer_service and waiting for its response.
+Failed verifications aren't cached.
+
+Cache is kept in memory of each orchestrator process (web app and orchestrator workers),
+ for at most CONSUMER_VERIFICATION_CACHE_SIZE consumers, least recently used ones are evicted first.
+Processes keep their caches in sync with events, which each process consumes from its own exclusive queue
+ in a background thread (started on first use of the cache in the process):
+ * `consumer_verified` - published to VERIFICATIONS_EXCHANGE by the process that handled a successful
+   verification response (sagas are started by web app, while responses are handled by workers),
+   consumer is cached by all processes. Event carries verification round-trip time,
+   so processes that only hit cache (web app, async API, sweeper) estimate time saved by hits as well
+ * `consumer_status_changed` - published by consumer_service (see consumer_service.consumer_status),
+   consumer is dropped from cache. Verifications sent before status change aren't cached when their results come
+Events published while a process is disconnected from broker are lost, so its cache is cleared on reconnect.
+
+Disabled by default (TTL is 0).
+
+Metrics: consumer_verification_cache_lookups_total{result} (hit, miss), consumer_verification_cache_invalidations_total,
+ consumer_verification_cache_saved_seconds_total (estimated as mean verification round-trip time per hit)
+ and consumer_verification_cache_size
+"""
+import collections
+import datetime
+import logging
+import os
+import threading
+import time
+import typing
+
+from celery import Celery
+from celery.utils import uuid
+from kombu import Exchange, Queue, binding
+from kombu.mixins import ConsumerMixin
+
+from order_service.app_common import metrics
+from order_service.app_common.messaging import consumer_service_messaging
+from order_service.app_common.messaging.consumer_service_messaging import consumer_status_changed_message
+from order_service.app_common.messaging.producer import ConfirmBatchingProducerPool
+
+logger = logging.getLogger(__name__)
+
+CONSUMER_VERIFICATION_CACHE_TTL_SECONDS = float(os.getenv('CONSUMER_VERIFICATION_CACHE_TTL_SECONDS', 0))
+CONSUMER_VERIFICATION_CACHE_SIZE = int(os.getenv('CONSUMER_VERIFICATION_CACHE_SIZE', 100000))
+
+VERIFICATIONS_EXCHANGE = Exchange('order_service.consumer_verifications', type='fanout', durable=True)
+CONSUMER_VERIFIED_EVENT = 'order_service.consumer_verified'
+# weight of the latest verification round trip in its moving average
+ROUND_TRIP_SMOOTHING = 0.1
+
+cache_lookups = metrics.Counter(
+    'consumer_verification_cache_lookups_total',
+    'Consumer verification cache lookups, by result (hit - verify_consumer_details step completed locally)',
+    labelnames=['result'])
+cache_invalidations = metrics.Counter(
+    'consumer_verification_cache_invalidations_total',
+    'Consumers dropped from verification cache because their status changed')
+cache_saved_seconds = metrics.Counter(
+    'consumer_verification_cache_saved_seconds_total',
+    'Estimated time of verify_consumer_details round trips saved by cache hits')
+cache_size = metrics.Gauge(
+    'consumer_verification_cache_size', 'Number of consumers in verification cache of this process')
+
+
+class ConsumerVerificationCache:
+    def __init__(self, celery_app: Celery, producer_pool: ConfirmBatchingProducerPool,
+                 ttl_seconds: float = CONSUMER_VERIFICATION_CACHE_TTL_SECONDS,
+                 max_size: int = CONSUMER_VERIFICATION_CACHE_SIZE):
+        self.celery_app = celery_app
+        self.producer_pool = producer_pool
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        # set to False to handle events with handle_event() instead (e.g. in tests and local runtime)
+        self.listen_in_background = True
+
+        self._expires_at = collections.OrderedDict()  # type: typing.Dict[int, float]  # time.monotonic()
+        # when consumers were last dropped because of status change (UTC), to ignore verifications sent before
+        self._invalidated_at = collections.OrderedDict()  # type: typing.Dict[int, datetime.datetime]
+        self._round_trip_s = None  # type: typing.Optional[float]
+        self._lock = threading.Lock()
+        self._events_queue = None  # type: typing.Optional[Queue]
+        self._events_queue_pid = None  # type: typing.Optional[int]
+        self._listener_pid = None  # type: typing.Optional[int]
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._expires_at)
+
+    @property
+    def events_queue(self) -> Queue:
+        # exclusive to this process (forked worker processes declare their own)
+        if self._events_queue_pid != os.getpid():
+            self._events_queue = Queue(
+                f'order_service.consumer_verification_cache.{uuid()}',
+                [binding(VERIFICATIONS_EXCHANGE), binding(consumer_service_messaging.EVENTS_EXCHANGE)],
+                exclusive=True)
+            self._events_queue_pid = os.getpid()
+        return self._events_queue
+
+    def is_verified(self, consumer_id: int) -> bool:
+        """
+        Whether consumer was verified recently (cache hit)
+        """
+        if not self.enabled:
+            return False
+
+        self._listen_if_needed()
+        with self._lock:
+            expires_at = self._expires_at.get(consumer_id)
+            hit = expires_at is not None and expires_at > time.monotonic()
+            if hit:
+                self._expires_at.move_to_end(consumer_id)
+            elif expires_at is not None:
+                del self._expires_at[consumer_id]
+            round_trip_s = self._round_trip_s
+
+        cache_lookups.inc(result='hit' if hit else 'miss')
+        if hit and round_trip_s:
+            cache_saved_seconds.inc(round_trip_s)
+        return hit
+
+    def record_verification(self, consumer_id: int, command_sent_at: datetime.datetime):
+        """
+        To be called when successful verification response is handled:
+         consumer is cached by this and all other orchestrator processes
+        """
+        if not self.enabled:
+            return
+
+        self._listen_if_needed()
+        # round trip is observed by all processes (this one included) when they get the event
+        round_trip_s = (datetime.datetime.utcnow() - command_sent_at).total_seconds()
+        self.add(consumer_id, command_sent_at)
+
+        try:
+            with self.producer_pool.acquire() as producer:
+                producer.publish(
+                    {'event': CONSUMER_VERIFIED_EVENT,
+                     'payload': {'consumer_id': consumer_id, 'verified_at': command_sent_at.isoformat(),
+                                 'round_trip_s': round_trip_s}},
+                    exchange=VERIFICATIONS_EXCHANGE, routing_key='', serializer='json',
+                    declare=[VERIFICATIONS_EXCHANGE])
+        except Exception:
+            # other processes will verify this consumer themselves
+            logger.exception('Failed to publish verification of consumer #%s', consumer_id)
+
+    def add(self, consumer_id: int, verified_at: datetime.datetime):
+        """
+        Caches consumer verified at `verified_at` (UTC), unless its status has changed since then
+        """
+        age_s = (datetime.datetime.utcnow() - verified_at).total_seconds()
+        with self._lock:
+            invalidated_at = self._invalidated_at.get(consumer_id)
+            if invalidated_at is not None and verified_at <= invalidated_at:
+                return
+
+            self._expires_at[consumer_id] = time.monotonic() + self.ttl_seconds - max(age_s, 0)
+            self._expires_at.move_to_end(consumer_id)
+            if len(self._expires_at) > self.max_size:
+                self._expires_at.popitem(last=False)
+
+    def observe_round_trip(self, round_trip_s: float):
+        with self._lock:
+            self._round_trip_s = round_trip_s if self._round_trip_s is None \
+                else self._round_trip_s + ROUND_TRIP_SMOOTHING * (round_trip_s - self._round_trip_s)
+
+    def invalidate(self, consumer_id: int):
+        with self._lock:
+            self._expires_at.pop(consumer_id, None)
+            self._invalidated_at[consumer_id] = datetime.datetime.utcnow()
+            self._invalidated_at.move_to_end(consumer_id)
+            if len(self._invalidated_at) > self.max_size:
+                self._invalidated_at.popitem(last=False)
+
+        cache_invalidations.inc()
+
+    def clear(self):
+        with self._lock:
+            self._expires_at.clear()
+
+    def handle_event(self, body: typing.Mapping[str, typing.Any]):
+        event, payload = body.get('event'), body.get('payload') or {}
+        if event == CONSUMER_VERIFIED_EVENT:
+            self.add(payload['consumer_id'], datetime.datetime.fromisoformat(payload['verified_at']))
+            if payload.get('round_trip_s') is not None:  # events of older versions don't have it
+                self.observe_round_trip(payload['round_trip_s'])
+        elif event == consumer_status_changed_message.EVENT_NAME:
+            logger.info('Consumer #%s status changed to %s, dropping it from verification cache',
+                        payload['consumer_id'], payload.get('status'))
+            self.invalidate(payload['consumer_id'])
+
+    def _listen_if_needed(self):
+        if not self.listen_in_background or self._listener_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+
+        listener = _CacheEventsListener(self.celery_app.connection_for_read(), self)
+        threading.Thread(target=listener.run, name='consumer-verification-cache-events', daemon=True).start()
+
+
+class _CacheEventsListener(ConsumerMixin):
+    def __init__(self, connection, cache: ConsumerVerificationCache):
+        self.connection = connection
+        self.cache = cache
+
+    def get_consumers(self, Consumer, channel):
+        return [Consumer(queues=[self.cache.events_queue], callbacks=[self.on_message], accept=['json'],
+                         no_ack=True)]
+
+    def on_connection_revived(self):
+        # events published while disconnected are lost (queue is exclusive), some consumers may be stale
+        self.cache.clear()
+
+    def on_message(self, body: dict, message):
+        try:
+            self.cache.handle_event(body)
+        except Exception:
+            logger.exception('Failed to handle consumer verification cache event %s', body)
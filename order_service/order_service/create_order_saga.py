@@ -0,0 +1,908 @@
+"""
+CreateOrder saga definition and its state repository.
+
+Orchestrator worker imports only this module (with models),
+ so it doesn't build web app routes or touch DB schema on startup
+"""
+import contextlib
+import datetime
+import logging
+import os
+import threading
+import time
+import typing
+from dataclasses import asdict, dataclass
+
+from celery import Celery, Task
+from celery.utils import uuid
+from saga_framework import SyncStep, \
+    AsyncStep, BaseStep, AbstractSagaStateRepository, StatefulSaga, serialize_saga_error, \
+    success_task_name, failure_task_name
+from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+
+from order_service.app_common import settings, metrics
+from order_service.app_common.resilience import RetryPolicy, NO_RETRIES, CircuitBreaker, circuit_breakers, \
+    is_transient_error, step_retries
+from order_service.app_common.structured_logging import saga_logger, SagaLoggerAdapter
+from order_service.app_common.messaging import consumer_service_messaging, \
+    restaurant_service_messaging, accounting_service_messaging
+from order_service.app_common.messaging.accounting_service_messaging import \
+    authorize_card_message
+from order_service.app_common.messaging.consumer_service_messaging import \
+    verify_consumer_details_message
+from order_service.app_common.messaging.restaurant_service_messaging import \
+    create_ticket_message, reject_ticket_message, approve_ticket_message
+from order_service.app_common.messaging.codec import configure_wire_format, encode_payload, decode_payload_as_dict
+from order_service.app_common.messaging.producer import ConfirmBatchingProducerPool
+from order_service.consumer_verification_cache import ConsumerVerificationCache, cache_size
+from order_service.db_statements_counter import SagaStatementsCounter
+from order_service.models import db, OrderStatuses, Order, CreateOrderSagaState, ProcessedSagaResponse, \
+    CreateOrderSagaStepEvent, transaction
+from order_service.outbox import OUTBOX_ENABLED, outbox_transaction, write_to_outbox
+from order_service.parallel_steps import ParallelStepGroup, ParallelGroupState, ParallelGroupStepStatuses
+from order_service.recent_keys import RecentKeys
+from order_service.stats import stats_counters
+
+logger = logging.getLogger(__name__)
+
+main_celery_app = Celery('my_celery_app', broker=settings.CELERY_BROKER)
+configure_wire_format(main_celery_app)
+
+# Persistent producers used to publish saga commands (both by web app and orchestrator worker).
+# Publisher confirms are awaited once per PUBLISH_CONFIRM_FLUSH_SIZE messages
+#  or PUBLISH_CONFIRM_FLUSH_INTERVAL seconds, whichever comes first
+producer_pool = ConfirmBatchingProducerPool(
+    main_celery_app,
+    size=int(os.getenv('PRODUCER_POOL_SIZE', 4)),
+    flush_size=int(os.getenv('PUBLISH_CONFIRM_FLUSH_SIZE', 100)),
+    flush_interval=float(os.getenv('PUBLISH_CONFIRM_FLUSH_INTERVAL', 0.05)),
+)
+
+# consumers verified recently, their verify_consumer_details step is completed locally
+consumer_verification_cache = ConsumerVerificationCache(main_celery_app, producer_pool)
+cache_size.set_function(lambda: len(consumer_verification_cache))
+
+# set to 0 to write each saga state change separately (as it was done before) and compare
+COALESCE_SAGA_STATE_UPDATES = os.getenv('COALESCE_SAGA_STATE_UPDATES', '1') == '1'
+# set to 0 to load saga state, its order and order items lazily on each access
+#  (as it was done before) and compare
+EAGER_LOAD_SAGA_STATE = os.getenv('EAGER_LOAD_SAGA_STATE', '1') == '1'
+
+statements_counter = SagaStatementsCounter()
+statements_counter.install(db.engine)
+stats_counters.install(db.session)
+
+# magic number that makes orchestrator fail on create_restaurant_ticket step
+QUANTITY_THAT_WILL_MAKE_ORCHESTRATOR_FAIL = 100500
+
+
+SAGA_STEP_TIMEOUT_SECONDS = float(os.getenv('SAGA_STEP_TIMEOUT_SECONDS', 60))
+
+
+class SagaStepTimeout(Exception):
+    pass
+
+
+@dataclass
+class StepTimeoutPolicy:
+    # how long to wait for step response
+    deadline: datetime.timedelta
+    # how many times to re-send step command before giving up and compensating saga,
+    #  and how long to delay re-sent commands (with jitter, so commands of sagas timed out together
+    #  aren't re-sent at once). Delays should be much less than deadline.
+    # Only steps that are safe to run twice (idempotent on handler side) should be retried
+    retry_policy: RetryPolicy = NO_RETRIES
+
+
+class CreateOrderSagaRepository(AbstractSagaStateRepository):
+    def get_saga_state_by_id(self, saga_id: int) -> CreateOrderSagaState:
+        return CreateOrderSagaState.find(saga_id)
+
+    def get_saga_state_with_order_and_items(self, saga_id: int, for_update: bool = False) -> CreateOrderSagaState:
+        """
+        Loads saga state, its order and order items in one query.
+        With `for_update`, saga state row is locked till the end of transaction
+        """
+        query = CreateOrderSagaState.query \
+            .options(joinedload(CreateOrderSagaState.order).joinedload(Order.items)) \
+            .filter_by(id=saga_id)
+        if for_update:
+            # only saga state row: outer-joined rows can't be locked
+            query = query.with_for_update(of=CreateOrderSagaState)
+
+        return query.one()
+
+    def update_status(self, saga_id: int, status: str) -> CreateOrderSagaState:
+        return self.get_saga_state_by_id(saga_id).update(status=status)
+
+    def update(self, saga_id: int, **fields_to_update: str) -> object:
+        return self.get_saga_state_by_id(saga_id).update(**fields_to_update)
+
+    def on_step_failure(self, saga_id: int, failed_step: BaseStep, initial_failure_payload: dict) -> object:
+        return self.get_saga_state_by_id(saga_id).update(
+            failed_step=failed_step.name,
+            failed_at=datetime.datetime.utcnow(),
+            failure_details=initial_failure_payload
+        )
+
+    def add_processed_response(self, saga_id: int, step_name: str, message_id: str) -> bool:
+        """
+        Records response as processed, with one INSERT. Returns False if it was already recorded (duplicate).
+        Inside transaction, unique constraint makes concurrent duplicate wait here till the first one is committed
+        """
+        row = dict(saga_id=saga_id, step=step_name, message_id=message_id, processed_at=datetime.datetime.utcnow())
+        dialect_insert = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}.get(db.engine.dialect.name)
+        if dialect_insert is not None:
+            return db.session.execute(
+                dialect_insert(ProcessedSagaResponse.__table__).on_conflict_do_nothing(), row).rowcount == 1
+
+        # for DBs without INSERT ... ON CONFLICT
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(ProcessedSagaResponse.__table__), row)
+        except IntegrityError:
+            return False
+        return True
+
+    def add_step_event(self, saga_id: int, step: AsyncStep, outcome: str,
+                       command_sent_at: datetime.datetime, response_received_at: datetime.datetime,
+                       handler_duration_ms: float) -> None:
+        db.session.add(CreateOrderSagaStepEvent(
+            saga_id=saga_id,
+            step=step.name,
+            outcome=outcome,
+            command_sent_at=command_sent_at,
+            response_received_at=response_received_at,
+            handler_duration_ms=handler_duration_ms,
+        ))
+        # outside of transaction, autocommit session commits on flush
+        db.session.flush()
+
+    @contextlib.contextmanager
+    def transaction(self, saga_id: int):
+        # every change is written (and committed) immediately
+        yield
+
+
+class CoalescingCreateOrderSagaRepository(CreateOrderSagaRepository):
+    """
+    Writes saga state with `UPDATE ... WHERE id=` statements, without loading it first.
+
+    Inside `transaction()`, changes are accumulated and written with a single UPDATE
+     in the same DB transaction as everything else orchestrator does in this task
+     (e.g. Order updates).
+    """
+    def __init__(self):
+        # one repository is shared by all tasks of a worker, so keep pending changes per thread
+        self._local = threading.local()
+
+    def update_status(self, saga_id: int, status: str) -> None:
+        self.update(saga_id, status=status)
+
+    def update(self, saga_id: int, **fields_to_update: str) -> None:
+        pending_changes = getattr(self._local, 'pending_changes', None)
+        if pending_changes is None:
+            self._write(saga_id, fields_to_update)
+        else:
+            pending_changes.setdefault(saga_id, {}).update(fields_to_update)
+
+    def on_step_failure(self, saga_id: int, failed_step: BaseStep, initial_failure_payload: dict) -> None:
+        self.update(
+            saga_id,
+            failed_step=failed_step.name,
+            failed_at=datetime.datetime.utcnow(),
+            failure_details=initial_failure_payload
+        )
+
+    @contextlib.contextmanager
+    def transaction(self, saga_id: int):
+        if getattr(self._local, 'pending_changes', None) is not None:
+            # nested call (e.g. on_async_step_success runs next step): join outer transaction
+            yield
+            return
+
+        self._local.pending_changes = {}
+        try:
+            # joins transaction begun by caller, if any (see outbox_transaction)
+            with transaction():
+                yield
+                for saga_id_, fields_to_update in self._local.pending_changes.items():
+                    self._write(saga_id_, fields_to_update)
+        finally:
+            self._local.pending_changes = None
+
+    @staticmethod
+    def _write(saga_id: int, fields_to_update: dict):
+        with transaction():
+            # bulk UPDATE isn't seen by stats counters' mapper events
+            stats_counters.record_saga_state_update(saga_id, fields_to_update)
+            CreateOrderSagaState.query \
+                .filter_by(id=saga_id) \
+                .update(fields_to_update, synchronize_session=False)
+
+
+def create_saga_state_repository() -> CreateOrderSagaRepository:
+    if COALESCE_SAGA_STATE_UPDATES:
+        return CoalescingCreateOrderSagaRepository()
+    return CreateOrderSagaRepository()
+
+
+# step responses recently handled by this process: (saga id, step name, message id)
+processed_responses = RecentKeys(max_size=int(os.getenv('PROCESSED_RESPONSES_CACHE_SIZE', 100000)))
+
+duplicate_responses_dropped = metrics.Counter(
+    'create_order_saga_duplicate_responses_dropped_total',
+    'Redelivered step responses dropped without handling, by step and where duplicate was detected (memory, db)',
+    labelnames=['step', 'detected_by'])
+
+
+class CreateOrderSaga(StatefulSaga):
+    # what timeout sweeper does with steps which response doesn't come in time
+    #  (see sweep_timed_out_sagas)
+    step_timeout_policies = {
+        # ticket or card transaction could be created even if response was lost,
+        #  so these steps are not re-sent
+        'verify_consumer_and_create_ticket': StepTimeoutPolicy(
+            deadline=datetime.timedelta(seconds=SAGA_STEP_TIMEOUT_SECONDS)),
+        'authorize_card': StepTimeoutPolicy(
+            deadline=datetime.timedelta(seconds=SAGA_STEP_TIMEOUT_SECONDS)),
+        'approve_restaurant_ticket': StepTimeoutPolicy(
+            deadline=datetime.timedelta(seconds=SAGA_STEP_TIMEOUT_SECONDS),
+            retry_policy=RetryPolicy(max_retries=2, base_delay=1, max_delay=10)),
+    }  # type: typing.Dict[str, StepTimeoutPolicy]
+
+    # kombu producer to publish commands with.
+    # If not set, producer is taken from producer_pool
+    producer = None
+    # messages that will be published when current unit of work ends (see _unit_of_work)
+    _messages_to_send = None
+    # steps completed without sending commands, handled at the end of current unit of work
+    #  (see _complete_step_locally)
+    _locally_completed_steps = None
+    # id of step response message being handled, set by registered response handlers
+    response_message_id = None
+    # see _get_parallel_group_state
+    _parallel_group_state = None
+    # delay of commands sent, seconds (set when commands are re-sent after timeout)
+    _command_countdown = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.log = saga_logger(logger, self.saga_id)
+
+        self.steps = [
+            SyncStep(
+                name='reject_order',
+                compensation=self.reject_order
+            ),
+            # these steps don't depend on each other, so they are run concurrently
+            ParallelStepGroup(
+                name='verify_consumer_and_create_ticket',
+                action=self.run_parallel_group,
+                compensation=self.compensate_parallel_group,
+                steps=[
+                    AsyncStep(
+                        name='verify_consumer_details',
+                        action=self.verify_consumer_details,
+
+                        base_task_name=verify_consumer_details_message.TASK_NAME,
+                        queue=consumer_service_messaging.COMMANDS_QUEUE,
+
+                        on_success=self.verify_consumer_details_on_success,
+                        on_failure=self.verify_consumer_details_on_failure
+                    ),
+
+                    AsyncStep(
+                        name='create_restaurant_ticket',
+                        action=self.create_restaurant_ticket,
+                        compensation=self.reject_restaurant_ticket,
+
+                        base_task_name=create_ticket_message.TASK_NAME,
+                        queue=restaurant_service_messaging.COMMANDS_QUEUE,
+
+                        on_success=self.create_restaurant_ticket_on_success,
+                        on_failure=self.create_restaurant_ticket_on_failure
+                    ),
+                ]
+            ),
+
+            AsyncStep(
+                name='authorize_card',
+                action=self.authorize_card,
+
+                base_task_name=authorize_card_message.TASK_NAME,
+                queue=accounting_service_messaging.COMMANDS_QUEUE,
+
+                on_success=self.authorize_card_on_success,
+                on_failure=self.authorize_card_on_failure
+            ),
+
+            AsyncStep(
+                name='approve_restaurant_ticket',
+                action=self.approve_restaurant_ticket,
+
+                base_task_name=approve_ticket_message.TASK_NAME,
+                queue=restaurant_service_messaging.COMMANDS_QUEUE,
+
+                on_success=self.approve_restaurant_ticket_on_success,
+                on_failure=self.approve_restaurant_ticket_on_failure
+            ),
+
+            SyncStep(
+                name='approve_order',
+                action=self.approve_order
+            )
+        ]
+
+    def _step_log(self, step: BaseStep) -> SagaLoggerAdapter:
+        return saga_logger(logger, self.saga_id, step=step.name)
+
+    @staticmethod
+    def _circuit_breaker(step: AsyncStep) -> CircuitBreaker:
+        # circuit breaker of service that handles step commands (command queues are named '<service>.commands')
+        return circuit_breakers.get(step.queue.partition('.')[0])
+
+    def _prepare_command_resend(self, step: AsyncStep, policy_step: BaseStep):
+        """
+        Called before step command is re-sent after timeout:
+         timeout counts as service failure, and command is delayed by step retry policy
+        """
+        retry_policy = self.step_timeout_policies[policy_step.name].retry_policy
+        self._command_countdown = retry_policy.delay(self.saga_state.timeout_retries)
+        self._circuit_breaker(step).record_failure()
+        step_retries.inc(service=self._circuit_breaker(step).service, task=step.base_task_name)
+
+    @contextlib.contextmanager
+    def _unit_of_work(self):
+        """
+        Everything orchestrator does within one task (web request or Celery task)
+         is done in one DB transaction, and messages are published after it's committed.
+        Otherwise, response to a message may come before the state it relies on is committed.
+        With outbox, messages are written to outbox in this transaction instead (see outbox.py)
+        """
+        if self._messages_to_send is not None:
+            yield
+            return
+
+        self._messages_to_send = []
+        self._locally_completed_steps = []
+        statements_before = statements_counter.get(self.saga_id)
+        try:
+            # outbox_transaction() begins a transaction if repository doesn't
+            #  (CreateOrderSagaRepository writes each change separately)
+            with statements_counter.counting_for(self.saga_id), \
+                    self.saga_state_repository.transaction(self.saga_id), \
+                    outbox_transaction():
+                yield
+                self._handle_locally_completed_steps()
+                if OUTBOX_ENABLED:
+                    write_to_outbox(self._messages_to_send)
+
+            if not OUTBOX_ENABLED:
+                with self._acquire_producer() as producer:
+                    for message in self._messages_to_send:
+                        self.celery_app.send_task(**message, producer=producer)
+        finally:
+            self._messages_to_send = None
+            self._locally_completed_steps = None
+
+        statements_total = statements_counter.get(self.saga_id)
+        self.log.debug('%s DB statements executed (%s in total)',
+                       statements_total - statements_before, statements_total)
+
+    @property
+    def saga_state(self) -> CreateOrderSagaState:
+        if not EAGER_LOAD_SAGA_STATE:
+            return self.saga_state_repository.get_saga_state_by_id(self.saga_id)
+
+        # saga instance lives as long as one orchestrator task,
+        #  so everything is loaded once per task and reused by all steps
+        if self._saga_state is None:
+            self._saga_state = self.saga_state_repository.get_saga_state_with_order_and_items(self.saga_id)
+
+        return self._saga_state
+
+    def _acquire_producer(self):
+        if self.producer:
+            return contextlib.nullcontext(self.producer)
+
+        return producer_pool.acquire()
+
+    def execute(self, starting_step: BaseStep = None):
+        with self._unit_of_work():
+            super().execute(starting_step)
+
+    @property
+    def async_steps(self) -> typing.List[AsyncStep]:
+        # including ones in parallel groups, so handlers are registered for them too
+        async_steps = []
+        for step in self.steps:
+            if isinstance(step, ParallelStepGroup):
+                async_steps.extend(step.steps)
+            elif isinstance(step, AsyncStep):
+                async_steps.append(step)
+
+        return async_steps
+
+    def _get_parallel_group(self, step: BaseStep) -> typing.Union[ParallelStepGroup, None]:
+        for group in self.steps:
+            if isinstance(group, ParallelStepGroup) and step in group.steps:
+                return group
+
+        return None
+
+    def _get_step_index(self, step: BaseStep) -> int:
+        # steps of a parallel group take the place of their group,
+        #  e.g. previous step of group step is the step before group
+        return super()._get_step_index(self._get_parallel_group(step) or step)
+
+    def _get_parallel_group_state(self) -> ParallelGroupState:
+        # kept in memory during the task: saga state changes are written at the end of it
+        if self._parallel_group_state is None:
+            self._parallel_group_state = ParallelGroupState(self.saga_state.parallel_group_state)
+
+        return self._parallel_group_state
+
+    def _save_parallel_group_state(self, group_state: ParallelGroupState):
+        self._parallel_group_state = group_state
+        self.saga_state_repository.update(self.saga_id, parallel_group_state=group_state.to_json())
+
+    def run_parallel_group(self, group: ParallelStepGroup):
+        """
+        Sends commands of all group steps. Saga then waits for all their responses
+        """
+        group_state = ParallelGroupState.started(group)
+        try:
+            for step in group.steps:
+                step.action(step)
+                group_state.set_sent(step, datetime.datetime.utcnow())
+        except BaseException:
+            # steps which commands are already sent will be compensated when they succeed
+            group_state.failed = True
+            raise
+        finally:
+            self._save_parallel_group_state(group_state)
+
+    def compensate_parallel_group(self, group: ParallelStepGroup):
+        # group has succeeded, i.e. all its steps succeeded
+        for step in reversed(group.steps):
+            step.compensation(step)
+
+    def _on_parallel_group_step_success(self, group: ParallelStepGroup, step: AsyncStep):
+        group_state = self._get_parallel_group_state()
+        if group_state.failed:
+            # other group step has failed meanwhile and saga is compensated already
+            self._step_log(step).info('Compensating step of failed "%s" group', group.name)
+            step.compensation(step)
+            group_state.set_status(step, ParallelGroupStepStatuses.COMPENSATED)
+            self._save_parallel_group_state(group_state)
+            return
+
+        group_state.set_status(step, ParallelGroupStepStatuses.SUCCEEDED)
+        self._save_parallel_group_state(group_state)
+        if len(group_state.steps_with_status(group, ParallelGroupStepStatuses.SUCCEEDED)) < len(group.steps):
+            return  # wait for other group steps
+
+        if self.saga_state.timeout_retries:
+            self.saga_state_repository.update(self.saga_id, timeout_retries=0)
+
+        if self.step_is_last(group):
+            self.on_saga_success()
+        else:
+            self.execute(self._get_next_step(group))
+
+    def _on_parallel_group_step_failure(self, group: ParallelStepGroup, step: AsyncStep, payload: dict):
+        group_state = self._get_parallel_group_state()
+        group_state.set_status(step, ParallelGroupStepStatuses.FAILED)
+        already_failed, group_state.failed = group_state.failed, True
+        self._save_parallel_group_state(group_state)
+        if already_failed:
+            return  # saga is compensated already
+
+        for succeeded_step in reversed(group_state.steps_with_status(group, ParallelGroupStepStatuses.SUCCEEDED)):
+            self.compensate_step(succeeded_step, payload)
+            group_state.set_status(succeeded_step, ParallelGroupStepStatuses.COMPENSATED)
+        self._save_parallel_group_state(group_state)
+
+        # compensates steps before the group
+        self.compensate(step, payload)
+
+    def _is_waiting_for_response(self, step: AsyncStep) -> bool:
+        if self._get_parallel_group(step):
+            # even if group has failed, response is handled to compensate the step if it succeeded
+            if self._get_parallel_group_state().get_status(step) == ParallelGroupStepStatuses.RUNNING:
+                return True
+        elif self.saga_state.status == f'{step.name}.running':
+            return True
+
+        # e.g. response came after step timed out and saga was compensated
+        self._step_log(step).warning('Ignoring step response, saga status is %s', self.saga_state.status)
+        return False
+
+    @classmethod
+    def register_success_handler_for_step(cls, saga_state_repository: AbstractSagaStateRepository,
+                                          celery_app: Celery, step: AsyncStep):
+        # same as in StatefulSaga, but response message id is passed to saga (for deduplication)
+        #  and binary payload is decoded
+        def on_success_handler(celery_task: Task, saga_id: int, payload: dict):
+            saga = cls(saga_state_repository, celery_app, saga_id)
+            saga.response_message_id = celery_task.request.id
+
+            step_ = saga.get_async_step_by_success_task_name(celery_task.name)
+            saga.on_async_step_success(step_, decode_payload_as_dict(celery_task.name, payload))
+
+        celery_app.task(
+            name=success_task_name(step.base_task_name),
+            bind=True
+        )(on_success_handler)
+
+    @classmethod
+    def register_failure_handler_for_step(cls, saga_state_repository: AbstractSagaStateRepository,
+                                          celery_app: Celery, step: AsyncStep):
+        # same as in StatefulSaga, but response message id is passed to saga (for deduplication)
+        #  and binary payload is decoded
+        def on_failure_handler(celery_task: Task, saga_id: int, payload: dict):
+            saga = cls(saga_state_repository, celery_app, saga_id)
+            saga.response_message_id = celery_task.request.id
+
+            step_ = saga.get_async_step_by_failure_task_name(celery_task.name)
+            saga.on_async_step_failure(step_, decode_payload_as_dict(celery_task.name, payload))
+
+        celery_app.task(
+            name=failure_task_name(step.base_task_name),
+            bind=True
+        )(on_failure_handler)
+
+    def _drop_duplicate_response(self, step: AsyncStep, detected_by: str):
+        duplicate_responses_dropped.inc(step=step.name, detected_by=detected_by)
+        self._step_log(step).warning('Dropping duplicate step response %s', self.response_message_id)
+
+    @contextlib.contextmanager
+    def _handling_response(self, step: AsyncStep):
+        """
+        Runs response handling in a unit of work. Yields whether response should be handled:
+         redelivered responses (already handled ones, with the same message id) are dropped
+         without loading saga state, as well as responses saga doesn't wait for anymore.
+
+        Response is recorded as processed in the same transaction as saga state changes,
+         so even concurrently delivered duplicates can't be both handled (unique constraint).
+        Responses that aren't in memory are recorded right away: failed insert means a duplicate,
+         so there's no lookup before it.
+        """
+        if self.response_message_id is None:  # e.g. timeout, not an actual response
+            with self._unit_of_work():
+                self._lock_saga_state_if_needed(step)
+                yield self._is_waiting_for_response(step)
+            return
+
+        response_key = (self.saga_id, step.name, self.response_message_id)
+        if response_key in processed_responses:
+            self._drop_duplicate_response(step, detected_by='memory')
+            yield False
+            return
+
+        with self._unit_of_work():
+            if not self.saga_state_repository.add_processed_response(*response_key):
+                self._drop_duplicate_response(step, detected_by='db')
+                should_handle = False
+            else:
+                self._lock_saga_state_if_needed(step)
+                should_handle = self._is_waiting_for_response(step)
+            yield should_handle
+
+        processed_responses.add(response_key)
+
+    def _lock_saga_state_if_needed(self, step: BaseStep):
+        """
+        Responses of parallel group steps may be handled concurrently,
+         so saga state is locked while one of them changes group state
+        """
+        if self._parallel_group_state is not None:
+            return  # already locked in this task
+
+        if isinstance(step, ParallelStepGroup) or self._get_parallel_group(step):
+            saga_state = self.saga_state_repository.get_saga_state_with_order_and_items(self.saga_id,
+                                                                                      for_update=True)
+            if EAGER_LOAD_SAGA_STATE:
+                self._saga_state = saga_state
+            self._parallel_group_state = ParallelGroupState(saga_state.parallel_group_state)
+
+    def on_async_step_success(self, step: AsyncStep, payload: dict):
+        # same as in AsyncSaga, but step handler is timed
+        with self._handling_response(step) as should_handle:
+            if not should_handle:
+                return
+
+            self._run_step_handler(step, 'success', payload)
+            self._continue_after_step_success(step)
+
+    def _continue_after_step_success(self, step: AsyncStep):
+        group = self._get_parallel_group(step)
+        if group:
+            self._on_parallel_group_step_success(group, step)
+            return
+
+        if self.saga_state.timeout_retries:
+            self.saga_state_repository.update(self.saga_id, timeout_retries=0)
+
+        if self.step_is_last(step):
+            self.on_saga_success()
+        else:
+            next_step = self._get_next_step(step)
+            self.execute(next_step)
+
+    def _complete_step_locally(self, step: AsyncStep):
+        """
+        Called by step action instead of sending command (e.g. result is known from cache).
+        Step succeeds at the end of current unit of work, as if success response came
+         (when it's recorded as sent and saga waits for it), but its on_success handler isn't run
+        """
+        self._locally_completed_steps.append(step)
+
+    def _handle_locally_completed_steps(self):
+        while self._locally_completed_steps:
+            step = self._locally_completed_steps.pop(0)
+            self._run_step_handler(step, 'cached', payload={})
+            self._continue_after_step_success(step)
+
+    def on_async_step_failure(self, step: AsyncStep, payload: dict):
+        # same as in AsyncSaga, but step handler is timed
+        with self._handling_response(step) as should_handle:
+            if not should_handle:
+                return
+
+            self._run_step_handler(step, 'failure', payload)
+            group = self._get_parallel_group(step)
+            if group:
+                self._on_parallel_group_step_failure(group, step, payload)
+            else:
+                self.compensate(step, payload)
+
+    def on_async_step_timeout(self, step: typing.Union[AsyncStep, ParallelStepGroup], retry: bool):
+        if isinstance(step, ParallelStepGroup):
+            self._on_parallel_group_timeout(step, retry)
+            return
+
+        with self._handling_response(step) as should_handle:
+            if not should_handle:
+                return
+
+            if retry:
+                self._step_log(step).warning('Step timed out, re-sending its command')
+                self._prepare_command_resend(step, step)
+                self.saga_state_repository.update(self.saga_id,
+                                                  timeout_retries=self.saga_state.timeout_retries + 1)
+                self.execute(step)
+            else:
+                self._step_log(step).warning('Step timed out, compensating')
+                self.on_async_step_failure(step, asdict(serialize_saga_error(
+                    SagaStepTimeout(f'No response for "{step.name}" step in time'))))
+
+    def _on_parallel_group_timeout(self, group: ParallelStepGroup, retry: bool):
+        with self._unit_of_work():
+            self._lock_saga_state_if_needed(group)
+            group_state = self._get_parallel_group_state()
+            running_steps = group_state.steps_with_status(group, ParallelGroupStepStatuses.RUNNING)
+            if self.saga_state.status != f'{group.name}.running' or not running_steps:
+                return
+
+            if retry:
+                self._step_log(group).warning('Group timed out, re-sending commands of %s',
+                                              [step.name for step in running_steps])
+                for step in running_steps:
+                    self._prepare_command_resend(step, group)
+                self.saga_state_repository.update(self.saga_id,
+                                                  timeout_retries=self.saga_state.timeout_retries + 1)
+                for step in running_steps:
+                    step.action(step)
+                    group_state.set_sent(step, datetime.datetime.utcnow())
+                self._save_parallel_group_state(group_state)
+            else:
+                # as if the first of steps that didn't respond has failed
+                self.on_async_step_timeout(running_steps[0], retry=False)
+
+    def _run_step_handler(self, step: AsyncStep, outcome: str, payload: dict):
+        """
+        Runs step on_success / on_failure handler and records step event with
+         time of sending command, receiving response and handler duration
+        """
+        response_received_at = datetime.datetime.utcnow()
+        self._step_log(step).debug('Running on_%s handler', outcome)
+
+        # business errors (e.g. declined card) don't mean the service is unavailable.
+        #  Service isn't called for steps completed locally ('cached' outcome)
+        if outcome == 'failure' and is_transient_error(payload.get('type')):
+            self._circuit_breaker(step).record_failure()
+        elif outcome != 'cached':
+            self._circuit_breaker(step).record_success()
+
+        handler = {'success': step.on_success, 'failure': step.on_failure}.get(outcome)
+        started_at = time.perf_counter()
+        if handler:
+            handler(step, payload)
+        handler_duration_ms = (time.perf_counter() - started_at) * 1000
+
+        self.saga_state_repository.add_step_event(
+            self.saga_id, step, outcome,
+            command_sent_at=self._get_command_sent_at(step),
+            response_received_at=response_received_at,
+            handler_duration_ms=handler_duration_ms,
+        )
+
+    def _get_command_sent_at(self, step: AsyncStep) -> datetime.datetime:
+        if self._get_parallel_group(step):
+            return self._get_parallel_group_state().get_sent_at(step)
+
+        # response is for the last message sent, and saga state is loaded before new messages are sent
+        return self.saga_state.last_message_sent_at
+
+    def send_message_to_other_service(self, step: AsyncStep, payload: dict, task_name: str = None):
+        if task_name is None:
+            # fails fast (and saga is compensated) while service is unavailable.
+            # Compensation commands (sent with explicit task_name) are sent anyway
+            self._circuit_breaker(step).check()
+
+        task_name = task_name or step.base_task_name
+        message = dict(
+            name=task_name,
+            args=[
+                self.saga_id,
+                encode_payload(task_name, payload)
+            ],
+            queue=step.queue,
+            # generate message id ourselves, so it's known before message is actually sent
+            task_id=uuid()
+        )
+        if self._command_countdown:
+            message['countdown'] = self._command_countdown
+
+        if self._messages_to_send is None:
+            if OUTBOX_ENABLED:
+                write_to_outbox([message])
+            else:
+                with self._acquire_producer() as producer:
+                    self.celery_app.send_task(**message, producer=producer)
+        else:
+            self._messages_to_send.append(message)
+
+        self.saga_state_repository.update(self.saga_id, last_message_sent_at=datetime.datetime.utcnow())
+
+        return message['task_id']
+
+    def verify_consumer_details(self, current_step: AsyncStep):
+        if consumer_verification_cache.is_verified(self.saga_state.order.consumer_id):
+            self._step_log(current_step).info('Consumer #%s is verified recently, skipping verification',
+                                              self.saga_state.order.consumer_id)
+            self._complete_step_locally(current_step)
+            return
+
+        self._step_log(current_step).info('Verifying consumer #%s ...', self.saga_state.order.consumer_id)
+
+        message_id = self.send_message_to_other_service(
+            current_step,
+            asdict(
+                verify_consumer_details_message.Payload(
+                    consumer_id=self.saga_state.order.consumer_id
+                )
+            )
+        )
+
+        self.saga_state_repository.update(self.saga_id, last_message_id=message_id)
+
+    def verify_consumer_details_on_success(self, step: BaseStep, payload: dict):
+        self._step_log(step).info('Consumer #%s verification succeeded, result = %s',
+                                  self.saga_state.order.consumer_id, payload)
+        consumer_verification_cache.record_verification(self.saga_state.order.consumer_id,
+                                                        command_sent_at=self._get_command_sent_at(step))
+
+    def verify_consumer_details_on_failure(self, step: BaseStep, payload: dict):
+        self._step_log(step).info('Consumer #%s verification failed, result = %s',
+                                  self.saga_state.order.consumer_id, payload)
+
+    def reject_order(self, step: BaseStep):
+        self.saga_state.order.update(status=OrderStatuses.REJECTED)
+        self._step_log(step).info('Compensation: order %s rejected', self.saga_state.order.id)
+
+    def create_restaurant_ticket(self, current_step: AsyncStep):
+        self._step_log(current_step).info('Creating restaurant ticket ...')
+
+        # emulating saga step failure on ORCHESTRATOR side
+        if self.saga_state.order.items[0].quantity == QUANTITY_THAT_WILL_MAKE_ORCHESTRATOR_FAIL:
+            raise KeyError('Incorrect quantity')
+
+        message_id = self.send_message_to_other_service(
+            current_step,
+            asdict(
+                create_ticket_message.Payload(
+                    order_id=self.saga_state.order.id,
+                    customer_id=self.saga_state.order.consumer_id,
+                    items=[
+                        create_ticket_message.OrderItem(
+                            name=item.name,
+                            quantity=item.quantity
+                        )
+                        for item in self.saga_state.order.items
+                    ]
+                )
+            )
+        )
+
+        self.saga_state_repository.update(self.saga_id, last_message_id=message_id)
+
+    def create_restaurant_ticket_on_success(self, step: BaseStep, payload: dict):
+        response = create_ticket_message.Response(**payload)
+        self._step_log(step).info('Restaurant ticket #%s created', response.ticket_id)
+
+        self.saga_state.order.update(restaurant_ticket_id=response.ticket_id)
+
+    def create_restaurant_ticket_on_failure(self, step: BaseStep, payload: dict):
+        self._step_log(step).info('Restaurant ticket creation failed: \n%s', payload)
+
+    def reject_restaurant_ticket(self, current_step: AsyncStep):
+        self._step_log(current_step).info('Compensation: rejecting restaurant ticket #%s ...',
+                                          self.saga_state.order.restaurant_ticket_id)
+
+        message_id = self.send_message_to_other_service(
+            current_step,
+            asdict(
+                reject_ticket_message.Payload(
+                    ticket_id=self.saga_state.order.restaurant_ticket_id
+                )
+            ),
+            # in compensation, it's needed to explicitly set Celery task name
+            task_name=reject_ticket_message.TASK_NAME
+        )
+
+        self.saga_state_repository.update(self.saga_id, last_message_id=message_id)
+
+    def authorize_card(self, current_step: AsyncStep):
+        self._step_log(current_step).info('Authorizing card (amount=%s) ...', self.saga_state.order.price)
+
+        message_id = self.send_message_to_other_service(
+            current_step,
+            asdict(
+                authorize_card_message.Payload(
+                    card_id=self.saga_state.order.card_id,
+                    amount=self.saga_state.order.price
+                )
+            )
+        )
+
+        self.saga_state_repository.update(self.saga_id, last_message_id=message_id)
+
+    def authorize_card_on_success(self, step: BaseStep, payload: dict):
+        response = authorize_card_message.Response(**payload)
+        self._step_log(step).info('Card authorized. Transaction ID: %s', response.transaction_id)
+        self.saga_state.order.update(transaction_id=response.transaction_id)
+
+    def authorize_card_on_failure(self, step: BaseStep, payload: dict):
+        self._step_log(step).info('Card authorization failed: \n%s', payload)
+
+    def approve_restaurant_ticket(self, current_step: AsyncStep):
+        self._step_log(current_step).info('Approving restaurant ticket #%s ...',
+                                          self.saga_state.order.restaurant_ticket_id)
+
+        message_id = self.send_message_to_other_service(
+            current_step,
+            asdict(
+                approve_ticket_message.Payload(
+                    ticket_id=self.saga_state.order.restaurant_ticket_id
+                )
+            )
+        )
+
+        self.saga_state_repository.update(self.saga_id, last_message_id=message_id)
+
+    def approve_restaurant_ticket_on_success(self, step: BaseStep, payload: dict):
+        self._step_log(step).info('Restaurant ticket #%s approved', self.saga_state.order.restaurant_ticket_id)
+
+    def approve_restaurant_ticket_on_failure(self, step: BaseStep, payload: dict):
+        self._step_log(step).info('Restaurant ticket #%s approve failed',
+                                  self.saga_state.order.restaurant_ticket_id)
+
+    def approve_order(self, step: BaseStep):
+        self.saga_state.order.update(status=OrderStatuses.APPROVED)
+        self._step_log(step).info('Order %s approved', self.saga_state.order.id)
@@ -1,17 +1,80 @@
-from celery import Celery
+import logging
+import os
+import typing
+
+from celery import Celery, bootsteps
+from celery.exceptions import ImproperlyConfigured
+from kombu import Exchange, Queue
 from saga_framework import close_sqlalchemy_db_connection_after_celery_task_ends
 
-from order_service.app_common import settings
-from order_service.app_common.messaging import CREATE_ORDER_SAGA_RESPONSE_QUEUE
-from .app import CreateOrderSaga, db, CreateOrderSagaRepository
+from order_service.app_common import settings, metrics
+from order_service.app_common.messaging import create_order_saga_response_queues
+from order_service.app_common.messaging.codec import configure_wire_format
+from order_service.app_common.structured_logging import setup_celery_logging
+# only saga definition and models: web app (routes, metrics aggregation, CLI commands) isn't loaded
+from .create_order_saga import CreateOrderSaga, create_saga_state_repository
+from .models import db
+
+logger = logging.getLogger(__name__)
+
+
+def parse_partitions(partitions: str) -> typing.List[int]:
+    """
+    '0,2-4' -> [0, 2, 3, 4]
+    """
+    result = []
+    for part in partitions.split(','):
+        first, _, last = part.strip().partition('-')
+        result.extend(range(int(first), int(last or first) + 1))
+
+    return result
+
+
+# Response queue partitions this worker consumes (e.g. '0-3'), all by default.
+# To handle responses to one saga one by one, each partition should be consumed by one worker process,
+#  so with partitions set, worker runs one process (see SingleProcessWorker), see readme
+WORKER_PARTITIONS = parse_partitions(os.getenv('CREATE_ORDER_SAGA_WORKER_PARTITIONS')) \
+    if os.getenv('CREATE_ORDER_SAGA_WORKER_PARTITIONS') \
+    else None
+response_queues = create_order_saga_response_queues(WORKER_PARTITIONS)
 
 create_order_saga_responses_celery_app = Celery(
     'create_order_saga_responses',
     broker=settings.CELERY_BROKER)
-create_order_saga_responses_celery_app.conf.task_default_queue = CREATE_ORDER_SAGA_RESPONSE_QUEUE
+create_order_saga_responses_celery_app.conf.task_queues = [
+    # declared the same way as Celery declares queues for sent tasks
+    Queue(name, Exchange(name), routing_key=name) for name in response_queues
+]
+create_order_saga_responses_celery_app.conf.task_default_queue = response_queues[0]
+configure_wire_format(create_order_saga_responses_celery_app)
+
+
+class SingleProcessWorker(bootsteps.Step):
+    """
+    Sets worker concurrency to 1, whatever --concurrency is
+    """
+    requires = {'celery.worker.components:Pool'}  # so it's applied after Pool step reads concurrency
+
+    def __init__(self, worker, **kwargs):
+        if worker.autoscale:
+            raise ImproperlyConfigured(f'Worker consumes partitions {WORKER_PARTITIONS}, it can not be autoscaled')
+        if worker.concurrency != 1:
+            logger.warning('Worker consumes partitions %s, so its concurrency is set to 1 instead of %s',
+                           WORKER_PARTITIONS, worker.concurrency)
+            worker.concurrency = worker.min_concurrency = 1
+        super().__init__(worker, **kwargs)
+
+
+if WORKER_PARTITIONS is not None:
+    create_order_saga_responses_celery_app.steps['worker'].add(SingleProcessWorker)
 
 close_sqlalchemy_db_connection_after_celery_task_ends(db.session)
+setup_celery_logging()
 
-saga_state_repository = CreateOrderSagaRepository()
+saga_state_repository = create_saga_state_repository()
 CreateOrderSaga.register_async_step_handlers(saga_state_repository,
                                              create_order_saga_responses_celery_app)
+
+# e.g. dropped duplicate responses counters
+if os.getenv('WORKER_METRICS_PORT'):
+    metrics.start_http_server(int(os.getenv('WORKER_METRICS_PORT')))
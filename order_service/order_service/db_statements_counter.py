@@ -0,0 +1,54 @@
+"""
+Counts DB statements executed on behalf of each saga.
+
+Usage:
+    statements_counter = SagaStatementsCounter()
+    statements_counter.install(db.engine)
+
+    with statements_counter.counting_for(saga_id):
+        ...  # every statement executed here is attributed to saga_id
+
+    statements_counter.get(saga_id)  # total for this process
+"""
+import collections
+import contextlib
+import contextvars
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_current_saga_id = contextvars.ContextVar('current_saga_id', default=None)
+
+
+class SagaStatementsCounter:
+    def __init__(self, max_sagas: int = 10000):
+        # only most recent sagas are kept, so a long-living worker doesn't leak memory
+        self.max_sagas = max_sagas
+        self._counts = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def install(self, engine: Engine):
+        event.listen(engine, 'before_cursor_execute', self._on_statement)
+
+    @contextlib.contextmanager
+    def counting_for(self, saga_id: int):
+        token = _current_saga_id.set(saga_id)
+        try:
+            yield
+        finally:
+            _current_saga_id.reset(token)
+
+    def get(self, saga_id: int) -> int:
+        with self._lock:
+            return self._counts.get(saga_id, 0)
+
+    def _on_statement(self, *args, **kwargs):
+        saga_id = _current_saga_id.get()
+        if saga_id is None:
+            return
+
+        with self._lock:
+            self._counts[saga_id] = self._counts.pop(saga_id, 0) + 1
+            if len(self._counts) > self.max_sagas:
+                self._counts.popitem(last=False)
@@ -0,0 +1,210 @@
+"""
+DB models of order service.
+
+Importing this module doesn't create tables: run `flask migrate-db` (see order_service.app) for that
+"""
+import contextlib
+import datetime
+import enum
+import os
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy_mixins import AllFeaturesMixin, TimestampsMixin
+
+# Flask app here only holds DB config for Flask-SQLAlchemy.
+#  Routes are added to it in order_service.app, which orchestrator worker doesn't import
+app = Flask('order_service')
+
+current_dir = os.path.abspath(os.path.dirname(__file__))
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('APP_SQLALCHEMY_DATABASE_URI',
+                                                  f"sqlite:///{current_dir}/order_service.sqlite")
+
+db = SQLAlchemy(app, session_options={'autocommit': True})
+
+
+class OrderStatuses(enum.Enum):
+    PENDING_VALIDATION = 'pending_validation'
+    APPROVED = 'approved'
+    REJECTED = 'rejected'
+
+
+class BaseModel(db.Model, AllFeaturesMixin):
+    __abstract__ = True
+    pass
+
+
+class Order(BaseModel):
+    id = db.Column(db.Integer, primary_key=True)
+    # active_history: previous value is loaded (if expired) before it's changed,
+    #  so stats counters know which count to decrement (see stats.py)
+    status = db.column_property(db.Column(db.Enum(OrderStatuses),
+                                          default=OrderStatuses.PENDING_VALIDATION),
+                                active_history=True)
+    consumer_id = db.Column(db.Integer)
+    card_id = db.Column(db.Integer)
+    price = db.Column(db.Integer)
+
+    items = db.relationship("OrderItem", backref="order")
+
+    transaction_id = db.Column(db.String)
+    restaurant_ticket_id = db.Column(db.Integer)
+
+    __table_args__ = (
+        # keyset-paginated lookups by filter column (see queries.py)
+        db.Index('ix_order_status_id', 'status', 'id'),
+        db.Index('ix_order_consumer_id_id', 'consumer_id', 'id'),
+    )
+
+
+class OrderItem(BaseModel):
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), index=True)
+    name = db.Column(db.String)
+    quantity = db.Column(db.Integer)
+
+
+class CreateOrderSagaState(BaseModel, TimestampsMixin):
+    id = db.Column(db.Integer, primary_key=True)
+    last_message_id = db.Column(db.String)
+    last_message_sent_at = db.Column(db.TIMESTAMP)
+    # how many times current step command was re-sent by timeout sweeper
+    timeout_retries = db.Column(db.Integer, default=0, nullable=False)
+    # progress of currently (or lastly) run parallel step group, see parallel_steps.ParallelGroupState
+    parallel_group_state = db.Column(db.JSON)
+
+    # active_history: see Order.status
+    status = db.column_property(db.Column(db.String, default='not_started'), active_history=True)
+    failed_step = db.column_property(db.Column(db.String), active_history=True)
+    failed_at = db.Column(db.TIMESTAMP)
+    failure_details = db.Column(db.JSON)
+
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), index=True)
+    order = db.relationship("Order")
+
+    __table_args__ = (
+        # lookups by status, and by status and age (e.g. finished sagas to archive)
+        db.Index('ix_create_order_saga_state_status_updated_at', 'status', 'updated_at'),
+        # keyset-paginated lookups by filter column (see queries.py)
+        db.Index('ix_create_order_saga_state_status_id', 'status', 'id'),
+        db.Index('ix_create_order_saga_state_failed_step_id', 'failed_step', 'id'),
+        db.Index('ix_create_order_saga_state_created_at', 'created_at'),
+    )
+
+
+class ProcessedSagaResponse(BaseModel):
+    """
+    Step responses already handled by orchestrator, to drop redelivered ones
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    saga_id = db.Column(db.Integer)
+    step = db.Column(db.String)
+    message_id = db.Column(db.String)
+    processed_at = db.Column(db.TIMESTAMP, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('saga_id', 'step', 'message_id'),
+    )
+
+
+# statuses after which saga state doesn't change anymore
+TERMINAL_SAGA_STATUSES = ('succeeded', 'failed')
+# saga states are inserted in advance with this status by async ingress (see asgi.py),
+#  so saga id can be returned to client before order is persisted
+RESERVED_SAGA_STATUS = 'reserved'
+
+
+class CreateOrderSagaStateArchive(BaseModel):
+    """
+    Finished sagas moved out of create_order_saga_state table by archive_finished_sagas()
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    last_message_id = db.Column(db.String)
+    last_message_sent_at = db.Column(db.TIMESTAMP)
+
+    status = db.Column(db.String)
+    failed_step = db.Column(db.String)
+    failed_at = db.Column(db.TIMESTAMP)
+    failure_details = db.Column(db.JSON)
+    parallel_group_state = db.Column(db.JSON)
+
+    order_id = db.Column(db.Integer, index=True)
+
+    created_at = db.Column(db.TIMESTAMP)
+    updated_at = db.Column(db.TIMESTAMP)
+    archived_at = db.Column(db.TIMESTAMP)
+
+
+class CreateOrderSagaStepEvent(BaseModel):
+    """
+    Append-only log of async step responses handled by orchestrator:
+     one row per response, never updated
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    saga_id = db.Column(db.Integer, index=True)
+    step = db.Column(db.String)
+    outcome = db.Column(db.String)  # 'success', 'failure' or 'cached' (completed without command)
+
+    command_sent_at = db.Column(db.TIMESTAMP)
+    response_received_at = db.Column(db.TIMESTAMP)
+    handler_duration_ms = db.Column(db.Float)  # on_success / on_failure handler
+
+
+class OutboxMessage(BaseModel):
+    """
+    Saga commands waiting to be published by outbox relay (see outbox.py).
+    Inserted in the same transaction as saga state change that sends them, deleted once published
+    """
+    id = db.Column(db.Integer, primary_key=True)  # messages are published in id order
+    task_id = db.Column(db.String, nullable=False)
+    task_name = db.Column(db.String, nullable=False)
+    queue = db.Column(db.String, nullable=False)
+    args = db.Column(db.JSON, nullable=False)
+    eta = db.Column(db.TIMESTAMP)  # UTC, for delayed (re-sent) commands
+    created_at = db.Column(db.TIMESTAMP, default=datetime.datetime.utcnow, nullable=False)
+    # set by relay that publishes the message: other relays skip it till then (UTC)
+    claimed_until = db.Column(db.TIMESTAMP)
+
+
+class StatsCounter(BaseModel):
+    """
+    Summary read model: numbers of orders by status and sagas by status and failed step (see stats.py).
+    Each count is a sum over several shard rows, so concurrent transactions rarely update the same row
+    """
+    kind = db.Column(db.String, primary_key=True)  # e.g. 'orders_by_status'
+    key = db.Column(db.String, primary_key=True)  # e.g. 'approved'
+    shard = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    count = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+BaseModel.set_session(db.session)
+
+
+def transaction():
+    """
+    Begins a transaction, or joins the one already begun by caller (session is in autocommit mode)
+    """
+    if db.session().in_transaction():
+        return contextlib.nullcontext()
+    return db.session.begin()
+
+
+# (table, index name, columns) of indexes that were removed from models
+OBSOLETE_INDEXES = [
+    # sagas are never looked up by last message id alone, and the index slowed down each command sent
+    (CreateOrderSagaState.__table__, 'ix_create_order_saga_state_last_message_id', ['last_message_id']),
+]
+
+
+def create_schema():
+    """
+    Creates tables and indexes that don't exist yet
+    """
+    db.create_all()
+    # create_all() skips existing tables, so indexes added to their models later are created here
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+    # and indexes removed from models are dropped
+    for table, index_name, column_names in OBSOLETE_INDEXES:
+        db.Index(index_name, *[table.c[name] for name in column_names]).drop(bind=db.engine, checkfirst=True)
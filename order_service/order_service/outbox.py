@@ -0,0 +1,182 @@
+"""
+Transactional outbox for saga commands.
+
+With OUTBOX_ENABLED=1, orchestrator doesn't publish commands itself: they are inserted into `outbox_message` table
+ in the same DB transaction as saga state change that sends them (see CreateOrderSaga._unit_of_work),
+ so a command is published if and only if the state change is committed,
+ and nothing is published to broker on the request path.
+New sagas are created and started in one transaction as well (see outbox_transaction).
+
+Outbox relay (`flask relay-outbox`, see OutboxRelay) publishes them:
+ * in batches of OUTBOX_RELAY_BATCH_SIZE, in id (insertion) order, over one pooled producer.
+   Publisher confirms are awaited before published rows are deleted
+ * batch rows are claimed first, in a short transaction (FOR UPDATE SKIP LOCKED, then `claimed_until` is set
+   OUTBOX_RELAY_CLAIM_TIMEOUT_SECONDS ahead), so concurrent relays don't publish the same message,
+   and no transaction (or row lock) is open while the batch is published and confirmed.
+   Run one relay to keep order between batches as well
+ * at least once: if relay crashes after publishing a batch but before deleting it, its claim expires
+   and the batch is published again, with the same task ids (they are generated when command is written).
+   Step handler services don't deduplicate commands by task id, so a re-published command is handled again:
+   restaurant tickets are created once per order and their status changes are conditional,
+   and consumer verification only reads, but card authorization is repeated
+
+Metrics: outbox_relay_lag_seconds (age of the oldest message not yet published, as of the last relay batch)
+ and outbox_messages_published_total
+"""
+import contextlib
+import datetime
+import logging
+import os
+import typing
+
+from celery import Celery
+from sqlalchemy import insert, or_
+
+from order_service.app_common import metrics
+from order_service.app_common.messaging.producer import ConfirmBatchingProducerPool
+from order_service.models import db, OutboxMessage, transaction
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_ENABLED = os.getenv('OUTBOX_ENABLED', '0') == '1'
+OUTBOX_RELAY_BATCH_SIZE = int(os.getenv('OUTBOX_RELAY_BATCH_SIZE', 500))
+OUTBOX_RELAY_POLL_INTERVAL_SECONDS = float(os.getenv('OUTBOX_RELAY_POLL_INTERVAL_SECONDS', 0.1))
+# should be longer than publishing a batch takes: batch is published again by another relay after it
+OUTBOX_RELAY_CLAIM_TIMEOUT_SECONDS = float(os.getenv('OUTBOX_RELAY_CLAIM_TIMEOUT_SECONDS', 60))
+
+relay_lag = metrics.Gauge(
+    'outbox_relay_lag_seconds',
+    'Age of the oldest saga command not yet published from outbox, as of the last relay batch')
+messages_published = metrics.Counter(
+    'outbox_messages_published_total', 'Saga commands published from outbox by relay')
+
+
+def outbox_transaction():
+    """
+    Transaction in which saga changes and commands they send (outbox rows) are committed together,
+     e.g. new saga rows and its first-step commands:
+        with outbox_transaction():
+            ...  # create saga state
+            CreateOrderSaga(...).execute()
+    Without outbox, no transaction is begun: commands are published right after
+     saga's own transaction is committed, so it mustn't be joined by an outer one
+    """
+    return transaction() if OUTBOX_ENABLED else contextlib.nullcontext()
+
+
+def write_to_outbox(messages: typing.List[dict]):
+    """
+    Inserts messages (keyword arguments of `Celery.send_task`) into outbox in the current transaction,
+     with one multi-row INSERT
+    """
+    if not messages:
+        return
+
+    now = datetime.datetime.utcnow()
+    db.session.execute(insert(OutboxMessage.__table__), [
+        dict(
+            task_id=message['task_id'],
+            task_name=message['name'],
+            queue=message['queue'],
+            args=message['args'],
+            eta=now + datetime.timedelta(seconds=message['countdown']) if message.get('countdown') else None,
+            created_at=now,
+        )
+        for message in messages
+    ])
+
+
+class OutboxRelay:
+    def __init__(self, celery_app: Celery, producer_pool: ConfirmBatchingProducerPool,
+                 batch_size: int = OUTBOX_RELAY_BATCH_SIZE,
+                 claim_timeout: datetime.timedelta = datetime.timedelta(seconds=OUTBOX_RELAY_CLAIM_TIMEOUT_SECONDS)):
+        self.celery_app = celery_app
+        self.producer_pool = producer_pool
+        self.batch_size = batch_size
+        self.claim_timeout = claim_timeout
+
+    def relay_batch(self) -> int:
+        """
+        Publishes up to `batch_size` oldest messages and deletes them from outbox.
+        Returns number of published messages
+        """
+        rows = self._claim_batch()
+        if rows:
+            row_ids = [row.id for row in rows]
+            try:
+                with self.producer_pool.acquire() as producer:
+                    for row in rows:
+                        self.celery_app.send_task(
+                            row.task_name,
+                            args=row.args,
+                            queue=row.queue,
+                            task_id=row.task_id,
+                            eta=row.eta.replace(tzinfo=datetime.timezone.utc) if row.eta else None,
+                            producer=producer)
+                    # rows are deleted only after broker has confirmed all messages of the batch
+                    producer.flush()
+            except Exception:
+                # so the batch is published again right away, not after claim timeout
+                self._release_claim(row_ids)
+                raise
+
+            with db.session.begin():
+                OutboxMessage.query \
+                    .filter(OutboxMessage.id.in_(row_ids)) \
+                    .delete(synchronize_session=False)
+
+        messages_published.inc(len(rows))
+        self._update_lag()
+        return len(rows)
+
+    def _claim_batch(self) -> list:
+        now = datetime.datetime.utcnow()
+        with db.session.begin():
+            rows = db.session.query(
+                OutboxMessage.id,
+                OutboxMessage.task_id,
+                OutboxMessage.task_name,
+                OutboxMessage.queue,
+                OutboxMessage.args,
+                OutboxMessage.eta,
+            ) \
+                .filter(or_(OutboxMessage.claimed_until.is_(None), OutboxMessage.claimed_until < now)) \
+                .order_by(OutboxMessage.id) \
+                .limit(self.batch_size) \
+                .with_for_update(skip_locked=True) \
+                .all()
+            if rows:
+                OutboxMessage.query \
+                    .filter(OutboxMessage.id.in_([row.id for row in rows])) \
+                    .update(dict(claimed_until=now + self.claim_timeout), synchronize_session=False)
+        return rows
+
+    @staticmethod
+    def _release_claim(row_ids: typing.List[int]):
+        try:
+            with db.session.begin():
+                OutboxMessage.query \
+                    .filter(OutboxMessage.id.in_(row_ids)) \
+                    .update(dict(claimed_until=None), synchronize_session=False)
+        except Exception:
+            logger.exception('Failed to release claim of %s outbox messages, they wait for claim timeout',
+                             len(row_ids))
+
+    def relay_all(self) -> int:
+        """
+        Publishes batches till outbox is empty. Returns number of published messages
+        """
+        published_count = 0
+        while True:
+            batch_count = self.relay_batch()
+            published_count += batch_count
+            if batch_count < self.batch_size:
+                return published_count
+
+    def _update_lag(self):
+        oldest_created_at = db.session.query(OutboxMessage.created_at) \
+            .order_by(OutboxMessage.id) \
+            .limit(1) \
+            .scalar()
+        lag = (datetime.datetime.utcnow() - oldest_created_at).total_seconds() if oldest_created_at else 0
+        relay_lag.set(lag)
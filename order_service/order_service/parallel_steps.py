@@ -0,0 +1,67 @@
+"""
+Group of async steps which are run concurrently:
+ commands of all group steps are sent at once, and saga moves on to the next step
+ only when all of them succeeded.
+If any of group steps fails, group steps that already succeeded are compensated
+ (and ones that succeed later are compensated as soon as their response comes).
+
+Progress of a group is kept in saga state as JSON, see ParallelGroupState.
+"""
+import datetime
+import typing
+
+from saga_framework import AsyncStep, BaseStep, NO_ACTION
+
+
+class ParallelStepGroup(BaseStep):
+    def __init__(self, name: str, steps: typing.List[AsyncStep],
+                 action: typing.Callable = NO_ACTION,
+                 compensation: typing.Callable = NO_ACTION):
+        super().__init__(name=name, action=action, compensation=compensation)
+        self.steps = steps
+
+
+class ParallelGroupStepStatuses:
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    COMPENSATED = 'compensated'
+
+
+class ParallelGroupState:
+    """
+    Stored as JSON like
+        {"group": "verify_consumer_and_create_ticket",
+         "failed": false,
+         "steps": {"verify_consumer_details": {"status": "succeeded", "sent_at": "2021-01-01T00:00:00"},
+                   "create_restaurant_ticket": {"status": "running", "sent_at": "2021-01-01T00:00:00"}}}
+    """
+    def __init__(self, data: dict = None):
+        data = data or {}
+        self.group_name = data.get('group')  # type: str
+        self.failed = data.get('failed', False)  # type: bool
+        self.steps = {name: dict(step) for name, step in data.get('steps', {}).items()}
+
+    @classmethod
+    def started(cls, group: ParallelStepGroup) -> 'ParallelGroupState':
+        return cls({'group': group.name, 'steps': {}})
+
+    def to_json(self) -> dict:
+        return {'group': self.group_name, 'failed': self.failed, 'steps': self.steps}
+
+    def get_status(self, step: BaseStep) -> typing.Union[str, None]:
+        return self.steps.get(step.name, {}).get('status')
+
+    def set_status(self, step: BaseStep, status: str):
+        self.steps.setdefault(step.name, {})['status'] = status
+
+    def set_sent(self, step: BaseStep, sent_at: datetime.datetime):
+        self.steps.setdefault(step.name, {}).update(status=ParallelGroupStepStatuses.RUNNING,
+                                                    sent_at=sent_at.isoformat())
+
+    def get_sent_at(self, step: BaseStep) -> typing.Union[datetime.datetime, None]:
+        sent_at = self.steps.get(step.name, {}).get('sent_at')
+        return datetime.datetime.fromisoformat(sent_at) if sent_at else None
+
+    def steps_with_status(self, group: ParallelStepGroup, status: str) -> typing.List[AsyncStep]:
+        return [step for step in group.steps if self.get_status(step) == status]
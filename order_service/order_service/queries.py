@@ -0,0 +1,210 @@
+"""
+Read API for operations: sagas and orders, filtered and paginated with keyset (cursor) pagination.
+
+Pages are ordered by id, newest first. Cursor is an opaque token with the last returned id,
+ so next page is read with `WHERE <filters> AND id < :last_id ORDER BY id DESC LIMIT :limit`
+ over (filter column, id) indexes, however deep the page is.
+Related orders and order items are loaded with `selectinload`, i.e. with two more queries per chunk
+ of STREAM_CHUNK_SIZE rows, whatever number of rows is in the page.
+Response is streamed chunk by chunk, so a large page isn't built in memory:
+    {"items": [...], "next_cursor": "eyJpZCI6IDEyM30="}
+`next_cursor` is null on the last page.
+
+Only sagas in `create_order_saga_state` table are listed, archived ones are not (see archive_finished_sagas).
+One saga, archived or not, is read by id with get_saga() (e.g. to see outcome of order submitted to async ingress)
+"""
+import base64
+import datetime
+import json
+import os
+import typing
+
+from sqlalchemy.orm import Query, selectinload
+
+from order_service.models import Order, OrderItem, OrderStatuses, CreateOrderSagaState, CreateOrderSagaStateArchive
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = int(os.getenv('QUERY_API_MAX_PAGE_SIZE', 1000))
+# rows fetched from DB (and their orders and items loaded) at a time
+STREAM_CHUNK_SIZE = 200
+
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({'id': last_id}).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(json.loads(base64.urlsafe_b64decode(cursor.encode()))['id'])
+    except (ValueError, TypeError, KeyError) as exc:
+        raise ValueError(f'Incorrect cursor: {cursor!r}') from exc
+
+
+def _parse_datetime(args: typing.Mapping[str, str], name: str) -> typing.Optional[datetime.datetime]:
+    value = args.get(name)
+    if not value:
+        return None
+
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError as exc:
+        raise ValueError(f'Incorrect {name}: {value!r}, ISO 8601 datetime expected') from exc
+
+
+def _parse_int(args: typing.Mapping[str, str], name: str) -> typing.Optional[int]:
+    value = args.get(name)
+    if not value:
+        return None
+
+    try:
+        return int(value)
+    except ValueError as exc:
+        raise ValueError(f'Incorrect {name}: {value!r}, integer expected') from exc
+
+
+def _parse_list(args: typing.Mapping[str, str], name: str) -> typing.List[str]:
+    # both ?status=a,b and ?status=a&status=b
+    values = args.getlist(name) if hasattr(args, 'getlist') else [args.get(name) or '']
+    return [value for values_str in values for value in values_str.split(',') if value]
+
+
+def parse_page_size(args: typing.Mapping[str, str]) -> int:
+    limit = _parse_int(args, 'limit')
+    if limit is None:
+        return DEFAULT_PAGE_SIZE
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f'limit should be between 1 and {MAX_PAGE_SIZE}')
+
+    return limit
+
+
+def _paginated(query: Query, model, args: typing.Mapping[str, str]) -> Query:
+    cursor = args.get('cursor')
+    if cursor:
+        query = query.filter(model.id < decode_cursor(cursor))
+
+    return query.order_by(model.id.desc())
+
+
+def sagas_query(args: typing.Mapping[str, str]) -> Query:
+    """
+    Filters (all optional):
+     * status - one or more saga statuses, e.g. `status=failed` or `status=authorize_card.running,failed`
+     * failed_step - name of the step saga failed on
+     * created_from, created_to - saga creation time range (ISO 8601, UTC), `created_from <= created_at < created_to`
+     * cursor - `next_cursor` of the previous page
+    Raises ValueError for incorrect filters
+    """
+    query = CreateOrderSagaState.query \
+        .options(selectinload(CreateOrderSagaState.order).selectinload(Order.items))
+
+    statuses = _parse_list(args, 'status')
+    if statuses:
+        query = query.filter(CreateOrderSagaState.status.in_(statuses))
+    if args.get('failed_step'):
+        query = query.filter(CreateOrderSagaState.failed_step == args['failed_step'])
+
+    created_from = _parse_datetime(args, 'created_from')
+    if created_from:
+        query = query.filter(CreateOrderSagaState.created_at >= created_from)
+    created_to = _parse_datetime(args, 'created_to')
+    if created_to:
+        query = query.filter(CreateOrderSagaState.created_at < created_to)
+
+    return _paginated(query, CreateOrderSagaState, args)
+
+
+def orders_query(args: typing.Mapping[str, str]) -> Query:
+    """
+    Filters (all optional):
+     * status - one or more order statuses (pending_validation, approved, rejected)
+     * consumer_id
+     * cursor - `next_cursor` of the previous page
+    Raises ValueError for incorrect filters
+    """
+    query = Order.query.options(selectinload(Order.items))
+
+    statuses = _parse_list(args, 'status')
+    if statuses:
+        query = query.filter(Order.status.in_([OrderStatuses(status) for status in statuses]))
+    consumer_id = _parse_int(args, 'consumer_id')
+    if consumer_id is not None:
+        query = query.filter(Order.consumer_id == consumer_id)
+
+    return _paginated(query, Order, args)
+
+
+def _isoformat(value: typing.Optional[datetime.datetime]) -> typing.Optional[str]:
+    return value.isoformat() if value else None
+
+
+def serialize_order_item(item: OrderItem) -> dict:
+    return {'name': item.name, 'quantity': item.quantity}
+
+
+def serialize_order(order: typing.Optional[Order]) -> typing.Optional[dict]:
+    if order is None:
+        return None
+
+    return {
+        'id': order.id,
+        'status': order.status.value if order.status else None,
+        'consumer_id': order.consumer_id,
+        'card_id': order.card_id,
+        'price': order.price,
+        'transaction_id': order.transaction_id,
+        'restaurant_ticket_id': order.restaurant_ticket_id,
+        'items': [serialize_order_item(item) for item in order.items],
+    }
+
+
+def serialize_saga(saga_state: typing.Union[CreateOrderSagaState, CreateOrderSagaStateArchive]) -> dict:
+    return {
+        'id': saga_state.id,
+        'status': saga_state.status,
+        'failed_step': saga_state.failed_step,
+        'failed_at': _isoformat(saga_state.failed_at),
+        'failure_details': saga_state.failure_details,
+        'created_at': _isoformat(saga_state.created_at),
+        'updated_at': _isoformat(saga_state.updated_at),
+        # archive has no relationship to order, see get_saga
+        'order': serialize_order(getattr(saga_state, 'order', None)),
+    }
+
+
+def get_saga(saga_id: int) -> typing.Optional[dict]:
+    saga_state = CreateOrderSagaState.query \
+        .options(selectinload(CreateOrderSagaState.order).selectinload(Order.items)) \
+        .filter_by(id=saga_id) \
+        .one_or_none()
+    if saga_state is not None:
+        return serialize_saga(saga_state)
+
+    archived_saga_state = CreateOrderSagaStateArchive.query.filter_by(id=saga_id).one_or_none()
+    if archived_saga_state is None:
+        return None
+    order = Order.query.options(selectinload(Order.items)).filter_by(id=archived_saga_state.order_id).one_or_none() \
+        if archived_saga_state.order_id else None
+    return dict(serialize_saga(archived_saga_state), order=serialize_order(order),
+                archived_at=_isoformat(archived_saga_state.archived_at))
+
+
+def stream_page(query: Query, limit: int, serialize: typing.Callable[[typing.Any], dict]) -> typing.Iterator[str]:
+    """
+    Yields JSON page by parts: opening, one part per row and closing with next page cursor
+    """
+    yield '{"items": ['
+
+    last_id = None
+    has_next_page = False
+    # one more row is read to know whether there's a next page
+    for count, row in enumerate(query.limit(limit + 1).yield_per(STREAM_CHUNK_SIZE)):
+        if count == limit:
+            has_next_page = True
+            continue
+
+        yield (', ' if count else '') + json.dumps(serialize(row))
+        last_id = row.id
+
+    next_cursor = encode_cursor(last_id) if has_next_page else None
+    yield '], "next_cursor": ' + json.dumps(next_cursor) + '}'
@@ -0,0 +1,35 @@
+"""
+Bounded set of recently seen keys, least recently added ones are evicted first.
+
+Usage:
+    processed_responses = RecentKeys(max_size=100000)
+
+    if key in processed_responses:
+        ...  # seen recently
+    processed_responses.add(key)
+"""
+import collections
+import threading
+import typing
+
+
+class RecentKeys:
+    def __init__(self, max_size: int = 100000):
+        self.max_size = max_size
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: typing.Hashable) -> bool:
+        with self._lock:
+            return key in self._keys
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._keys)
+
+    def add(self, key: typing.Hashable):
+        with self._lock:
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+            if len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
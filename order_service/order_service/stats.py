@@ -0,0 +1,223 @@
+"""
+Incrementally maintained counters: number of orders by status, sagas by status and sagas by failed step,
+ so they are read without GROUP BY over orders and sagas (see `GET /stats`).
+
+Counts are changed in the same transaction as the rows they count:
+ * ORM inserts and updates of Order and CreateOrderSagaState (e.g. `Order.update(status=...)`)
+   are picked up by mapper events. Counted columns have active history, so previous value is known
+ * bulk UPDATEs (`CoalescingCreateOrderSagaRepository`, async ingress) record their changes explicitly,
+   see record_saga_state_update() and record_change()
+Changes are accumulated in session and written right before commit, with one statement:
+ counter rows are locked only till commit, and always in the same order, so writers don't deadlock.
+Each count is spread over STATS_COUNTER_SHARDS rows (shard is chosen randomly per transaction),
+ so concurrent transactions rarely wait for each other. Reading sums at most (keys x shards) rows,
+ however many orders there are.
+
+Archived sagas are still counted: counts are for all sagas ever created.
+If counters drift (e.g. rows were changed by hand), rebuild them from base tables:
+    PYTHONPATH=. FLASK_APP=order_service.app flask reconcile-stats
+
+Usage:
+    stats_counters.install(db.session)  # once per process
+    stats_counters.read()  # -> {'orders_by_status': {'approved': 10, ...}, 'sagas_by_status': ..., ...}
+    stats_counters.count_excluding(SAGAS_BY_STATUS, TERMINAL_SAGA_STATUSES)  # -> 5
+"""
+import collections
+import os
+import random
+import typing
+
+from sqlalchemy import event, func, inspect, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, scoped_session, object_session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+
+from order_service.models import db, Order, CreateOrderSagaState, CreateOrderSagaStateArchive, StatsCounter, \
+    transaction
+
+STATS_COUNTER_SHARDS = int(os.getenv('STATS_COUNTER_SHARDS', 8))
+
+ORDERS_BY_STATUS = 'orders_by_status'
+SAGAS_BY_STATUS = 'sagas_by_status'
+SAGAS_BY_FAILED_STEP = 'sagas_by_failed_step'
+KINDS = [ORDERS_BY_STATUS, SAGAS_BY_STATUS, SAGAS_BY_FAILED_STEP]
+
+# counted columns of each model: (counter kind, attribute name)
+COUNTED_ATTRIBUTES = {
+    Order: [(ORDERS_BY_STATUS, 'status')],
+    CreateOrderSagaState: [(SAGAS_BY_STATUS, 'status'), (SAGAS_BY_FAILED_STEP, 'failed_step')],
+}
+
+# session.info key of changes not yet written: {(kind, key): delta}
+_DELTAS_KEY = 'stats_counter_deltas'
+
+
+def _counter_key(value) -> typing.Optional[str]:
+    return value.value if hasattr(value, 'value') else value  # enums are counted by value
+
+
+class StatsCounters:
+    def __init__(self, shards: int = STATS_COUNTER_SHARDS):
+        self.shards = shards
+        self._installed = False
+
+    def install(self, session: typing.Union[Session, scoped_session]):
+        if self._installed:
+            return
+
+        for model in COUNTED_ATTRIBUTES:
+            event.listen(model, 'after_insert', self._on_insert)
+            event.listen(model, 'after_update', self._on_update)
+        event.listen(session, 'before_commit', self._write_deltas)
+        event.listen(session, 'after_rollback', self._discard_deltas)
+        self._installed = True
+
+    def record_change(self, kind: str, old_key: typing.Optional[str], new_key: typing.Optional[str],
+                      count: int = 1, session: Session = None):
+        """
+        Records that `count` rows changed from `old_key` to `new_key` (None - not counted, e.g. new row).
+        Written when current transaction is committed
+        """
+        old_key, new_key = _counter_key(old_key), _counter_key(new_key)
+        if old_key == new_key or not count:
+            return
+
+        deltas = (session or db.session()).info.setdefault(_DELTAS_KEY, collections.Counter())
+        if old_key is not None:
+            deltas[(kind, old_key)] -= count
+        if new_key is not None:
+            deltas[(kind, new_key)] += count
+
+    def record_saga_state_update(self, saga_id: int, fields_to_update: dict):
+        """
+        To be called (in a transaction) when saga state is changed with a bulk UPDATE,
+         which mapper events don't see.
+        Current values are taken from saga state loaded in session (orchestrator loads it at the start of a task),
+         or else read, locking saga state row till commit.
+        Loaded saga state gets new values of counted columns, so the next change is counted from them
+        """
+        counted = COUNTED_ATTRIBUTES[CreateOrderSagaState]
+        if not any(attribute in fields_to_update for _, attribute in counted):
+            return
+
+        saga_state = db.session().identity_map.get(identity_key(CreateOrderSagaState, saga_id))
+        if saga_state is not None and not inspect(saga_state).unloaded & {attribute for _, attribute in counted}:
+            current = [inspect(saga_state).attrs[attribute].loaded_value for _, attribute in counted]
+        else:
+            saga_state = None
+            current = db.session.query(*[getattr(CreateOrderSagaState, attribute) for _, attribute in counted]) \
+                .filter_by(id=saga_id) \
+                .with_for_update() \
+                .one()
+
+        for (kind, attribute), current_value in zip(counted, current):
+            new_value = fields_to_update.get(attribute, current_value)
+            self.record_change(kind, current_value, new_value)
+            if saga_state is not None:
+                set_committed_value(saga_state, attribute, new_value)
+
+    def read(self) -> typing.Dict[str, typing.Dict[str, int]]:
+        rows = db.session.query(StatsCounter.kind, StatsCounter.key, func.sum(StatsCounter.count)) \
+            .group_by(StatsCounter.kind, StatsCounter.key) \
+            .all()
+
+        counts = {kind: {} for kind in KINDS}
+        for kind, key, count in rows:
+            if count:
+                counts.setdefault(kind, {})[key] = int(count)
+        return counts
+
+    def count_excluding(self, kind: str, excluded_keys: typing.Iterable[str]) -> int:
+        """
+        Sum of `kind` counts over all keys except `excluded_keys`, e.g. number of unfinished sagas.
+        Reads only counter rows of `kind` (first primary key column), at most (keys x shards) of them
+        """
+        return int(db.session.query(func.coalesce(func.sum(StatsCounter.count), 0))
+                   .filter(StatsCounter.kind == kind, StatsCounter.key.notin_(list(excluded_keys)))
+                   .scalar())
+
+    def rebuild(self) -> typing.Dict[str, typing.Dict[str, int]]:
+        """
+        Recounts everything from orders, sagas and archived sagas. Returns new counts
+        """
+        with transaction():
+            if db.engine.dialect.name == 'postgresql':
+                # writers wait for rebuild before commit, so their changes are counted exactly once
+                db.session.execute(f'LOCK TABLE {StatsCounter.__tablename__} IN EXCLUSIVE MODE')
+            StatsCounter.query.delete(synchronize_session=False)
+
+            counts = {kind: collections.Counter() for kind in KINDS}
+            for kind, column in [(ORDERS_BY_STATUS, Order.status),
+                                 (SAGAS_BY_STATUS, CreateOrderSagaState.status),
+                                 (SAGAS_BY_STATUS, CreateOrderSagaStateArchive.status),
+                                 (SAGAS_BY_FAILED_STEP, CreateOrderSagaState.failed_step),
+                                 (SAGAS_BY_FAILED_STEP, CreateOrderSagaStateArchive.failed_step)]:
+                rows = db.session.query(column, func.count()).filter(column.isnot(None)).group_by(column)
+                for value, count in rows:
+                    counts[kind][_counter_key(value)] += count
+
+            rows = [dict(kind=kind, key=key, shard=0, count=count)
+                    for kind, kind_counts in counts.items() for key, count in kind_counts.items()]
+            if rows:
+                db.session.execute(insert(StatsCounter.__table__), rows)
+
+        return {kind: dict(kind_counts) for kind, kind_counts in counts.items()}
+
+    def _on_insert(self, mapper, connection, target):
+        for kind, attribute in COUNTED_ATTRIBUTES[type(target)]:
+            self.record_change(kind, None, getattr(target, attribute), session=object_session(target))
+
+    def _on_update(self, mapper, connection, target):
+        state = inspect(target)
+        for kind, attribute in COUNTED_ATTRIBUTES[type(target)]:
+            history = state.attrs[attribute].history
+            if history.added or history.deleted:
+                self.record_change(kind,
+                                   history.deleted[0] if history.deleted else None,
+                                   history.added[0] if history.added else None,
+                                   session=state.session)
+
+    def _write_deltas(self, session: Session):
+        deltas = session.info.pop(_DELTAS_KEY, None)
+        if not deltas:
+            return
+
+        shard = random.randrange(self.shards)
+        # sorted, so counter rows are locked in the same order by all writers
+        rows = [dict(kind=kind, key=key, shard=shard, count=delta)
+                for (kind, key), delta in sorted(deltas.items()) if delta]
+        if not rows:
+            return
+
+        connection = session.connection()
+        dialect_insert = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}.get(connection.dialect.name)
+        if dialect_insert is None:
+            self._write_rows_one_by_one(connection, rows)
+            return
+
+        statement = dialect_insert(StatsCounter.__table__)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=['kind', 'key', 'shard'],
+            set_={'count': StatsCounter.__table__.c.count + statement.excluded['count']}
+        ), rows)
+
+    @staticmethod
+    def _write_rows_one_by_one(connection, rows: typing.List[dict]):
+        # for DBs without INSERT ... ON CONFLICT
+        table = StatsCounter.__table__
+        for row in rows:
+            updated = connection.execute(
+                table.update()
+                .where(table.c.kind == row['kind'], table.c.key == row['key'], table.c.shard == row['shard'])
+                .values(count=table.c.count + row['count'])
+            ).rowcount
+            if not updated:
+                connection.execute(table.insert(), row)
+
+    @staticmethod
+    def _discard_deltas(session: Session):
+        session.info.pop(_DELTAS_KEY, None)
+
+
+stats_counters = StatsCounters()
@@ -1 +1 @@
-PYTHONPATH=. celery -A order_service.create_order_saga_worker worker --loglevel=INFO
\ No newline at end of file
+PYTHONPATH=. celery -A order_service.create_order_saga_worker worker --loglevel=INFO "$@"
\ No newline at end of file
@@ -0,0 +1,31 @@
+"""
+Batch mode of restaurant_service worker (see app_common/messaging/batch_consumer.py):
+ ticket creation commands are handled in batches,
+ and responses to a batch are published at once.
+
+Ticket approval and rejection commands of a batch are handled in bulk: all tickets are changed
+ with one statement (see ticket_store.py), each approval still gets its own response.
+
+Run it instead of Celery worker with
+    PYTHONPATH=. python -m restaurant_service.batch_worker
+"""
+from restaurant_service.app_common.messaging import restaurant_service_messaging, \
+    create_order_saga_response_queue
+from restaurant_service.app_common.messaging.batch_consumer import BatchCommandConsumer
+from restaurant_service.app_common.messaging.restaurant_service_messaging import \
+    create_ticket_message, approve_ticket_message, reject_ticket_message
+from .worker import command_handlers_celery_app, create_ticket, approve_tickets, reject_tickets
+
+consumer = BatchCommandConsumer(
+    command_handlers_celery_app,
+    queue_name=restaurant_service_messaging.COMMANDS_QUEUE,
+    handlers={create_ticket_message.TASK_NAME: create_ticket},
+    bulk_handlers={
+        approve_ticket_message.TASK_NAME: approve_tickets,
+        reject_ticket_message.TASK_NAME: reject_tickets,
+    },
+    response_queue=create_order_saga_response_queue,
+)
+
+if __name__ == '__main__':
+    consumer.run()
@@ -0,0 +1,84 @@
+"""
+DB models of restaurant service.
+
+Importing this module doesn't create tables: run `python -m restaurant_service.models` for that
+ (run_worker.sh does it before starting the worker)
+"""
+import datetime
+import enum
+import os
+
+from sqlalchemy import create_engine, event, Column, Integer, String, JSON, TIMESTAMP, Index
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import declarative_base
+
+current_dir = os.path.abspath(os.path.dirname(__file__))
+DATABASE_URI = os.getenv('RESTAURANT_SQLALCHEMY_DATABASE_URI', f"sqlite:///{current_dir}/restaurant_service.sqlite")
+# how long SQLite waits for a lock held by another connection (e.g. of another worker process) before failing
+SQLITE_BUSY_TIMEOUT_SECONDS = 30
+
+Base = declarative_base()
+
+
+class TicketStatuses(enum.Enum):
+    CREATED = 'created'
+    APPROVED = 'approved'
+    REJECTED = 'rejected'
+
+
+class Ticket(Base):
+    __tablename__ = 'ticket'
+
+    id = Column(Integer, primary_key=True)  # ticket id, returned to orchestrator
+    # one ticket per order: redelivered create_ticket commands get the already created ticket
+    order_id = Column(Integer, nullable=False)
+    saga_id = Column(Integer)
+    customer_id = Column(Integer)
+    items = Column(JSON)
+    status = Column(String, nullable=False, default=TicketStatuses.CREATED.value)
+    created_at = Column(TIMESTAMP, default=datetime.datetime.utcnow, nullable=False)
+    updated_at = Column(TIMESTAMP, default=datetime.datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        Index('ix_ticket_order_id', 'order_id', unique=True),
+    )
+
+
+def make_engine(database_uri: str = DATABASE_URI) -> Engine:
+    if database_uri.startswith('sqlite'):
+        engine = create_engine(database_uri, connect_args={'timeout': SQLITE_BUSY_TIMEOUT_SECONDS})
+
+        @event.listens_for(engine, 'connect')
+        def _on_connect(dbapi_connection, connection_record):
+            # readers don't wait for writers of other processes
+            dbapi_connection.execute('PRAGMA journal_mode=WAL')
+            # transactions are begun below, not by pysqlite
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(engine, 'begin')
+        def _on_begin(connection):
+            # write lock is taken when transaction begins, not on its first write:
+            #  SQLite has no SELECT ... FOR UPDATE, and concurrent transactions can't upgrade their locks
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+        return engine
+    return create_engine(database_uri, pool_pre_ping=True)
+
+
+engine = make_engine()
+
+
+def create_schema(bind: Engine = None):
+    """
+    Creates tables and indexes that don't exist yet
+    """
+    bind = bind or engine
+    Base.metadata.create_all(bind)
+    # create_all() skips existing tables, so indexes added to their models later are created here
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
+
+
+if __name__ == '__main__':
+    create_schema()
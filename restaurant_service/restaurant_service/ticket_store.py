@@ -0,0 +1,181 @@
+"""
+Restaurant tickets, stored in `ticket` table (see models.py).
+
+ * tickets get unique ids from the DB, and there's one ticket per order:
+   creating a ticket for an order that already has one (e.g. redelivered command) returns the existing ticket
+ * status changes (created -> approved / rejected) are conditional UPDATEs (`... WHERE status = 'created'`),
+   so of concurrent approval and rejection of a ticket exactly one wins, without read-modify-write races.
+   Repeating a change that's already done (e.g. redelivered command) succeeds without changing anything
+ * tickets are approved and rejected in bulk with one statement per batch (approve_many(), reject_many()),
+   each ticket of a batch gets its own result
+
+Usage:
+    ticket_id = ticket_store.create(order_id=1, saga_id=1, customer_id=75, items=[...])
+    ticket_store.approve(ticket_id)  # raises TicketNotFound or TicketStatusConflict
+    result = ticket_store.reject_many([ticket_id, 2, 3])
+    result.error_for(2)  # -> None or exception to fail command about ticket 2 with
+
+Metric: ticket_transitions_total{status, result} (result: changed, unchanged, conflict, missing)
+"""
+import datetime
+import typing
+from dataclasses import dataclass, field
+
+from sqlalchemy import select, update, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+
+from restaurant_service.app_common import metrics
+from .models import engine as default_engine, Ticket, TicketStatuses
+
+ticket_transitions = metrics.Counter(
+    'ticket_transitions_total',
+    'Requested ticket status changes, by result (unchanged - ticket already had this status)',
+    labelnames=['status', 'result'])
+
+
+class TicketNotFound(ValueError):
+    pass
+
+
+class TicketStatusConflict(ValueError):
+    pass
+
+
+@dataclass
+class TransitionResult:
+    status: TicketStatuses
+    changed: typing.List[int] = field(default_factory=list)  # changed by this call
+    unchanged: typing.List[int] = field(default_factory=list)  # already had the requested status
+    conflicts: typing.Dict[int, str] = field(default_factory=dict)  # ticket id -> current (other final) status
+    missing: typing.List[int] = field(default_factory=list)
+
+    def error_for(self, ticket_id: int) -> typing.Optional[ValueError]:
+        if ticket_id in self.missing:
+            return TicketNotFound(f'Ticket {ticket_id} not found')
+        if ticket_id in self.conflicts:
+            return TicketStatusConflict(f'Ticket {ticket_id} is {self.conflicts[ticket_id]}, '
+                                        f'it can not become {self.status.value}')
+        return None
+
+
+class TicketStore:
+    def __init__(self, engine: Engine = default_engine):
+        self.engine = engine
+
+    def create(self, order_id: int, saga_id: int, customer_id: int, items: typing.List[dict]) -> int:
+        """
+        Creates ticket of the order, unless order already has one. Returns ticket id
+        """
+        row = dict(order_id=order_id, saga_id=saga_id, customer_id=customer_id, items=items,
+                   status=TicketStatuses.CREATED.value)
+        with self.engine.begin() as connection:
+            dialect_insert = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}.get(connection.dialect.name)
+            if dialect_insert is not None:
+                connection.execute(dialect_insert(Ticket.__table__)
+                                   .on_conflict_do_nothing(index_elements=['order_id']), row)
+            else:
+                self._insert_unless_exists(connection, row)
+
+            return connection.execute(select(Ticket.id).where(Ticket.order_id == order_id)).scalar_one()
+
+    @staticmethod
+    def _insert_unless_exists(connection: Connection, row: dict):
+        # for DBs without INSERT ... ON CONFLICT
+        savepoint = connection.begin_nested()
+        try:
+            connection.execute(insert(Ticket.__table__), row)
+        except IntegrityError:
+            savepoint.rollback()
+        else:
+            savepoint.commit()
+
+    def get(self, ticket_id: int) -> typing.Optional[dict]:
+        with self.engine.connect() as connection:
+            row = connection.execute(select(Ticket.__table__).where(Ticket.id == ticket_id)).first()
+        return dict(row._mapping) if row else None
+
+    def get_by_order(self, order_id: int) -> typing.Optional[dict]:
+        with self.engine.connect() as connection:
+            row = connection.execute(select(Ticket.__table__).where(Ticket.order_id == order_id)).first()
+        return dict(row._mapping) if row else None
+
+    def approve(self, ticket_id: int) -> bool:
+        """
+        Returns whether ticket was approved by this call (False - it was approved before)
+        """
+        return self._transition_one(ticket_id, TicketStatuses.APPROVED)
+
+    def reject(self, ticket_id: int) -> bool:
+        """
+        Returns whether ticket was rejected by this call (False - it was rejected before)
+        """
+        return self._transition_one(ticket_id, TicketStatuses.REJECTED)
+
+    def approve_many(self, ticket_ids: typing.Iterable[int]) -> TransitionResult:
+        return self.transition(ticket_ids, TicketStatuses.APPROVED)
+
+    def reject_many(self, ticket_ids: typing.Iterable[int]) -> TransitionResult:
+        return self.transition(ticket_ids, TicketStatuses.REJECTED)
+
+    def _transition_one(self, ticket_id: int, status: TicketStatuses) -> bool:
+        result = self.transition([ticket_id], status)
+        error = result.error_for(ticket_id)
+        if error:
+            raise error
+        return ticket_id in result.changed
+
+    def transition(self, ticket_ids: typing.Iterable[int], status: TicketStatuses) -> TransitionResult:
+        """
+        Changes status of created tickets among `ticket_ids` to `status`, in one transaction
+        """
+        ticket_ids = sorted(set(ticket_ids))  # rows are locked in the same order by all writers
+        result = TransitionResult(status=status)
+        if not ticket_ids:
+            return result
+
+        statement = update(Ticket.__table__) \
+            .where(Ticket.id.in_(ticket_ids), Ticket.status == TicketStatuses.CREATED.value) \
+            .values(status=status.value, updated_at=datetime.datetime.utcnow())
+        with self.engine.begin() as connection:
+            if connection.dialect.full_returning:
+                result.changed = sorted(connection.execute(statement.returning(Ticket.id)).scalars())
+            else:
+                # lock candidates first, so UPDATE changes exactly them
+                #  (SQLite transactions are started with BEGIN IMMEDIATE instead, see models.make_engine)
+                candidates = connection.execute(
+                    select(Ticket.id)
+                    .where(Ticket.id.in_(ticket_ids), Ticket.status == TicketStatuses.CREATED.value)
+                    .order_by(Ticket.id)
+                    .with_for_update()
+                ).scalars().all()
+                if candidates:
+                    connection.execute(statement.where(Ticket.id.in_(candidates)))
+                result.changed = candidates
+
+            changed = set(result.changed)
+            current_statuses = dict(connection.execute(
+                select(Ticket.id, Ticket.status).where(Ticket.id.in_([id_ for id_ in ticket_ids
+                                                                      if id_ not in changed]))
+            ).all()) if len(changed) < len(ticket_ids) else {}
+
+        for ticket_id in ticket_ids:
+            if ticket_id in changed:
+                continue
+            current_status = current_statuses.get(ticket_id)
+            if current_status is None:
+                result.missing.append(ticket_id)
+            elif current_status == status.value:
+                result.unchanged.append(ticket_id)
+            else:
+                result.conflicts[ticket_id] = current_status
+
+        for result_name, ids in [('changed', result.changed), ('unchanged', result.unchanged),
+                                 ('conflict', result.conflicts), ('missing', result.missing)]:
+            if ids:
+                ticket_transitions.inc(len(ids), status=status.value, result=result_name)
+        return result
+
+
+ticket_store = TicketStore()
@@ -1,68 +1,126 @@
 import logging
+import os
 import random
 import typing
 from dataclasses import asdict
 
 from celery import Celery, Task
-from saga_framework import saga_step_handler, no_response_saga_step_handler
-from saga_framework.celery_utils import auto_retry_then_reraise
+from saga_framework import no_response_saga_step_handler
 
-from restaurant_service.app_common import settings
+from restaurant_service.app_common import settings, metrics
 from restaurant_service.app_common.messaging import \
     restaurant_service_messaging, \
-    CREATE_ORDER_SAGA_RESPONSE_QUEUE
+    create_order_saga_response_queue
 from restaurant_service.app_common.messaging.restaurant_service_messaging import \
     create_ticket_message, reject_ticket_message, approve_ticket_message
+from restaurant_service.app_common.messaging.codec import configure_wire_format, decode_payload
+from restaurant_service.app_common.messaging.saga_handlers import saga_step_handler
+from restaurant_service.app_common.simulation import simulated, simulate_each, simulator, configure_simulated_worker
+from restaurant_service.app_common.resilience import RetryPolicy, retry_with_backoff, circuit_breakers
+from restaurant_service.app_common.structured_logging import setup_logging, setup_celery_logging, saga_logger
+from .ticket_store import ticket_store, TicketNotFound, TicketStatusConflict
 
-logging.basicConfig(level=logging.DEBUG)
+setup_logging()
+setup_celery_logging()
+
+logger = logging.getLogger(__name__)
 
 command_handlers_celery_app = Celery(
     'restaurant_command_handlers',
     broker=settings.CELERY_BROKER)
 command_handlers_celery_app.conf.task_default_queue = restaurant_service_messaging.COMMANDS_QUEUE
+configure_wire_format(command_handlers_celery_app)
+configure_simulated_worker(command_handlers_celery_app, 'restaurant_service')
 
 
-@command_handlers_celery_app.task(bind=True, name=create_ticket_message.TASK_NAME)
-@saga_step_handler(response_queue=CREATE_ORDER_SAGA_RESPONSE_QUEUE)
-def create_ticket_task(self: Task, saga_id: int, payload: dict) -> dict:
-    request_data = create_ticket_message.Payload(**payload)
+@simulated(create_ticket_message.TASK_NAME)
+def create_ticket(saga_id: int, payload: dict) -> dict:
+    request_data = decode_payload(create_ticket_message.TASK_NAME, payload)  # type: create_ticket_message.Payload
 
-    # in real world, we would create a ticket in restaurant service DB
-    # here, we will just generate some fake ID of just created ticket
-    ticket_id = random.randint(200, 300)
-    logging.info(f'Restaurant ticket {request_data} created')
-    logging.info(f'Ticket details: {payload}')
+    ticket_id = ticket_store.create(order_id=request_data.order_id, saga_id=saga_id,
+                                    customer_id=request_data.customer_id,
+                                    items=[asdict(item) for item in request_data.items])
+    log = saga_logger(logger, saga_id)
+    log.info('Restaurant ticket %s created', ticket_id)
+    log.debug('Ticket items: %s', request_data.items)
 
     return asdict(create_ticket_message.Response(
         ticket_id=ticket_id
     ))
 
 
+@command_handlers_celery_app.task(bind=True, name=create_ticket_message.TASK_NAME)
+@saga_step_handler(response_queue=create_order_saga_response_queue)
+def create_ticket_task(self: Task, saga_id: int, payload: dict) -> dict:
+    return create_ticket(saga_id, payload)
+
+
 @command_handlers_celery_app.task(bind=True, name=reject_ticket_message.TASK_NAME)
 @no_response_saga_step_handler  # no response is sent back to orchestrator. it's typical for compensation steps
+@simulated(reject_ticket_message.TASK_NAME)
 def reject_ticket_task(self: Task, saga_id: int, payload: dict) -> typing.Union[dict, None]:
-    request_data = reject_ticket_message.Payload(**payload)
+    request_data = decode_payload(reject_ticket_message.TASK_NAME, payload)  # type: reject_ticket_message.Payload
 
-    # in real world, we would reject a ticket in restaurant service DB
-    logging.info(f'Restaurant ticket {request_data.ticket_id} rejected')
+    ticket_store.reject(request_data.ticket_id)
+    saga_logger(logger, saga_id).info('Restaurant ticket %s rejected', request_data.ticket_id)
 
     return None
 
 
-@command_handlers_celery_app.task(
-    bind=True, name=approve_ticket_message.TASK_NAME,
-    default_retry_delay=5  # set some small retry delay to not wait 3 minutes Celery sets by default
-)
-@saga_step_handler(response_queue=CREATE_ORDER_SAGA_RESPONSE_QUEUE)
-@auto_retry_then_reraise(max_retries=2)  # retry task 2 times, then re-raise exception
+class EmulatedApprovalError(EnvironmentError):
+    """
+    Random approval failure, emulated to show retries. Ticket store isn't called, so it doesn't count as its failure
+     (neither by circuit breaker below, nor by orchestrator, as the type isn't one of TRANSIENT_ERROR_TYPES)
+    """
+
+
+@command_handlers_celery_app.task(bind=True, name=approve_ticket_message.TASK_NAME)
+@saga_step_handler(response_queue=create_order_saga_response_queue)
+# retry task 2 times (after 0-1 and 0-2 seconds), then re-raise exception.
+# While ticket store fails, tasks fail fast and sagas are compensated.
+# Tickets that can't be approved (missing or rejected) fail the task at once
+@retry_with_backoff(RetryPolicy(max_retries=2, base_delay=1, max_delay=10), circuit_breakers.get('ticket_store'),
+                    uncounted_errors=(EmulatedApprovalError,),
+                    business_errors=(TicketNotFound, TicketStatusConflict))
+@simulated(approve_ticket_message.TASK_NAME)
 def approve_ticket_task(self: Task, saga_id: int, payload: dict) -> typing.Union[dict, None]:
-    request_data = approve_ticket_message.Payload(**payload)
+    request_data = decode_payload(approve_ticket_message.TASK_NAME, payload)  # type: approve_ticket_message.Payload
 
-    # emulate 30%-probable failure
-    if random.random() < 0.3:
-        raise EnvironmentError('test error message. Task will retry now')
+    # emulate 30%-probable failure (in simulation mode, failures are set by the profile)
+    if not simulator.enabled and random.random() < 0.3:
+        raise EmulatedApprovalError('test error message. Task will retry now')
 
-    # in real world, we would change ticket status to 'approved' in service DB
-    logging.info(f'Restaurant ticket {request_data.ticket_id} approved')
+    ticket_store.approve(request_data.ticket_id)
+    saga_logger(logger, saga_id).info('Restaurant ticket %s approved', request_data.ticket_id)
 
     return None
+
+
+# bulk handlers of batch mode (see batch_worker.py): tickets of a whole batch are changed with one statement.
+#  Unlike the tasks above, they don't emulate random approval failures.
+#  In simulation mode, each command is simulated, and tickets of failed ones aren't changed
+def approve_tickets(commands: typing.List[typing.Tuple[int, dict]]) -> typing.List[typing.Optional[Exception]]:
+    ticket_ids = [decode_payload(approve_ticket_message.TASK_NAME, payload).ticket_id for _, payload in commands]
+    errors = simulate_each(approve_ticket_message.TASK_NAME, len(commands))
+    result = ticket_store.approve_many([ticket_id for ticket_id, error in zip(ticket_ids, errors) if error is None])
+    logger.info('Restaurant tickets approved: %s, already approved: %s', len(result.changed), len(result.unchanged))
+
+    return [error or result.error_for(ticket_id) for ticket_id, error in zip(ticket_ids, errors)]
+
+
+def reject_tickets(commands: typing.List[typing.Tuple[int, dict]]) -> None:
+    ticket_ids = [decode_payload(reject_ticket_message.TASK_NAME, payload).ticket_id for _, payload in commands]
+    errors = simulate_each(reject_ticket_message.TASK_NAME, len(commands))
+    result = ticket_store.reject_many([ticket_id for ticket_id, error in zip(ticket_ids, errors) if error is None])
+    logger.info('Restaurant tickets rejected: %s, already rejected: %s', len(result.changed), len(result.unchanged))
+
+    # no responses are sent for compensation steps, so errors are only logged
+    for (saga_id, _), ticket_id, error in zip(commands, ticket_ids, errors):
+        error = error or result.error_for(ticket_id)
+        if error:
+            saga_logger(logger, saga_id).error('Failed to reject restaurant ticket %s: %s', ticket_id, error)
+
+
+# e.g. retries and circuit breaker state
+if os.getenv('WORKER_METRICS_PORT'):
+    metrics.start_http_server(int(os.getenv('WORKER_METRICS_PORT')))
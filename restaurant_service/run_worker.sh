@@ -1 +1,8 @@
-PYTHONPATH=. pipenv run celery -A restaurant_service.worker worker --loglevel=INFO
\ No newline at end of file
+# creates missing tables first: worker doesn't do it on import
+PYTHONPATH=. pipenv run python -m restaurant_service.models
+
+if [ "$BATCH_MODE" = "1" ]; then
+  PYTHONPATH=. pipenv run python -m restaurant_service.batch_worker
+else
+  PYTHONPATH=. pipenv run celery -A restaurant_service.worker worker --loglevel=INFO
+fi